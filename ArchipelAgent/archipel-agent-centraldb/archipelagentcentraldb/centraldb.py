@@ -20,6 +20,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import datetime
+import hashlib
 import random
 import sqlite3
 
@@ -38,6 +39,28 @@ ARCHIPEL_ERROR_CODE_CENTRALAGENT         = 123
 
 ARCHIPEL_CENTRAL_AGENT_TIMEOUT           = 120
 
+# max number of vms per sync_vms iq
+ARCHIPEL_CENTRALDB_SYNC_CHUNK_SIZE       = 500
+
+# max number of vms, and max size of their definitions, per register_vms iq
+ARCHIPEL_CENTRALDB_REGISTER_CHUNK_SIZE   = 50
+ARCHIPEL_CENTRALDB_REGISTER_CHUNK_BYTES  = 262144
+
+
+def definition_hash(domain):
+    """
+    Compute the hash of a domain definition, as done by the central agent.
+    The whitespaces are collapsed, because XML attributes values are
+    normalized when sent over XMPP.
+    @type domain: string
+    @param domain: the domain definition
+    @rtype: string
+    @return: the hexadecimal sha1 of the definition
+    """
+    if isinstance(domain, unicode):
+        domain = domain.encode("utf-8")
+    return hashlib.sha1(" ".join(domain.split())).hexdigest()
+
 class TNCentralDb (TNArchipelPlugin):
     """
     This contains the necessary interfaces to interact with central agent and central db
@@ -229,15 +252,18 @@ class TNCentralDb (TNArchipelPlugin):
         Consequently, we re-populate central database
         since we are using "on conflict replace" mode of sqlite, inserting an existing uuid will overwrite it.
         """
-        vm_table = []
+        vm_table = {}
 
         for vm,vmprops in self.entity.virtualmachines.iteritems():
 
-            vm_table.append({"uuid":vmprops.uuid,"parker":None,"creation_date":None,"domain":vmprops.definition,"hypervisor":self.entity.jid})
+            domain = "None"
+            if vmprops.definition:
+                domain = unicode(vmprops.definition)
+            vm_table[vmprops.uuid] = {"uuid":vmprops.uuid,"parker":None,"creation_date":None,"domain":domain,"hypervisor":self.entity.jid}
 
         if len(vm_table) >= 1:
 
-            self.register_vms(vm_table)
+            self.sync_vms(vm_table)
 
         self.register_hypervisors([{"jid":self.entity.jid, "status":"Online", "last_seen": datetime.datetime.now(), "stat1":0, "stat2":0, "stat3":0}])
         # parsing required statistics to be pushed to central agent
@@ -247,25 +273,107 @@ class TNCentralDb (TNArchipelPlugin):
             for required_stat in central_announcement_event.getTag("required_stats").getChildren():
                 self.required_statistics.append({"major":required_stat.getAttr("major"),"minor":required_stat.getAttr("minor")})
 
+    def sync_vms(self, vm_table):
+        """
+        Send the definition hashes of the vms to the central agent, and
+        register only the vms it doesn't have, or has with another definition.
+        If the central agent doesn't support sync_vms, all the vms are registered.
+        @type vm_table: dict
+        @param vm_table: the vms to register, indexed by uuid
+        """
+        uuids = vm_table.keys()
+
+        for i in range(0, len(uuids), ARCHIPEL_CENTRALDB_SYNC_CHUNK_SIZE):
+
+            chunk = uuids[i:i + ARCHIPEL_CENTRALDB_SYNC_CHUNK_SIZE]
+            hashes = [{"uuid": uuid, "domain_hash": definition_hash(vm_table[uuid]["domain"])} for uuid in chunk]
+
+            def _sync_vms_callback(entries):
+                vms = [vm_table[entry["uuid"]] for entry in entries if entry.get("uuid") in vm_table]
+                self.entity.log.debug("CENTRALDB: central agent needs %d vm definitions" % len(vms))
+                self.register_vms_in_chunks(vms)
+
+            def _sync_vms_error_callback(resp, chunk=chunk):
+                self.entity.log.warning("CENTRALDB: central agent cannot sync vms, registering all of them")
+                self.register_vms_in_chunks([vm_table[uuid] for uuid in chunk])
+
+            self.commit_to_db("sync_vms", hashes, _sync_vms_callback, _sync_vms_error_callback)
+
+    def register_vms_in_chunks(self, vms):
+        """
+        Register vms with several iqs, so no iq is too large.
+        @type vms: list
+        @param vms: the list of vms to register
+        """
+        chunk = []
+        chunk_bytes = 0
+
+        for vm in vms:
+
+            chunk.append(vm)
+            chunk_bytes += len(vm["domain"] or "")
+
+            if len(chunk) >= ARCHIPEL_CENTRALDB_REGISTER_CHUNK_SIZE or chunk_bytes >= ARCHIPEL_CENTRALDB_REGISTER_CHUNK_BYTES:
+                self.register_vms(chunk)
+                chunk = []
+                chunk_bytes = 0
+
+        if chunk:
+            self.register_vms(chunk)
+
     ### Database Management
 
     #### read commands
 
-    def read_hypervisors(self, columns, where_statement, callback):
+    def read_hypervisors(self, columns, callback, jids=None, status=None):
         """
-        List vm in database.
-        @type table: list
-        @param table: the list of hypervisors to insert
+        List hypervisors in central database.
+        @type columns: string
+        @param columns: comma separated list of columns, or "*"
+        @type callback: func
+        @param callback: will receive the list of hypervisors
+        @type jids: list
+        @param jids: if set, only read these hypervisors
+        @type status: string
+        @param status: if set, only read the hypervisors with this status
         """
-        self.read_from_db("read_hypervisors", columns, where_statement, callback)
+        filters = {}
+        if status:
+            filters["status"] = status
+        self.read_from_db("read_hypervisors", columns, filters, "jid", jids, callback)
 
-    def read_vms(self, columns, where_statement, callback):
+    def read_vms(self, columns, callback, uuids=None, hypervisor=None, parked=False, order=None, limit=None, offset=0):
         """
-        Registers a list of vms into central database.
-        @type table: list
-        @param table: the list of vms to insert
-        """
-        self.read_from_db("read_vms", columns, where_statement, callback)
+        List vms in central database.
+        @type columns: string
+        @param columns: comma separated list of columns, or "*"
+        @type callback: func
+        @param callback: will receive the list of vms
+        @type uuids: list
+        @param uuids: if set, only read these vms
+        @type hypervisor: string
+        @param hypervisor: if set, only read the vms of this hypervisor
+        @type parked: Boolean
+        @param parked: if True, only read the parked vms
+        @type order: string
+        @param order: if set, the column to sort the vms by
+        @type limit: int
+        @param limit: if set, the max number of vms to read
+        @type offset: int
+        @param offset: the number of vms to skip
+        """
+        filters = {}
+        if hypervisor:
+            filters["hypervisor"] = hypervisor
+        if parked:
+            filters["parked"] = "true"
+        if order:
+            filters["order"] = order
+        if limit is not None:
+            filters["limit"] = limit
+        if offset:
+            filters["offset"] = offset
+        self.read_from_db("read_vms", columns, filters, "uuid", uuids, callback)
 
     #### write commands
 
@@ -331,13 +439,15 @@ class TNCentralDb (TNArchipelPlugin):
         """
         self.commit_to_db("update_hypervisors",table, None)
 
-    def commit_to_db(self,action,table,callback):
+    def commit_to_db(self,action,table,callback,error_callback=None):
         """
         Sends a command to active central agent for execution
         @type command: string
         @param command: the sql command to execute
         @type table: table
         @param command: the table of dicts of values associated with the command.
+        @type error_callback: func
+        @param error_callback: if set, called with the response instead of callback when the command fails
         """
         central_agent_jid = self.central_agent_jid()
 
@@ -359,7 +469,11 @@ class TNCentralDb (TNArchipelPlugin):
 
             def commit_to_db_callback(conn,resp):
 
-                if callback:
+                if error_callback and resp.getType() == "error":
+
+                    error_callback(resp)
+
+                elif callback:
 
                     unpacked_entries = self.unpack_entries(resp)
                     callback(unpacked_entries)
@@ -374,29 +488,44 @@ class TNCentralDb (TNArchipelPlugin):
 
             self.entity.log.warning("CENTRALDB: cannot commit to db because we have not detected any central agent")
 
-    def read_from_db(self,action,columns, where_statement, callback):
+    def read_from_db(self, action, columns, filters, key, keys, callback):
         """
-        Send a select statement to central db.
-        @type command: string
-        @param command: the sql command to execute
+        Send a read request to central db.
+        @type action: string
+        @param action: the read action to perform
         @type columns: string
         @param columns: the list of database columns to return
-        @type where_statement: string
-        @param where_statement: for database reads, provides "where" constraint
+        @type filters: dict
+        @param filters: the values the rows must match
+        @type key: string
+        @param key: the name of the key column
+        @type keys: list
+        @param keys: if set, only read the rows with these keys
+        @type callback: func
+        @param callback: will receive the list of rows
         """
         central_agent_jid = self.central_agent_jid()
 
-        if central_agent_jid:
+        if keys is not None and len(keys) == 0:
+
+            callback([])
+
+        elif central_agent_jid:
 
             # send an iq to central agent
             dbCommand = xmpp.Node(tag="event", attrs={"jid":self.entity.jid})
 
-            if where_statement:
-                dbCommand.setAttr("where_statement", where_statement)
+            for name, value in filters.iteritems():
+                dbCommand.setAttr(name, value)
+
+            for value in keys or []:
+                entryTag = xmpp.Node(tag="entry")
+                entryTag.addChild("item", attrs={"key": key, "value": value})
+                dbCommand.addChild(node=entryTag)
 
             if columns:
                 dbCommand.setAttr("columns", columns)
-            self.entity.log.debug("CENTRALDB: Asking central db for [%s] %s %s" % (action.upper(), columns, where_statement))
+            self.entity.log.debug("CENTRALDB: Asking central db for [%s] %s %s" % (action.upper(), columns, filters))
             iq = xmpp.Iq(typ="set", queryNS=ARCHIPEL_NS_CENTRALAGENT, to=central_agent_jid)
             iq.getTag("query").addChild(name="archipel", attrs={"action":action})
             iq.getTag("query").getTag("archipel").addChild(node=dbCommand)
@@ -21,15 +21,282 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import datetime
+import os
+import re
+import select
 import sqlite3
 import subprocess
 import time
 import json
-from threading import Thread
+from array import array
+from threading import Lock, Thread
 
 from archipelcore.utils import log
 
 
+# filesystems ignored by disk stats (as df -x)
+ARCHIPEL_HEALTH_IGNORED_FILESYSTEMS = ("devfs", "devtmpfs", "tmpfs")
+
+# the stats tables: name, columns and the matching fields of the records.
+# Tables are partitioned by day (UTC): cpu_20140131, memory_20140131...
+ARCHIPEL_HEALTH_TABLES              = (("cpu", "idle float, iowait float, steal float", ("id", "iowait", "steal")),
+                                       ("memory", "free integer, used integer, total integer, swapped integer, shared integer", ("free", "used", "total", "swapped", "shared")),
+                                       ("load", "one float, five float, fifteen float", ("one", "five", "fifteen")),
+                                       ("network", "records text", ("records",)))
+
+# the rollups: resolution and retention, in seconds
+ARCHIPEL_HEALTH_ROLLUPS             = ((60, 2 * 86400), (900, 30 * 86400), (3600, 365 * 86400))
+
+# the fields aggregated in the rollups, by stat. network is the sum of the deltas of all NICs
+ARCHIPEL_HEALTH_ROLLUP_FIELDS       = (("cpu", ("id", "iowait", "steal")),
+                                       ("memory", ("free", "used", "total", "swapped", "shared")),
+                                       ("load", ("one", "five", "fifteen")),
+                                       ("network", ("delta",)))
+
+# max number of samples returned by a history query
+ARCHIPEL_HEALTH_HISTORY_MAX_POINTS  = 500
+
+
+def to_timestamp(date):
+    """
+    Convert a date stored by sqlite3 into an epoch timestamp.
+    @type date: string
+    @param date: the date, as "YYYY-MM-DD HH:MM:SS[.ffffff]"
+    @rtype: float
+    @return: the timestamp
+    """
+    seconds, _, microseconds = str(date).partition(".")
+    parsed = datetime.datetime.strptime(seconds, "%Y-%m-%d %H:%M:%S")
+    return time.mktime(parsed.timetuple()) + float("0.%s" % (microseconds or "0"))
+
+
+class TNStatsRingBuffer (object):
+    """
+    Fixed size ring buffer of stat records. Each numeric field is stored in
+    its own array of floats, the timestamps (in seconds since epoch) too.
+    Fields that are not numbers (like the per-NIC network deltas) are
+    stored as Python objects.
+    """
+
+    def __init__(self, size, columns, object_columns=()):
+        """
+        Initialize the buffer.
+        @type size: integer
+        @param size: the max number of records
+        @type columns: tuple
+        @param columns: the names of the numeric fields
+        @type object_columns: tuple
+        @param object_columns: the names of the other fields
+        """
+        self.size           = max(1, size)
+        self.columns        = columns
+        self.object_columns = object_columns
+        self.dates          = array("d", [0.0] * self.size)
+        self.values         = dict([(column, array("d", [0.0] * self.size)) for column in columns])
+        self.objects        = dict([(column, [None] * self.size) for column in object_columns])
+        self.count          = 0
+        self.total          = 0
+        self.saved          = 0
+        self.lock           = Lock()
+
+    def __len__(self):
+        """
+        @rtype: integer
+        @return: the number of records in the buffer
+        """
+        return self.count
+
+    def __getitem__(self, index):
+        """
+        Return a record. As with a list, -1 is the newest one.
+        @type index: integer
+        @param index: the index of the record
+        @rtype: dict
+        @return: the record
+        """
+        with self.lock:
+            if index < 0:
+                index += self.count
+            if index < 0 or index >= self.count:
+                raise IndexError("stat record index out of range")
+            return self.build_record((self.total - self.count + index) % self.size)
+
+    def build_record(self, position):
+        """
+        Build the record stored at the given position of the arrays.
+        @type position: integer
+        @param position: the position in the arrays
+        @rtype: dict
+        @return: the record
+        """
+        record = {"date": self.dates[position]}
+        for column in self.columns:
+            record[column] = self.values[column][position]
+        for column in self.object_columns:
+            record[column] = self.objects[column][position]
+        return record
+
+    def append(self, record):
+        """
+        Add a record, overwriting the oldest one if the buffer is full.
+        @type record: dict
+        @param record: the record, with a date key containing a timestamp
+        """
+        with self.lock:
+            position = self.total % self.size
+            self.dates[position] = record["date"]
+            for column in self.columns:
+                self.values[column][position] = record[column]
+            for column in self.object_columns:
+                self.objects[column][position] = record[column]
+            self.total += 1
+            self.count = min(self.count + 1, self.size)
+
+    def last(self, limit):
+        """
+        Return the last records, the newest first.
+        @type limit: integer
+        @param limit: the max number of records
+        @rtype: list
+        @return: list of records
+        """
+        with self.lock:
+            return [self.build_record((self.total - 1 - i) % self.size) for i in range(min(limit, self.count))]
+
+    def between(self, start, end):
+        """
+        Return the records with a date in the given range, the oldest first.
+        @type start: float
+        @param start: the min timestamp
+        @type end: float
+        @param end: the max timestamp
+        @rtype: list
+        @return: list of records
+        """
+        with self.lock:
+            first = self.total - self.count
+            low, high = first, self.total
+            while low < high:
+                middle = (low + high) / 2
+                if self.dates[middle % self.size] < start:
+                    low = middle + 1
+                else:
+                    high = middle
+            records = []
+            for i in range(low, self.total):
+                if self.dates[i % self.size] > end:
+                    break
+                records.append(self.build_record(i % self.size))
+            return records
+
+    def unsaved(self):
+        """
+        Return the records added since the last call to mark_saved, the oldest first.
+        @rtype: tuple
+        @return: the list of records, and the marker to give to mark_saved once saved
+        """
+        with self.lock:
+            start = max(self.saved, self.total - self.count)
+            return ([self.build_record(i % self.size) for i in range(start, self.total)], self.total)
+
+    def mark_saved(self, marker=None):
+        """
+        Mark records as saved.
+        @type marker: integer
+        @param marker: the marker returned by unsaved. If None, all the records
+        """
+        with self.lock:
+            if marker is None:
+                marker = self.total
+            self.saved = marker
+
+
+class TNStatsRollup (object):
+    """
+    Min, average and max of the stats by bucket of a given resolution. The
+    current bucket is updated by each collection, and stored in a
+    L{TNStatsRingBuffer} when the next one starts.
+    """
+
+    def __init__(self, resolution, retention):
+        """
+        Initialize the rollup.
+        @type resolution: integer
+        @param resolution: the duration of a bucket, in seconds
+        @type retention: integer
+        @param retention: number of seconds of buckets to keep in memory
+        """
+        self.resolution = resolution
+        self.retention  = retention
+        self.fields     = [field for stat, fields in ARCHIPEL_HEALTH_ROLLUP_FIELDS for field in fields]
+        self.columns    = tuple(["%s_%s" % (field, function) for field in self.fields for function in ("min", "avg", "max")])
+        self.buckets    = TNStatsRingBuffer(retention / resolution, self.columns)
+        self.start      = None
+        self.count      = 0
+        self.minimums   = None
+        self.sums       = None
+        self.maximums   = None
+        self.lock       = Lock()
+
+    def add(self, timestamp, values):
+        """
+        Add the values of a collection.
+        @type timestamp: float
+        @param timestamp: the date of the collection
+        @type values: dict
+        @param values: the values, indexed by field
+        """
+        start = int(timestamp) - int(timestamp) % self.resolution
+        with self.lock:
+            if self.start is not None and not self.start == start:
+                self.buckets.append(self.build_current())
+                self.start = None
+            if self.start is None:
+                self.start = start
+                self.count = 0
+                self.minimums = dict([(field, values[field]) for field in self.fields])
+                self.sums = dict([(field, 0.0) for field in self.fields])
+                self.maximums = dict([(field, values[field]) for field in self.fields])
+            self.count += 1
+            for field in self.fields:
+                value = values[field]
+                self.sums[field] += value
+                if value < self.minimums[field]:
+                    self.minimums[field] = value
+                if value > self.maximums[field]:
+                    self.maximums[field] = value
+
+    def build_current(self):
+        """
+        Build the record of the current bucket.
+        @rtype: dict
+        @return: the record
+        """
+        record = {"date": float(self.start)}
+        for field in self.fields:
+            record["%s_min" % field] = self.minimums[field]
+            record["%s_avg" % field] = self.sums[field] / self.count
+            record["%s_max" % field] = self.maximums[field]
+        return record
+
+    def between(self, start, end):
+        """
+        Return the buckets overlapping the given range, including the current one, the oldest first.
+        @type start: float
+        @param start: the min timestamp
+        @type end: float
+        @param end: the max timestamp
+        @rtype: list
+        @return: list of records
+        """
+        start = start - self.resolution + 1
+        records = self.buckets.between(start, end)
+        with self.lock:
+            if self.start is not None and start <= self.start <= end:
+                records.append(self.build_current())
+        return records
+
+
 class TNThreadedHealthCollector (Thread):
     """
     This class collects hypervisor stats regularly.
@@ -51,60 +318,159 @@ class TNThreadedHealthCollector (Thread):
         self.collection_interval    = collection_interval
         self.max_rows_before_purge  = max_rows_before_purge
         self.max_cached_rows        = max_cached_rows
-        self.stats_CPU              = []
-        self.stats_memory           = []
-        self.stats_load             = []
-        self.stats_network          = []
+        self.stats_CPU              = TNStatsRingBuffer(max_cached_rows, ("id", "iowait", "steal"), ("cores",))
+        self.stats_memory           = TNStatsRingBuffer(max_cached_rows, ("free", "used", "total", "swapped", "shared"))
+        self.stats_load             = TNStatsRingBuffer(max_cached_rows, ("one", "five", "fifteen"))
+        self.stats_network          = TNStatsRingBuffer(max_cached_rows, (), ("records",))
         self.current_record         = {}
+        self.mounts                 = None
+        self.mounts_file            = None
+        self.mounts_poller          = None
+        self.disk_stats_cache       = None
+        self.disk_stats_date        = 0
+        self.disk_stats_lock        = Lock()
+        self.cpu_times              = self.get_cpu_times()
+        self.buffers                = {"cpu": self.stats_CPU, "memory": self.stats_memory, "load": self.stats_load, "network": self.stats_network}
+        self.partitions             = set()
+        self.retention              = max_rows_before_purge * collection_interval
+        self.rollups                = [TNStatsRollup(resolution, retention) for resolution, retention in ARCHIPEL_HEALTH_ROLLUPS]
         self.memoryPageSize         = int(subprocess.Popen(["getconf", "PAGESIZE"], stdout=subprocess.PIPE).communicate()[0])
         uname = subprocess.Popen(["uname", "-rsmo"], stdout=subprocess.PIPE).communicate()[0].split()
         self.uname_stats = {"krelease": uname[0], "kname": uname[1], "machine": uname[2], "os": uname[3]}
         self.database_query_connection = sqlite3.connect(self.database_file)
         self.cursor = self.database_query_connection.cursor()
-        self.cursor.execute("create table if not exists cpu (collection_date date, idle int)")
-        self.cursor.execute("create table if not exists memory (collection_date date, free integer, used integer, total integer, swapped integer, shared integer)")
-        self.cursor.execute("create table if not exists load (collection_date date, one float, five float, fifteen float)")
-        self.cursor.execute("create table if not exists network (collection_date date, records text)")
-        self.database_query_connection.commit()
+        self.cursor.execute("pragma journal_mode=WAL")
+        self.cursor.execute("pragma synchronous=NORMAL")
+        for name, in self.cursor.execute("select name from sqlite_master where type='table'").fetchall():
+            if re.match(r"^(%s)_\d{8}$" % "|".join([table[0] for table in ARCHIPEL_HEALTH_TABLES]), name):
+                self.partitions.add(name)
+        self.migrate_legacy_tables()
+        for rollup in self.rollups:
+            self.cursor.execute("create table if not exists rollup_%d (collection_date integer, %s)" % (rollup.resolution, ", ".join(["%s float" % column for column in rollup.columns])))
+            self.cursor.execute("create index if not exists rollup_%d_collection_date on rollup_%d (collection_date)" % (rollup.resolution, rollup.resolution))
         log.info("Database ready.")
         self.recover_stored_stats()
         self.cursor.close()
         Thread.__init__(self)
 
+    def get_partition(self, table, timestamp):
+        """
+        Return the name of the partition of a table containing the given timestamp.
+        @type table: string
+        @param table: the name of the table
+        @type timestamp: float
+        @param timestamp: the timestamp
+        @rtype: string
+        @return: the name of the partition
+        """
+        return "%s_%s" % (table, time.strftime("%Y%m%d", time.gmtime(timestamp)))
+
+    def get_partitions(self, table):
+        """
+        Return the existing partitions of a table, the newest first.
+        @type table: string
+        @param table: the name of the table
+        @rtype: list
+        @return: the names of the partitions
+        """
+        return sorted([name for name in self.partitions if name.rsplit("_", 1)[0] == table], reverse=True)
+
+    def create_partition(self, cursor, table, partition):
+        """
+        Create a partition of a table, with an index on collection_date.
+        @type cursor: sqlite3.Cursor
+        @param cursor: the cursor to use
+        @type table: string
+        @param table: the name of the table
+        @type partition: string
+        @param partition: the name of the partition
+        """
+        if partition in self.partitions:
+            return
+        columns = [definition for name, definition, fields in ARCHIPEL_HEALTH_TABLES if name == table][0]
+        cursor.execute("create table if not exists %s (collection_date integer, %s)" % (partition, columns))
+        cursor.execute("create index if not exists %s_collection_date on %s (collection_date)" % (partition, partition))
+        self.partitions.add(partition)
+
+    def insert_records(self, cursor, table, records):
+        """
+        Insert records in the partitions of a table. Dates must be timestamps,
+        and network records must be already serialized.
+        @type cursor: sqlite3.Cursor
+        @param cursor: the cursor to use
+        @type table: string
+        @param table: the name of the table
+        @type records: list
+        @param records: the records
+        """
+        fields = [fields for name, definition, fields in ARCHIPEL_HEALTH_TABLES if name == table][0]
+        by_partition = {}
+        for record in records:
+            by_partition.setdefault(self.get_partition(table, record["date"]), []).append(record)
+        for partition, partition_records in by_partition.items():
+            self.create_partition(cursor, table, partition)
+            cursor.executemany("insert into %s values(%s)" % (partition, ", ".join(["?"] * (len(fields) + 1))),
+                               [[int(record["date"])] + [record[field] for field in fields] for record in partition_records])
+
+    def migrate_legacy_tables(self):
+        """
+        Move the stats of the tables used by previous versions (one table per
+        stat, with dates as strings) into the partitions, and drop them.
+        """
+        for table, definition, fields in ARCHIPEL_HEALTH_TABLES:
+            if not self.cursor.execute("select name from sqlite_master where type='table' and name=?", (table,)).fetchone():
+                continue
+            log.info("Migrating stored statistics of table %s. It may take a while..." % table)
+            columns = [column[1] for column in self.cursor.execute("pragma table_info(%s)" % table)]
+            records = []
+            for row in self.cursor.execute("select * from %s" % table).fetchall():
+                values = dict(zip(columns, row))
+                record = {"date": to_timestamp(values["collection_date"])}
+                for column, field in zip([column.strip().split()[0] for column in definition.split(",")], fields):
+                    record[field] = values.get(column) or 0
+                records.append(record)
+            self.insert_records(self.cursor, table, records)
+            self.cursor.execute("drop table %s" % table)
+            self.database_query_connection.commit()
+
     def recover_stored_stats(self):
         """
-        Recover info from database.
-        """
-        log.info("Recovering stored statistics. It may take a while...")
-        self.cursor.execute("select * from cpu order by collection_date desc limit %d" % self.max_cached_rows)
-        for values in self.cursor:
-            date, idle = values
-            self.stats_CPU.append({"date": date, "id": idle})
-        self.stats_CPU.reverse()
-        self.cursor.execute("select * from memory order by collection_date desc limit %d" % self.max_cached_rows)
-        for values in self.cursor:
-            date, free, used, total, swapped, shared = values
-            self.stats_memory.append({"date": date, "free": free, "used": used, "total": total, "swapped": swapped, "shared": shared})
-        self.stats_memory.reverse()
-        self.cursor.execute("select * from load order by collection_date desc limit %d" % self.max_cached_rows)
-        for values in self.cursor:
-            date, one, five, fifteen = values
-            self.stats_load.append({"date": date, "one": one, "five": five, "fifteen": fifteen})
-        self.stats_load.reverse()
-        self.cursor.execute("select * from network order by collection_date desc limit %d" % self.max_cached_rows)
-        for values in self.cursor:
-            date, records = values
-            self.stats_network.append({"date": date, "records": records})
-        self.stats_network.reverse()
+        Recover the last max_cached_rows stats of each table from database.
+        Only the newest partitions are read, using their index.
+        """
+        log.info("Recovering stored statistics.")
+        for table, definition, fields in ARCHIPEL_HEALTH_TABLES:
+            rows = []
+            for partition in self.get_partitions(table):
+                if len(rows) >= self.max_cached_rows:
+                    break
+                rows += self.cursor.execute("select * from %s order by collection_date desc limit ?" % partition, (self.max_cached_rows - len(rows),)).fetchall()
+            for row in reversed(rows):
+                record = dict(zip(fields, row[1:]))
+                record["date"] = float(row[0])
+                if table == "cpu":
+                    record["cores"] = []
+                if table == "network":
+                    record["records"] = json.loads(record["records"])
+                self.buffers[table].append(record)
+            self.buffers[table].mark_saved()
+        for rollup in self.rollups:
+            rows = self.cursor.execute("select * from rollup_%d order by collection_date desc limit ?" % rollup.resolution, (rollup.buckets.size,)).fetchall()
+            for row in reversed(rows):
+                record = dict(zip(rollup.columns, row[1:]))
+                record["date"] = float(row[0])
+                rollup.buckets.append(record)
+            rollup.buckets.mark_saved()
         log.info("Statistics recovered.")
 
     def get_collected_stats(self, limit=1):
         """
-        This method returns the current L{TNArchipelVirtualMachine} instance.
+        Return the last collected stats, the newest first. Dates are
+        timestamps, and network records are dict of deltas indexed by NIC.
         @type limit: integer
         @param limit: the max number of row to get
-        @rtype: TNArchipelVirtualMachine
-        @return: the L{TNArchipelVirtualMachine} instance
+        @rtype: dict
+        @return: the stats
         """
         log.debug("STATCOLLECTOR: Retrieving last "+ str(limit) + " recorded stats data for sending.")
         try:
@@ -113,34 +479,91 @@ class TNThreadedHealthCollector (Thread):
         except Exception as ex:
             raise Exception("Unable to get uptime.", ex)
         try:
-            acpu = self.stats_CPU[-limit:]
+            acpu = self.stats_CPU.last(limit)
         except Exception as ex:
             raise Exception("Unable to get CPU stats.", ex)
         try:
-            amem = self.stats_memory[-limit:]
+            amem = self.stats_memory.last(limit)
         except Exception as ex:
             raise Exception("Unable to get memory.", ex)
         try:
-            anetwork = self.stats_network[-limit:]
+            anetwork = self.stats_network.last(limit)
         except Exception as ex:
             raise Exception("Unable to get networks.", ex)
         try:
-            adisk = sorted(self.get_disk_stats(), cmp=lambda x, y: cmp(x["mount"], y["mount"]))
-            totalDisk = self.get_disk_total()
+            adisk, totalDisk = self.get_cached_disk_stats()
         except Exception as ex:
             raise Exception("Unable to get disks information.", ex)
         try:
-            aload = self.stats_load[-limit:]
+            aload = self.stats_load.last(limit)
         except Exception as ex:
             raise Exception("Unable to get disks information.", ex)
-        if limit > 1:
-            acpu.reverse()
-            amem.reverse()
-            aload.reverse()
-            anetwork.reverse()
         return {"cpu": acpu, "memory": amem, "disk": adisk, "totaldisk": totalDisk,
                 "load": aload, "uptime": uptime_stats, "uname": self.uname_stats, "network": anetwork}
 
+    def get_history(self, start, end, resolution=None, max_points=ARCHIPEL_HEALTH_HISTORY_MAX_POINTS):
+        """
+        Return the stats collected in a time range. With a resolution of 0,
+        the raw stats cached in memory are returned. Otherwise, the min, avg
+        and max of each field are returned, by bucket of the resolution.
+        @type start: float
+        @param start: the min timestamp
+        @type end: float
+        @param end: the max timestamp
+        @type resolution: integer
+        @param resolution: 0 or one of the rollup resolutions. If None, the finest
+                           resolution returning at most max_points samples is used
+        @type max_points: integer
+        @param max_points: the max number of samples. The newest ones are returned
+        @rtype: tuple
+        @return: the resolution used, and the list of samples, the oldest first.
+                 Each sample is a dict with a date, and a dict of values for cpu, memory, load and network
+        """
+        if resolution is None:
+            resolution = ARCHIPEL_HEALTH_ROLLUPS[-1][0]
+            for rollup_resolution, retention in ARCHIPEL_HEALTH_ROLLUPS:
+                if (end - start) / rollup_resolution <= max_points:
+                    resolution = rollup_resolution
+                    break
+        samples = []
+        if resolution == 0:
+            stats = [(stat, self.buffers[stat].between(start, end)) for stat, fields in ARCHIPEL_HEALTH_ROLLUP_FIELDS]
+            number_of_samples = min([len(records) for stat, records in stats])
+            for i in range(-number_of_samples, 0):
+                sample = {"date": stats[0][1][i]["date"]}
+                for stat, records in stats:
+                    sample[stat] = records[i]
+                samples.append(sample)
+        else:
+            rollups = [rollup for rollup in self.rollups if rollup.resolution == resolution]
+            if not rollups:
+                raise Exception("Unsupported resolution %s. Use 0 or one of %s" % (resolution, str([rollup.resolution for rollup in self.rollups])))
+            for record in rollups[0].between(start, end):
+                sample = {"date": record["date"]}
+                for stat, fields in ARCHIPEL_HEALTH_ROLLUP_FIELDS:
+                    sample[stat] = dict([(column, record[column]) for column in record if column.rsplit("_", 1)[0] in fields])
+                samples.append(sample)
+        return (resolution, samples[-max_points:])
+
+    def update_rollups(self, cpu, memory, load, network):
+        """
+        Add the stats of a collection to the rollups.
+        @type cpu: dict
+        @param cpu: the cpu stats
+        @type memory: dict
+        @param memory: the memory stats
+        @type load: dict
+        @param load: the load stats
+        @type network: dict
+        @param network: the network stats
+        """
+        values = {"delta": sum(network["records"].values())}
+        for stat, record in (("cpu", cpu), ("memory", memory), ("load", load)):
+            for field in dict(ARCHIPEL_HEALTH_ROLLUP_FIELDS)[stat]:
+                values[field] = record[field]
+        for rollup in self.rollups:
+            rollup.add(cpu["date"], values)
+
     def get_uptime(self):
         """
         Get the uptime from /proc/uptime.
@@ -188,17 +611,61 @@ class TNThreadedHealthCollector (Thread):
         memFree = minfo["Cached"] + minfo["Buffers"] + minfo["MemFree"]
         swapped = minfo["SwapTotal"] - minfo["SwapFree"]
         memUsed = minfo["MemTotal"] - memFree
-        return {"date": datetime.datetime.now(), "free": memFree, "used": memUsed, "total": minfo["MemTotal"], "swapped": swapped, "shared": memshared}
+        return {"date": time.time(), "free": memFree, "used": memUsed, "total": minfo["MemTotal"], "swapped": swapped, "shared": memshared}
+
+    def get_cpu_times(self):
+        """
+        Read the CPU times from /proc/stat.
+        @rtype: dict
+        @return: list of user, nice, system, idle, iowait, irq, softirq, steal times, indexed
+                 by cpu name ("cpu" for the total, "cpu0", "cpu1"... for each core)
+        """
+        f = open('/proc/stat')
+        lines = f.readlines()
+        f.close()
+        times = {}
+        for line in lines:
+            if not line.startswith("cpu"):
+                continue
+            fields = line.split()
+            values = [int(value) for value in fields[1:9]]
+            times[fields[0]] = values + [0] * (8 - len(values))
+        return times
+
+    def get_cpu_percentages(self, previous, current):
+        """
+        Compute the CPU usage between two snapshots of /proc/stat.
+        @type previous: list
+        @param previous: the previous times of the cpu
+        @type current: list
+        @param current: the current times of the cpu
+        @rtype: dict
+        @return: the idle, iowait and steal percentages
+        """
+        delta = [current[i] - previous[i] for i in range(8)]
+        total = sum(delta)
+        if total <= 0:
+            return {"id": 100.0, "iowait": 0.0, "steal": 0.0}
+        return {"id": delta[3] * 100.0 / total, "iowait": delta[4] * 100.0 / total, "steal": delta[7] * 100.0 / total}
 
     def get_cpu_stats(self):
         """
-        Get CPU stats.
+        Get CPU stats, since the previous collection.
         @rtype: dict
         @return: dictionnary containing the informations
         """
-        dt = self.deltaTime(1)
-        cpuPct = (dt[len(dt) - 1] * 100.00 / sum(dt))
-        return {"date": datetime.datetime.now(), "id": cpuPct}
+        previous_times = self.cpu_times
+        current_times = self.get_cpu_times()
+        self.cpu_times = current_times
+        stats = self.get_cpu_percentages(previous_times["cpu"], current_times["cpu"])
+        cores = []
+        for index in range(len(current_times) - 1):
+            name = "cpu%d" % index
+            if name in current_times and name in previous_times:
+                cores.append(self.get_cpu_percentages(previous_times[name], current_times[name]))
+        stats["date"] = time.time()
+        stats["cores"] = cores
+        return stats
 
     def get_load_stats(self):
         """
@@ -212,39 +679,84 @@ class TNThreadedHealthCollector (Thread):
         load1min = float(contents[0])
         load5min = float(contents[1])
         load15min = float(contents[2])
-        return {"date": datetime.datetime.now(), "one": load1min, "five": load5min, "fifteen": load15min}
+        return {"date": time.time(), "one": load1min, "five": load5min, "fifteen": load15min}
+
+    def get_mounts(self):
+        """
+        Get the mounted filesystems from /proc/self/mounts. The file is parsed
+        again only when the kernel signals that the mount table has changed.
+        @rtype: list
+        @return: list of tuple (device, mount point), without ignored filesystems
+        """
+        if self.mounts is not None and self.mounts_poller:
+            try:
+                if not self.mounts_poller.poll(0):
+                    return self.mounts
+            except select.error:
+                pass
+        if not self.mounts_file:
+            self.mounts_file = open("/proc/self/mounts")
+            try:
+                self.mounts_poller = select.poll()
+                self.mounts_poller.register(self.mounts_file.fileno(), select.POLLERR | select.POLLPRI)
+            except (AttributeError, select.error):
+                self.mounts_poller = None
+        self.mounts_file.seek(0)
+        mounts = []
+        listed = set()
+        for line in self.mounts_file.read().split("\n"):
+            cell = line.split()
+            if len(cell) < 3 or cell[2] in ARCHIPEL_HEALTH_IGNORED_FILESYSTEMS:
+                continue
+            mount = re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), cell[1])
+            if mount in listed:
+                continue
+            listed.add(mount)
+            mounts.append((cell[0], mount))
+        self.mounts = mounts
+        return self.mounts
 
     def get_disk_stats(self):
         """
-        Get drive usage stats.
-        @rtype: dict
-        @return: dictionnary containing the informations
+        Get drive usage stats with statvfs, in the same units as df -P.
+        @rtype: tuple
+        @return: the list of partitions sorted by mount point, and the total
         """
-        output  = subprocess.Popen(["df", "-P", "-x", "devfs", "-x", "devtmpfs", "-x", "tmpfs"], stdout=subprocess.PIPE).communicate()[0]
-        listed  = []
-        ret     = []
-        out     = output.split("\n")[1:-1]
-        for l in out:
-            cell = l.split()
-            if cell[5] in listed:
+        ret = []
+        total_used = 0
+        total_available = 0
+        for partition, mount in self.get_mounts():
+            try:
+                st = os.statvfs(mount)
+            except OSError:
+                continue
+            if st.f_blocks == 0:
                 continue
-            ret.append({"partition": cell[0], "blocks": cell[1], "used": int(cell[2]) * 1024, "available": int(cell[3]) * 1024, "capacity": cell[4], "mount": cell[5]})
-            listed.append(cell[5])
-        return ret
+            used = (st.f_blocks - st.f_bfree) * st.f_frsize
+            available = st.f_bavail * st.f_frsize
+            capacity = 0
+            if used + available > 0:
+                capacity = (used * 100 + used + available - 1) / (used + available)
+            ret.append({"partition": partition, "blocks": str(st.f_blocks * st.f_frsize / 1024), "used": used, "available": available, "capacity": "%d%%" % capacity, "mount": mount})
+            total_used += used
+            total_available += available
+        total_capacity = 0
+        if total_used + total_available > 0:
+            total_capacity = (total_used * 100 + total_used + total_available - 1) / (total_used + total_available)
+        total = {"used": str(total_used / 1024), "available": str(total_available / 1024), "capacity": "%d%%" % total_capacity}
+        return (sorted(ret, cmp=lambda x, y: cmp(x["mount"], y["mount"])), total)
 
-    def get_disk_total(self):
+    def get_cached_disk_stats(self):
         """
-        Get total size of drive used stats.
-        @rtype: dict
-        @return: dictionnary containing the informations
+        Get drive usage stats. They are computed at most once per collection interval.
+        @rtype: tuple
+        @return: the list of partitions sorted by mount point, and the total
         """
-        out = subprocess.Popen(["df", "--total", "-P", "-x", "devfs", "-x", "devtmpfs", "-x", "tmpfs"], stdout=subprocess.PIPE).communicate()[0].split("\n")
-        for line in out:
-            line = line.split()
-            if line[0] == "total":
-                disk_total = line
-                break
-        return {"used": disk_total[2], "available": disk_total[3], "capacity": disk_total[4]}
+        with self.disk_stats_lock:
+            if not self.disk_stats_cache or time.time() - self.disk_stats_date >= self.collection_interval:
+                self.disk_stats_cache = self.get_disk_stats()
+                self.disk_stats_date = time.time()
+            return self.disk_stats_cache
 
     def get_network_stats(self):
         """
@@ -273,29 +785,43 @@ class TNThreadedHealthCollector (Thread):
                 delta_usage = 0;
             ret[dev] = delta_usage
         self.current_record = records;
-        return {"date": datetime.datetime.now(), "records": json.dumps(ret)}
+        return {"date": time.time(), "records": ret}
 
-    def getTimeList(self):
+    def save_stats(self):
         """
-        ignore
+        Save the records collected since the last save in database, in a
+        single transaction, and drop the partitions older than the retention.
         """
-        statFile = file('/proc/stat')
-        timeList = statFile.readline().split(" ")[2:6]
-        statFile.close()
-        for i in range(len(timeList)):
-            timeList[i] = int(timeList[i])
-        return timeList
+        markers = {}
+        for table, definition, fields in ARCHIPEL_HEALTH_TABLES:
+            records, markers[table] = self.buffers[table].unsaved()
+            if table == "network":
+                for record in records:
+                    record["records"] = json.dumps(record["records"])
+            self.insert_records(self.database_thread_cursor, table, records)
 
-    def deltaTime(self, interval):
-        """
-        ignore
-        """
-        x = self.getTimeList()
-        time.sleep(interval)
-        y = self.getTimeList()
-        for i in range(len(x)):
-            y[i] -= x[i]
-        return y
+        oldest_partition_day = time.strftime("%Y%m%d", time.gmtime(time.time() - self.retention))
+        for table, definition, fields in ARCHIPEL_HEALTH_TABLES:
+            for partition in self.get_partitions(table):
+                if partition.rsplit("_", 1)[1] < oldest_partition_day:
+                    self.database_thread_cursor.execute("drop table %s" % partition)
+                    self.partitions.discard(partition)
+                    log.debug("Old stored stats of partition %s have been dropped from database." % partition)
+
+        rollup_markers = []
+        for rollup in self.rollups:
+            records, marker = rollup.buckets.unsaved()
+            self.database_thread_cursor.executemany("insert into rollup_%d values(%s)" % (rollup.resolution, ", ".join(["?"] * (len(rollup.columns) + 1))),
+                                                    [[int(record["date"])] + [record[column] for column in rollup.columns] for record in records])
+            self.database_thread_cursor.execute("delete from rollup_%d where collection_date < ?" % rollup.resolution, (int(time.time() - rollup.retention),))
+            rollup_markers.append((rollup, marker))
+
+        self.database_thread_connection.commit()
+        for table, marker in markers.items():
+            self.buffers[table].mark_saved(marker)
+        for rollup, marker in rollup_markers:
+            rollup.buckets.mark_saved(marker)
+        log.info("Stats saved in database file.")
 
     def run(self):
         """
@@ -303,37 +829,21 @@ class TNThreadedHealthCollector (Thread):
         """
         self.database_thread_connection = sqlite3.connect(self.database_file)
         self.database_thread_cursor = self.database_thread_connection.cursor()
+        self.database_thread_cursor.execute("pragma synchronous=NORMAL")
         while(1):
             try:
-                self.stats_CPU.append(self.get_cpu_stats())
-                self.stats_memory.append(self.get_memory_stats())
-                self.stats_load.append(self.get_load_stats())
-                self.stats_network.append(self.get_network_stats())
-
-                if len(self.stats_CPU) >= self.max_cached_rows:
-                    middle = (self.max_cached_rows - 1) / 2
-
-                    self.database_thread_cursor.executemany("insert into memory values(:date, :free, :used, :total, :swapped, :shared)", self.stats_memory[0:middle])
-                    self.database_thread_cursor.executemany("insert into cpu values(:date, :id)", self.stats_CPU[0:middle])
-                    self.database_thread_cursor.executemany("insert into load values(:date, :one , :five, :fifteen)", self.stats_load[0:middle])
-                    self.database_thread_cursor.executemany("insert into network values(:date, :records)", self.stats_network[0:middle])
-
-                    log.info("Stats saved in database file.")
-                    nrRow = int(self.database_thread_cursor.execute("select count(*) from cpu").fetchone()[0]);
-                    if  nrRow > self.max_rows_before_purge * 1.5:
-                        self.database_thread_cursor.execute("DELETE FROM cpu WHERE collection_date IN (SELECT collection_date FROM cpu ORDER BY collection_date ASC LIMIT " + str(nrRow - self.max_rows_before_purge) + ")")
-                        self.database_thread_cursor.execute("DELETE FROM memory WHERE collection_date IN (SELECT collection_date FROM memory ORDER BY collection_date ASC LIMIT " + str(nrRow - self.max_rows_before_purge) + ")")
-                        self.database_thread_cursor.execute("DELETE FROM load WHERE collection_date IN (SELECT collection_date FROM load ORDER BY collection_date ASC LIMIT " + str(nrRow - self.max_rows_before_purge) + ")")
-                        self.database_thread_cursor.execute("DELETE FROM network WHERE collection_date IN (SELECT collection_date FROM network ORDER BY collection_date ASC LIMIT " + str(nrRow - self.max_rows_before_purge) + ")")
-                        log.debug("Old stored stats have been purged from database.")
-
-                    del self.stats_CPU[0:middle]
-                    del self.stats_memory[0:middle]
-                    del self.stats_load[0:middle]
-                    del self.stats_network[0:middle]
-                    log.info("Cached stats have been purged from memory.")
-
-                    self.database_thread_connection.commit()
+                cpu = self.get_cpu_stats()
+                memory = self.get_memory_stats()
+                load = self.get_load_stats()
+                network = self.get_network_stats()
+                self.stats_CPU.append(cpu)
+                self.stats_memory.append(memory)
+                self.stats_load.append(load)
+                self.stats_network.append(network)
+                self.update_rollups(cpu, memory, load, network)
+
+                if self.stats_CPU.total - self.stats_CPU.saved >= max(1, (self.max_cached_rows - 1) / 2):
+                    self.save_stats()
 
                 time.sleep(self.collection_interval)
             except Exception as ex:
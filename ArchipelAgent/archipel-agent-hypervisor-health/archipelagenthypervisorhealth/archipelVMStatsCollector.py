@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+#
+# archipelVMStatsCollector.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import deque
+from threading import Lock
+
+
+# resolutions of the history, in seconds. 0 is the raw collection
+ARCHIPEL_VM_HISTORY_RESOLUTION_RAW      = 0
+ARCHIPEL_VM_HISTORY_RESOLUTION_MINUTE   = 60
+ARCHIPEL_VM_HISTORY_RESOLUTION_HOUR     = 3600
+ARCHIPEL_VM_HISTORY_RESOLUTIONS         = (ARCHIPEL_VM_HISTORY_RESOLUTION_RAW, ARCHIPEL_VM_HISTORY_RESOLUTION_MINUTE, ARCHIPEL_VM_HISTORY_RESOLUTION_HOUR)
+
+# the values of a sample. cpu is in percent of the VM vCPUs, memory in KiB,
+# disk and network in bytes per second
+ARCHIPEL_VM_HISTORY_FIELDS              = ("cpu", "memory", "diskread", "diskwrite", "netrx", "nettx")
+
+
+class TNVMStatsHistory (object):
+    """
+    The history of one virtual machine. Samples are kept as collected, and
+    averaged by minute and by hour, each resolution with its own retention.
+    """
+
+    def __init__(self, collection_interval, retentions):
+        """
+        Initialize the history.
+        @type collection_interval: integer
+        @param collection_interval: the interval between two samples
+        @type retentions: dict
+        @param retentions: the number of seconds to keep, indexed by resolution
+        """
+        self.lock       = Lock()
+        self.tiers      = {}
+        self.buckets    = {}
+        for resolution in ARCHIPEL_VM_HISTORY_RESOLUTIONS:
+            step = resolution or collection_interval
+            self.tiers[resolution] = deque(maxlen=max(1, retentions[resolution] / step))
+            self.buckets[resolution] = None
+
+    def add(self, timestamp, values):
+        """
+        Add a sample.
+        @type timestamp: float
+        @param timestamp: the time of the sample
+        @type values: tuple
+        @param values: the values, in the order of ARCHIPEL_VM_HISTORY_FIELDS
+        """
+        with self.lock:
+            self.tiers[ARCHIPEL_VM_HISTORY_RESOLUTION_RAW].append((timestamp,) + tuple(values))
+            for resolution in ARCHIPEL_VM_HISTORY_RESOLUTIONS[1:]:
+                self.aggregate(resolution, timestamp, values)
+
+    def aggregate(self, resolution, timestamp, values):
+        """
+        Add the sample to the current bucket of the resolution. When the
+        sample belongs to a new bucket, the average of the previous one
+        is stored.
+        @type resolution: integer
+        @param resolution: the resolution
+        @type timestamp: float
+        @param timestamp: the time of the sample
+        @type values: tuple
+        @param values: the values
+        """
+        start = int(timestamp) - int(timestamp) % resolution
+        bucket = self.buckets[resolution]
+        if bucket and not bucket[0] == start:
+            self.tiers[resolution].append((bucket[0],) + tuple([total / bucket[1] for total in bucket[2]]))
+            bucket = None
+        if not bucket:
+            bucket = [start, 0, [0.0] * len(values)]
+            self.buckets[resolution] = bucket
+        bucket[1] += 1
+        for i in range(len(values)):
+            bucket[2][i] += values[i]
+
+    def get(self, resolution, limit):
+        """
+        Return the last samples of the given resolution, the oldest first.
+        @type resolution: integer
+        @param resolution: the resolution
+        @type limit: integer
+        @param limit: the max number of samples
+        @rtype: list
+        @return: list of tuple (timestamp, values...)
+        """
+        with self.lock:
+            rows = list(self.tiers[resolution])
+        return rows[-limit:]
+
+
+class TNVMStatsCollector (object):
+    """
+    This class keeps the performance history of all the virtual machines of
+    the hypervisor: cpu, memory, block I/O and interface I/O. The counters
+    are collected by the L{TNCPUTimeSampler} of the hypervisor, so libvirt
+    is polled only once for the cputime and for the history.
+    """
+
+    def __init__(self, hypervisor, collection_interval, retentions):
+        """
+        The contructor of the class.
+        @type hypervisor: L{TNArchipelHypervisor}
+        @param hypervisor: the hypervisor
+        @type collection_interval: integer
+        @param collection_interval: the intervale between two collection
+        @type retentions: dict
+        @param retentions: the number of seconds to keep, indexed by resolution
+        """
+        self.hypervisor             = hypervisor
+        self.collection_interval    = collection_interval
+        self.retentions             = retentions
+        self.histories              = {}
+        self.counters               = {}
+
+    def start(self):
+        """
+        Start receiving the counters from the sampler of the hypervisor.
+        Does nothing if already started.
+        """
+        self.hypervisor.cpu_sampler.register_listener(self.collect, self.collection_interval)
+
+    def stop(self):
+        """
+        Stop receiving the counters.
+        """
+        self.hypervisor.cpu_sampler.unregister_listener(self.collect)
+
+    def collect(self, now, counters):
+        """
+        Add a sample to the history of each virtual machine.
+        @type now: float
+        @param now: the time of the counters
+        @type counters: dict
+        @param counters: tuple (cputime, vcpus, memory, read bytes, written bytes, received bytes, sent bytes), indexed by UUID
+        """
+        for uuid, current in counters.items():
+            previous = self.counters.get(uuid)
+            self.counters[uuid] = (now, current)
+            if not previous:
+                continue
+            elapsed = now - previous[0]
+            if elapsed <= 0:
+                continue
+            cputime, vcpus, memory, read_bytes, written_bytes, received_bytes, sent_bytes = current
+            old = previous[1]
+            values = (max(0.0, 100.0 * (cputime - old[0]) / (elapsed * vcpus * 1000000000)),
+                      memory,
+                      max(0.0, (read_bytes - old[3]) / elapsed),
+                      max(0.0, (written_bytes - old[4]) / elapsed),
+                      max(0.0, (received_bytes - old[5]) / elapsed),
+                      max(0.0, (sent_bytes - old[6]) / elapsed))
+            if not uuid in self.histories:
+                self.histories[uuid] = TNVMStatsHistory(self.collection_interval, self.retentions)
+            self.histories[uuid].add(now, values)
+
+        for uuid in self.counters.keys():
+            if not uuid in counters:
+                del self.counters[uuid]
+        for uuid in self.histories.keys():
+            if not uuid in self.hypervisor.virtualmachines:
+                del self.histories[uuid]
+
+    def get_history(self, uuids=None, resolution=ARCHIPEL_VM_HISTORY_RESOLUTION_RAW, limit=1):
+        """
+        Return the history of several virtual machines.
+        @type uuids: list
+        @param uuids: the UUIDs of the virtual machines. If None, all of them
+        @type resolution: integer
+        @param resolution: one of ARCHIPEL_VM_HISTORY_RESOLUTIONS
+        @type limit: integer
+        @param limit: the max number of samples per virtual machine
+        @rtype: dict
+        @return: list of dict, the oldest sample first, indexed by UUID
+        """
+        if not resolution in ARCHIPEL_VM_HISTORY_RESOLUTIONS:
+            raise Exception("Unsupported resolution %s. Use one of %s" % (resolution, str(ARCHIPEL_VM_HISTORY_RESOLUTIONS)))
+        if uuids is None:
+            uuids = self.histories.keys()
+        ret = {}
+        for uuid in uuids:
+            history = self.histories.get(uuid)
+            ret[uuid] = []
+            if not history:
+                continue
+            for row in history.get(resolution, limit):
+                sample = dict(zip(ARCHIPEL_VM_HISTORY_FIELDS, row[1:]))
+                sample["date"] = row[0]
+                ret[uuid].append(sample)
+        return ret
@@ -21,12 +21,15 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import commands
+import datetime
 import libvirt
-import json
+import time
 
 from archipelcore.archipelPlugin import TNArchipelPlugin
 from archipelcore.utils import build_error_iq, build_error_message
 from archipelStatsCollector import TNThreadedHealthCollector
+from archipelVMStatsCollector import TNVMStatsCollector, ARCHIPEL_VM_HISTORY_FIELDS, ARCHIPEL_VM_HISTORY_RESOLUTION_RAW,\
+                                     ARCHIPEL_VM_HISTORY_RESOLUTION_MINUTE, ARCHIPEL_VM_HISTORY_RESOLUTION_HOUR
 from archipelcore import xmpp
 
 
@@ -34,6 +37,7 @@ ARCHIPEL_NS_HYPERVISOR_HEALTH       = "archipel:hypervisor:health"
 ARCHIPEL_ERROR_CODE_HEALTH_HISTORY  = -8001
 ARCHIPEL_ERROR_CODE_HEALTH_INFO     = -8002
 ARCHIPEL_ERROR_CODE_HEALTH_LOG      = -8003
+ARCHIPEL_ERROR_CODE_HEALTH_VMHISTORY = -8004
 
 
 class TNHypervisorHealth (TNArchipelPlugin):
@@ -57,10 +61,21 @@ class TNHypervisorHealth (TNArchipelPlugin):
         self.collector = TNThreadedHealthCollector(db_file,collection_interval, max_rows_before_purge, max_cached_rows)
         self.logfile = log_file
 
+        self.vm_collector = None
+        if not self.configuration.has_option("HEALTH", "vm_history_enabled") or self.configuration.getboolean("HEALTH", "vm_history_enabled"):
+            retentions = {ARCHIPEL_VM_HISTORY_RESOLUTION_RAW: 3600, ARCHIPEL_VM_HISTORY_RESOLUTION_MINUTE: 86400, ARCHIPEL_VM_HISTORY_RESOLUTION_HOUR: 2592000}
+            for resolution, token in ((ARCHIPEL_VM_HISTORY_RESOLUTION_RAW, "vm_history_raw_retention"),
+                                      (ARCHIPEL_VM_HISTORY_RESOLUTION_MINUTE, "vm_history_minute_retention"),
+                                      (ARCHIPEL_VM_HISTORY_RESOLUTION_HOUR, "vm_history_hour_retention")):
+                if self.configuration.has_option("HEALTH", token):
+                    retentions[resolution] = self.configuration.getint("HEALTH", token)
+            self.vm_collector = TNVMStatsCollector(self.entity, collection_interval, retentions)
+
         # permissions
         self.entity.permission_center.create_permission("health_history", "Authorizes user to get the health history", False)
         self.entity.permission_center.create_permission("health_info", "Authorizes user to get entity information", False)
         self.entity.permission_center.create_permission("health_logs", "Authorizes user to get entity logs", False)
+        self.entity.permission_center.create_permission("health_vmhistory", "Authorizes user to get the performance history of the virtual machines", False)
         registrar_items = [
                             {   "commands" : ["health"],
                                 "parameters": [{"name": "limit", "description": "Max number of returned entries. Equals 1 if ommited"}],
@@ -124,6 +139,53 @@ class TNHypervisorHealth (TNArchipelPlugin):
         info["vmx"] = self.entity.has_vmx
         return info
 
+    def format_stat(self, record):
+        """
+        Prepare a stat record of the collector to be used as node attributes.
+        @type record: dict
+        @param record: the record, with a timestamp as date
+        @rtype: dict
+        @return: the attributes, with a formatted date
+        """
+        attrs = dict(record)
+        attrs["date"] = datetime.datetime.fromtimestamp(record["date"])
+        return attrs
+
+    def format_rollup(self, values):
+        """
+        Prepare rollup values of the collector to be used as node attributes.
+        The average is named as the field, min and max are suffixed.
+        @type values: dict
+        @param values: the values, as free_min, free_avg, free_max...
+        @rtype: dict
+        @return: the attributes
+        """
+        attrs = {}
+        for column, value in values.items():
+            field, function = column.rsplit("_", 1)
+            if function == "avg":
+                attrs[field] = "%.2f" % value
+            else:
+                attrs[column] = "%.2f" % value
+        return attrs
+
+    def build_cpu_node(self, cpu_stats):
+        """
+        Build the cpu node of a stat, with a core node per CPU core.
+        @type cpu_stats: dict
+        @param cpu_stats: the cpu stats, as returned by the collector
+        @rtype: xmpp.Node
+        @return: the cpu node
+        """
+        attrs = self.format_stat(cpu_stats)
+        del attrs["cores"]
+        cpu_node = xmpp.Node("cpu", attrs=attrs)
+        for index, core in enumerate(cpu_stats.get("cores", [])):
+            core_attrs = {"index": index}
+            core_attrs.update(core)
+            cpu_node.addChild("core", attrs=core_attrs)
+        return cpu_node
+
 
     ### HOOK
 
@@ -139,6 +201,8 @@ class TNHypervisorHealth (TNArchipelPlugin):
         """
         if not self.collector.is_alive():
             self.collector.start()
+        if self.vm_collector:
+            self.vm_collector.start()
 
 
     ### XMPP Processing
@@ -150,6 +214,7 @@ class TNHypervisorHealth (TNArchipelPlugin):
             - history
             - info
             - logs
+            - vmhistory
         @type conn: xmpp.Dispatcher
         @param conn: ths instance of the current connection that send the stanza
         @type iq: xmpp.Protocol.Iq
@@ -164,6 +229,8 @@ class TNHypervisorHealth (TNArchipelPlugin):
             reply = self.iq_health_info(iq)
         elif action == "logs":
             reply = self.iq_get_logs(iq)
+        elif action == "vmhistory":
+            reply = self.iq_vm_history(iq)
         if reply:
             conn.send(reply)
             raise xmpp.protocol.NodeProcessed
@@ -171,28 +238,32 @@ class TNHypervisorHealth (TNArchipelPlugin):
     def iq_health_info_history(self, iq):
         """
         Get a range of old stat history according to the limit parameters in iq node.
+        If the archipel node has a start, end or resolution attribute, the stats
+        of the time range are sent instead, see L{iq_health_info_history_range}.
         @type iq: xmpp.Protocol.Iq
         @param iq: the sender request IQ
         @rtype: xmpp.Protocol.Iq
         @return: a ready-to-send IQ containing the results
         """
+        archipel_tag = iq.getTag("query").getTag("archipel")
+        if archipel_tag.getAttr("start") or archipel_tag.getAttr("end") or archipel_tag.getAttr("resolution"):
+            return self.iq_health_info_history_range(iq)
         try:
             reply = iq.buildReply("result")
             self.entity.log.debug("Converting stats into XML node.")
-            limit = int(iq.getTag("query").getTag("archipel").getAttr("limit"))
+            limit = int(archipel_tag.getAttr("limit"))
             nodes = []
             stats = self.collector.get_collected_stats(limit)
             number_of_rows = limit
-            if number_of_rows > len(stats["memory"]):
-                number_of_rows = len(stats["memory"])
+            number_of_rows = min(number_of_rows, len(stats["memory"]), len(stats["cpu"]), len(stats["load"]), len(stats["network"]))
             for i in range(number_of_rows):
                 statNode = xmpp.Node("stat")
-                statNode.addChild("memory", attrs=stats["memory"][i])
-                statNode.addChild("cpu", attrs=stats["cpu"][i])
+                statNode.addChild("memory", attrs=self.format_stat(stats["memory"][i]))
+                statNode.addChild(node=self.build_cpu_node(stats["cpu"][i]))
                 statNode.addChild("disk")
-                statNode.addChild("load", attrs=stats["load"][i])
+                statNode.addChild("load", attrs=self.format_stat(stats["load"][i]))
                 network_node = statNode.addChild("networks")
-                for nic, delta in json.loads(stats["network"][i]["records"]).items():
+                for nic, delta in stats["network"][i]["records"].items():
                     network_node.addChild("network", attrs={"name": nic, "delta": delta})
                 nodes.append(statNode)
             reply.setQueryPayload(nodes)
@@ -200,6 +271,78 @@ class TNHypervisorHealth (TNArchipelPlugin):
             reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_HEALTH_HISTORY)
         return reply
 
+    def iq_health_info_history_range(self, iq):
+        """
+        Get the stats of a time range. start and end are timestamps (end defaults
+        to now, start to one hour before end). resolution can be 0 for raw stats,
+        or 60, 900 or 3600 for min/avg/max by bucket. If not set, the finest
+        resolution fitting the range in a bounded number of samples is used.
+        @type iq: xmpp.Protocol.Iq
+        @param iq: the sender request IQ
+        @rtype: xmpp.Protocol.Iq
+        @return: a ready-to-send IQ containing the results
+        """
+        try:
+            reply = iq.buildReply("result")
+            archipel_tag = iq.getTag("query").getTag("archipel")
+            end = float(archipel_tag.getAttr("end") or time.time())
+            start = float(archipel_tag.getAttr("start") or end - 3600)
+            resolution = archipel_tag.getAttr("resolution")
+            if resolution is not None:
+                resolution = int(resolution)
+            resolution, samples = self.collector.get_history(start, end, resolution)
+            nodes = []
+            for sample in samples:
+                statNode = xmpp.Node("stat", attrs={"date": datetime.datetime.fromtimestamp(sample["date"]), "timestamp": int(sample["date"]), "resolution": resolution})
+                if resolution == 0:
+                    statNode.addChild("memory", attrs=self.format_stat(sample["memory"]))
+                    statNode.addChild(node=self.build_cpu_node(sample["cpu"]))
+                    statNode.addChild("load", attrs=self.format_stat(sample["load"]))
+                    network_node = statNode.addChild("networks")
+                    for nic, delta in sample["network"]["records"].items():
+                        network_node.addChild("network", attrs={"name": nic, "delta": delta})
+                else:
+                    for stat, tag in (("memory", "memory"), ("cpu", "cpu"), ("load", "load"), ("network", "networks")):
+                        statNode.addChild(tag, attrs=self.format_rollup(sample[stat]))
+                nodes.append(statNode)
+            reply.setQueryPayload(nodes)
+        except Exception as ex:
+            reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_HEALTH_HISTORY)
+        return reply
+
+    def iq_vm_history(self, iq):
+        """
+        Get the performance history of one or several virtual machines.
+        The archipel node can contain vm nodes with an uuid attribute. If there
+        is none, the history of all the virtual machines is sent. The resolution
+        attribute can be 0 (raw samples), 60 or 3600 (averages by minute or by hour).
+        @type iq: xmpp.Protocol.Iq
+        @param iq: the sender request IQ
+        @rtype: xmpp.Protocol.Iq
+        @return: a ready-to-send IQ containing the results
+        """
+        try:
+            reply = iq.buildReply("result")
+            if not self.vm_collector:
+                raise Exception("Virtual machine history is disabled on this hypervisor.")
+            archipel_tag = iq.getTag("query").getTag("archipel")
+            limit = int(archipel_tag.getAttr("limit") or 1)
+            resolution = int(archipel_tag.getAttr("resolution") or ARCHIPEL_VM_HISTORY_RESOLUTION_RAW)
+            uuids = [vm_tag.getAttr("uuid").lower() for vm_tag in archipel_tag.getTags("vm")] or None
+            nodes = []
+            for uuid, samples in self.vm_collector.get_history(uuids, resolution, limit).items():
+                vm_node = xmpp.Node("vm", attrs={"uuid": uuid, "resolution": resolution})
+                for sample in samples:
+                    attrs = {"date": int(sample["date"])}
+                    for field in ARCHIPEL_VM_HISTORY_FIELDS:
+                        attrs[field] = "%.2f" % sample[field]
+                    vm_node.addChild("stat", attrs=attrs)
+                nodes.append(vm_node)
+            reply.setQueryPayload(nodes)
+        except Exception as ex:
+            reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_HEALTH_VMHISTORY)
+        return reply
+
     def iq_health_info(self, iq):
         """
         Send information about the hypervisor health info.
@@ -216,13 +359,12 @@ class TNHypervisorHealth (TNArchipelPlugin):
                 reply = build_error_iq(self, "Unable to get stats. See hypervisor log.", iq)
             else:
                 try:
-                    mem_free_node = xmpp.Node("memory", attrs=stats["memory"][0])
+                    mem_free_node = xmpp.Node("memory", attrs=self.format_stat(stats["memory"][0]))
                     nodes.append(mem_free_node)
                 except Exception as ex:
                     raise Exception("Unable to append memory stats node.", ex)
                 try:
-                    cpu_node = xmpp.Node("cpu", attrs=stats["cpu"][0])
-                    nodes.append(cpu_node)
+                    nodes.append(self.build_cpu_node(stats["cpu"][0]))
                 except Exception as ex:
                     raise Exception("Unable to append cpu stats node.", ex)
                 try:
@@ -234,13 +376,13 @@ class TNHypervisorHealth (TNArchipelPlugin):
                     raise Exception("Unable to append disk stats node.", ex)
                 try:
                     network_node = xmpp.Node("networks")
-                    for nic, delta in json.loads(stats["network"][0]["records"]).items():
+                    for nic, delta in stats["network"][0]["records"].items():
                         network_node.addChild("network", attrs={"name": nic, "delta": delta})
                     nodes.append(network_node)
                 except Exception as ex:
                     raise Exception("Unable to append network stats node.", ex)
                 try:
-                    load_node = xmpp.Node("load", attrs=stats["load"][0])
+                    load_node = xmpp.Node("load", attrs=self.format_stat(stats["load"][0]))
                     nodes.append(load_node)
                 except Exception as ex:
                     raise Exception("Unable to append load avergae stats node.", ex)
@@ -269,6 +411,8 @@ class TNHypervisorHealth (TNArchipelPlugin):
                     nodes.append(basic_info)
                 except Exception as ex:
                     raise Exception("Unable to append basic_info node.", ex)
+                if self.entity.vm_startup_stats:
+                    nodes.append(xmpp.Node("startup", attrs=self.entity.vm_startup_stats))
                 reply.setQueryPayload(nodes)
         except Exception as ex:
             reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_HEALTH_INFO)
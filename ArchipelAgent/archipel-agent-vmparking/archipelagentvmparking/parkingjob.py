@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+#
+# parkingjob.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains L{TNParkingJob}, that parks or unparks a batch of virtual machines
+with a bounded number of worker threads.
+"""
+
+import Queue
+from threading import Lock, Thread
+
+
+# default max number of virtual machines processed at the same time
+ARCHIPEL_PARKING_WORKERS            = 8
+
+# number of progress reports sent during a job
+ARCHIPEL_PARKING_PROGRESS_REPORTS   = 10
+
+
+class TNParkingJob (object):
+    """
+    This class runs a task on each item of a batch. The items are shared by
+    at most max_workers threads. The progress is reported a few times during
+    the job, and the results are given to a callback once all the items
+    have been processed.
+    """
+
+    def __init__(self, name, items, task, max_workers=ARCHIPEL_PARKING_WORKERS, progress_callback=None, done_callback=None, log=None):
+        """
+        Initialize the job.
+        @type name: string
+        @param name: the name of the job, used in the logs
+        @type items: list
+        @param items: the items to process
+        @type task: function
+        @param task: called with each item. Its return value is the result of the item
+        @type max_workers: int
+        @param max_workers: the max number of threads
+        @type progress_callback: function
+        @param progress_callback: called with the number of processed items, the number of failed items and the total
+        @type done_callback: function
+        @param done_callback: called with the list of (item, result) that succeeded, and the list of (item, exception) that failed
+        @type log: TNArchipelLogger
+        @param log: the logger
+        """
+        self.name               = name
+        self.items              = items
+        self.task               = task
+        self.max_workers        = max(1, max_workers)
+        self.progress_callback  = progress_callback
+        self.done_callback      = done_callback
+        self.log                = log
+        self.queue              = Queue.Queue()
+        self.lock               = Lock()
+        self.succeeded          = []
+        self.failed             = []
+        self.report_step        = max(1, len(items) / ARCHIPEL_PARKING_PROGRESS_REPORTS)
+
+    def start(self):
+        """
+        Start the workers.
+        """
+        if not self.items:
+            self.finish()
+            return
+        for item in self.items:
+            self.queue.put(item)
+        for i in range(min(self.max_workers, len(self.items))):
+            worker = Thread(target=self.work, name="%s-%d" % (self.name, i))
+            worker.setDaemon(True)
+            worker.start()
+
+    def work(self):
+        """
+        Process items until the queue is empty.
+        """
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                self.processed(item, True, self.task(item))
+            except Exception as ex:
+                if self.log:
+                    self.log.error("VMPARKING: %s failed for %s: %s" % (self.name, item, str(ex)))
+                self.processed(item, False, ex)
+
+    def processed(self, item, success, result):
+        """
+        Record the result of an item, and report the progress.
+        @type item: object
+        @param item: the item
+        @type success: Boolean
+        @param success: True if the task succeeded
+        @type result: object
+        @param result: the result of the task, or the exception it raised
+        """
+        with self.lock:
+            if success:
+                self.succeeded.append((item, result))
+            else:
+                self.failed.append((item, result))
+            done = len(self.succeeded) + len(self.failed)
+            failed = len(self.failed)
+        if done == len(self.items):
+            self.finish()
+        elif self.progress_callback and done % self.report_step == 0:
+            self.progress_callback(done, failed, len(self.items))
+
+    def finish(self):
+        """
+        Report the end of the job.
+        """
+        if self.log:
+            self.log.info("VMPARKING: %s done, %d succeeded, %d failed" % (self.name, len(self.succeeded), len(self.failed)))
+        if self.progress_callback:
+            self.progress_callback(len(self.items), len(self.failed), len(self.items))
+        if self.done_callback:
+            self.done_callback(self.succeeded, self.failed)
@@ -25,6 +25,7 @@ import random
 import shutil
 import sqlite3
 import string
+from threading import Event
 
 from archipel.archipelHypervisor import TNArchipelHypervisor
 from archipel.archipelVirtualMachine import TNArchipelVirtualMachine
@@ -33,6 +34,8 @@ from archipelcore import xmpp
 
 from archipelcore.utils import build_error_iq, build_error_message
 
+from parkingjob import TNParkingJob, ARCHIPEL_PARKING_WORKERS
+
 ARCHIPEL_ERROR_CODE_VMPARK_LIST = -11001
 ARCHIPEL_ERROR_CODE_VMPARK_PARK = -11002
 ARCHIPEL_ERROR_CODE_VMPARK_UNPARK = -11003
@@ -43,6 +46,9 @@ ARCHIPEL_ERROR_CODE_VMPARK_CREATE_PARKED = -11005
 ARCHIPEL_NS_HYPERVISOR_VMPARKING = "archipel:hypervisor:vmparking"
 ARCHIPEL_NS_VM_VMPARKING = "archipel:vm:vmparking"
 
+# number of seconds an unparking worker waits for its vm to authenticate
+ARCHIPEL_PARKING_STARTUP_TIMEOUT = 60
+
 class TNVMParking (TNArchipelPlugin):
 
     def __init__(self, configuration, entity, entry_point_group):
@@ -57,6 +63,13 @@ class TNVMParking (TNArchipelPlugin):
         """
         TNArchipelPlugin.__init__(self, configuration=configuration, entity=entity, entry_point_group=entry_point_group)
 
+        self.max_workers = ARCHIPEL_PARKING_WORKERS
+        if self.configuration.has_option("VMPARKING", "workers"):
+            self.max_workers = self.configuration.getint("VMPARKING", "workers")
+        self.startup_timeout = ARCHIPEL_PARKING_STARTUP_TIMEOUT
+        if self.configuration.has_option("VMPARKING", "startup_timeout"):
+            self.startup_timeout = self.configuration.getint("VMPARKING", "startup_timeout")
+
         # creates permissions
         self.entity.permission_center.create_permission("vmparking_park", "Authorizes user to park a virtual machines", False)
 
@@ -128,32 +141,6 @@ class TNVMParking (TNArchipelPlugin):
         """
         self.entity.get_plugin("centraldb").register_vms(vm_informations)
 
-    def is_vm_registered(self, uuid):
-        """
-        Check if vm with given UUID is already in DB
-        @type uuid: String
-        @param uuid: the UUID of the vm
-        @rtype: Boolean
-        @return: True is vm is already in park
-        """
-        rows = self.entity.get_plugin("centraldb").read_vms("uuid", "uuid='%s'" % uuid)
-        if len(rows) > 1:
-            return True
-        return False
-
-    def is_vm_parked(self, uuid):
-        """
-        Check if vm with given UUID is already parked
-        @type uuid: String
-        @param uuid: the UUID of the vm
-        @rtype: Boolean
-        @return: True is vm is already in park
-        """
-        rows = self.entity.get_plugin("centraldb").read_vms("uuid", "uuid='%s' and (hypervisor='None' or hypervisor not in (select jid from hypervisors where status='Online'))" % uuid)
-        if len(rows) > 1:
-            return True
-        return False
-
     def get_parked_vms(self, vms, callback):
         """
         Get a list of parked vms from central db based on a list of uuids.
@@ -162,38 +149,8 @@ class TNVMParking (TNArchipelPlugin):
         @rtype: dict
         @return: dict like {"uuid": x, "parker": y, "date": z, "hypervisor": s, "domain": d}
         """
-        uuid_strings = []
-        for vm in vms:
-            uuid_strings.append(vm["uuid"])
-        where_statement = "uuid='" + "' or uuid='".join(uuid_strings) + "' and (hypervisor='None' or hypervisor not in (select jid from hypervisors where status='Online'))"
-        rows = self.entity.get_plugin("centraldb").read_vms("*", where_statement, callback)
-
-    def get_vm_by_uuid_from_db(self, uuid):
-        """
-        Get a VM from the parking
-        @type uuid: String
-        @param uuid: The UUID of the VM
-        @rtype: dict
-        @return: dict like {"uuid": x, "parker": y, "date": z, "hypervisor": s, "domain": d}
-        """
-        rows = self.entity.get_plugin("centraldb").read_vms("*", "uuid='%s'" % uuid)
-        row = rows[0]
-        return {"uuid": row[0], "parker": row[1], "date": row[2], "hypervisor": row[4], "domain": xmpp.simplexml.NodeBuilder(data=row[3]).getDom()}
-
-    def get_all_vms_from_db(self):
-        """
-        Return all vms in parkings
-        @rtype: list
-        @return: list containing dict like {"uuid": x, "parker": y, "date": z, "hypervisor": s, "domain": d}
-        """
-        rows = self.entity.get_plugin("centraldb").read_vms("*", "hypervisor='None' or hypervisor not in (select jid from hypervisors where status='Online')", )
-        ret = []
-        for row in rows:
-            domain=None
-            if row[3]!="None":
-                domain=xmpp.simplexml.NodeBuilder(data=row[3]).getDom()
-            ret.append({"uuid": row[0], "parker": row[1], "date": row[2], "hypervisor": row[4], "domain": domain})
-        return ret
+        uuids = [vm["uuid"] for vm in vms]
+        self.entity.get_plugin("centraldb").read_vms("*", callback, uuids=uuids, parked=True)
 
     def update_vm_domain_in_db(self, uuid, new_domain):
         """
@@ -235,112 +192,190 @@ class TNVMParking (TNArchipelPlugin):
 
     def list(self, iq, conn):
         """
-        List virtual machines in the park.
+        List virtual machines in the park, sorted by name. The archipel node
+        of the IQ can have the attributes limit and offset to get a page of
+        the list, and domain="false" to only get the metadata of the vms.
+        When there are more vms after the page, the query of the reply has
+        more="true".
         """
+        request = iq.getTag("query").getTag("archipel")
+        limit = request.getAttr("limit") and int(request.getAttr("limit"))
+        offset = int(request.getAttr("offset") or 0)
+        with_domain = not request.getAttr("domain") == "false"
+
         def _on_centralagent_reply(vms):
             try:
                 self.entity.log.debug("VMPARKING: We got %s entry from central db" % len(vms))
                 reply = iq.buildReply("result")
-                parked_vms = []
-                for vm in vms:
-                    try:
-                        parked_vms.append({"info": {"uuid": vm["uuid"], "parker": vm["parker"], "date": vm["creation_date"]}, "domain": xmpp.simplexml.NodeBuilder(vm["domain"]).getDom()})
-                    except:
-                        self.entity.log.warning("VMPARKING: Error parsing entry %s" % vm)
-
-                def sorting(a, b):
-                    a_name=""
-                    b_name=""
-                    if a["domain"]:
-                        a_name=a["domain"].getTag("name").getData()
-                    if b["domain"]:
-                        b_name=b["domain"].getTag("name").getData()
-                    return cmp(a_name, b_name)
-
-                parked_vms.sort(sorting)
+                more = limit is not None and len(vms) > limit
                 nodes = []
-                for parked_vm in parked_vms:
-                    vm_node = xmpp.Node("virtualmachine", attrs=parked_vm["info"])
-                    if parked_vm["domain"] and parked_vm["domain"].getTag('description'):
-                        parked_vm["domain"].delChild("description")
-                    vm_node.addChild(node=parked_vm["domain"])
+                for vm in vms[:limit]:
+                    vm_node = xmpp.Node("virtualmachine", attrs={"uuid": vm["uuid"], "name": vm["name"], "parker": vm["parker"], "date": vm["creation_date"]})
+                    if with_domain:
+                        try:
+                            domain = xmpp.simplexml.NodeBuilder(vm["domain"]).getDom()
+                        except:
+                            self.entity.log.warning("VMPARKING: Error parsing entry %s" % vm)
+                            continue
+                        if domain.getTag("description"):
+                            domain.delChild("description")
+                        vm_node.addChild(node=domain)
                     nodes.append(vm_node)
                 reply.setQueryPayload(nodes)
+                if more:
+                    reply.getTag("query").setAttr("more", "true")
             except Exception as ex:
                 reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_VMPARK_LIST)
             self.entity.xmppclient.send(reply)
             raise xmpp.protocol.NodeProcessed
 
-        self.entity.get_plugin("centraldb").read_vms("*", "hypervisor='None' or hypervisor not in (select jid from hypervisors where status='Online')", _on_centralagent_reply)
-
+        columns = "uuid,name,parker,creation_date"
+        if with_domain:
+            columns += ",domain"
+        # one more row tells if there is a next page
+        self.entity.get_plugin("centraldb").read_vms(columns, _on_centralagent_reply, parked=True, order="name",
+                                                     limit=limit is not None and limit + 1 or None, offset=offset)
+
+
+    def run_job(self, name, items, task, done_callback):
+        """
+        Run a task on a batch of virtual machines with at most max_workers
+        threads, and push the progress of the job.
+        @type name: string
+        @param name: the name of the job ("park" or "unpark")
+        @type items: list
+        @param items: the virtual machines to process
+        @type task: function
+        @param task: called with each item
+        @type done_callback: function
+        @param done_callback: called with the list of (item, result) that succeeded, and the list of (item, exception) that failed
+        """
+        def _on_progress(done, failed, total):
+            progress = xmpp.Node("progress", attrs={"action": name, "done": done, "failed": failed, "total": total})
+            self.entity.push_change("vmparking", "progress", progress)
+
+        TNParkingJob(name, items, task, max_workers=self.max_workers, progress_callback=_on_progress,
+                     done_callback=done_callback, log=self.entity.log).start()
+
+    def job_report(self, succeeded, failed):
+        """
+        Build the content of the push sent at the end of a parking job.
+        @type succeeded: list
+        @param succeeded: the list of (item, result) that succeeded
+        @type failed: list
+        @param failed: the list of (item, exception) that failed
+        @rtype: list
+        @return: a vm node per item, with its uuid, its status ("done" or "failed") and the error if any
+        """
+        nodes = []
+        for item, result in succeeded:
+            nodes.append(xmpp.Node("vm", attrs={"uuid": item["uuid"], "status": "done"}))
+        for item, ex in failed:
+            nodes.append(xmpp.Node("vm", attrs={"uuid": item["uuid"], "status": "failed", "error": str(ex)}))
+        return nodes
 
     def park(self, vm_informations):
         """
-        Park a virtual machine.
+        Park a virtual machine. The domains are destroyed and the vms freed
+        by a parking job, then all the parked vms are written in the central
+        database at once. The workers only wait for libvirt: soft_free updates
+        the hypervisor under its virtualmachines_lock.
         @type vm_informations: list
         @param vm_informations: list of dict like {"uuid": x, "parker": z)}
         """
         vm_informations_cleaned = []
+        rejected = []
         for vm_info in vm_informations:
 
             vm = self.entity.get_vm_by_uuid(vm_info["uuid"])
             if not vm:
                 self.entity.log.warning("VMPARKING: No virtual machine with UUID %s" % vm_info["uuid"])
+                rejected.append((vm_info, Exception("No virtual machine with UUID %s" % vm_info["uuid"])))
                 continue
             if not vm.domain:
                 self.entity.log.warning("VMPARKING: VM with UUID %s cannot be parked because it is not defined" % vm_info["uuid"])
+                rejected.append((vm_info, Exception("VM with UUID %s cannot be parked because it is not defined" % vm_info["uuid"])))
                 continue
             vm_informations_cleaned.append(vm_info)
 
-        # Now, perform operations
-        new_vm_info = []
-        for vm_info in vm_informations_cleaned:
+        def _park_vm(vm_info):
             vm = self.entity.get_vm_by_uuid(vm_info["uuid"])
             if not vm.info()["state"] == 5:
                 vm.destroy()
             domain = vm.xmldesc(mask_description=False)
             vm_jid = xmpp.JID(domain.getTag("description").getData().split("::::")[0])
             vm_info["hypervisor"]=None
-            new_vm_info.append(vm_info)
             self.entity.soft_free(vm_jid)
-        if len(new_vm_info) > 0:
-            self.set_vms_status(new_vm_info)
-            self.entity.push_change("vmparking", "parked")
+            return vm_info
+
+        def _on_parked(succeeded, failed):
+            if len(succeeded) > 0:
+                self.set_vms_status([vm_info for vm_info, result in succeeded])
+            self.entity.push_change("vmparking", "parked", *self.job_report(succeeded, rejected + failed))
+
+        if len(vm_informations_cleaned) > 0:
+            self.run_job("park", vm_informations_cleaned, _park_vm, _on_parked)
+        else:
+            _on_parked([], [])
 
     def unpark(self, vm_information):
         """
-        Unpark virtual machine
+        Unpark virtual machine. The parked vms are read from the central
+        database at once, then started by a parking job: a worker waits
+        for its vm to be authenticated before taking the next one. The vms
+        are registered by soft_alloc under the virtualmachines_lock of the
+        hypervisor.
         @type vm_information: list
         @param vm_information: list of dict like {"uuid": x, "start": True|False, "parker": z}
         """
+        vm_information_by_uuid  = {}
+        for vm_info in vm_information:
+            vm_information_by_uuid[vm_info["uuid"]] = vm_info
+
+        def _unpark_vm(vm_item):
+            vm_info = vm_information_by_uuid[vm_item["uuid"]]
+            domain = vm_item["domain"]
+            ret = str(domain).replace('xmlns=\"archipel:hypervisor:vmparking\"', '')
+            domain = xmpp.simplexml.NodeBuilder(data=ret).getDom()
+            vmjid = domain.getTag("description").getData().split("::::")[0]
+            vmpass = domain.getTag("description").getData().split("::::")[1]
+            vmname = domain.getTag("name").getData()
+            self.entity.log.debug("VMPARKING: about to create vm thread")
+            vm_thread = self.entity.soft_alloc(xmpp.JID(vmjid), vmname, vmpass, start=False, organization_info=self.entity.vcard_infos)
+            vm = vm_thread.get_instance()
+            # the vm may have been given a new JID by the hypervisor
+            vmjid = vm.jid.getStripped()
+            authenticated = Event()
+            vm.register_hook("HOOK_ARCHIPELENTITY_XMPP_AUTHENTICATED", method=vm.define_hook, user_info=domain, oneshot=True)
+            if vm_info["start"]:
+                vm.register_hook("HOOK_ARCHIPELENTITY_XMPP_AUTHENTICATED", method=vm.control_create_hook, oneshot=True)
+            vm.register_hook("HOOK_ARCHIPELENTITY_XMPP_AUTHENTICATED", method=lambda origin, user_info, arguments: authenticated.set(), oneshot=True)
+            vm_thread.start()
+            if not authenticated.wait(self.startup_timeout):
+                self.entity.log.warning("VMPARKING: %s is not authenticated after %d seconds" % (vmjid, self.startup_timeout))
+            self.entity.log.info("VMPARKING: successfully unparked %s" % str(vmjid))
+            return vmjid
+
+        rejected = []
+
+        def _on_unparked(succeeded, failed):
+            self.entity.push_change("vmparking", "unparked", *self.job_report(succeeded, rejected + failed))
 
         def _unpark_callback(vm_items):
-
-            vm_information_by_uuid  = {}
-
-            for vm_info in vm_information:
-                vm_information_by_uuid[vm_info["uuid"]] = vm_info
-
-            for vm_item in vm_items:
-                vm_info = vm_information_by_uuid[vm_item["uuid"]]
-                domain = vm_item["domain"]
-                ret = str(domain).replace('xmlns=\"archipel:hypervisor:vmparking\"', '')
-                domain = xmpp.simplexml.NodeBuilder(data=ret).getDom()
-                vmjid = domain.getTag("description").getData().split("::::")[0]
-                vmpass = domain.getTag("description").getData().split("::::")[1]
-                vmname = domain.getTag("name").getData()
-                self.entity.log.debug("VMPARKING: about to create vm thread")
-                vm_thread = self.entity.soft_alloc(xmpp.JID(vmjid), vmname, vmpass, start=False, organization_info=self.entity.vcard_infos)
-                vm = vm_thread.get_instance()
-                vm.register_hook("HOOK_ARCHIPELENTITY_XMPP_AUTHENTICATED", method=vm.define_hook, user_info=domain, oneshot=True)
-                if vm_info["start"]:
-                    vm.register_hook("HOOK_ARCHIPELENTITY_XMPP_AUTHENTICATED", method=vm.control_create_hook, oneshot=True)
-                vm_thread.start()
-
-                self.entity.push_change("vmparking", "unparked")
-                self.entity.log.info("VMPARKING: successfully unparked %s" % str(vmjid))
-
-        vm_items = self.get_parked_vms(vm_information, _unpark_callback)
+            parked_uuids = set([vm_item["uuid"] for vm_item in vm_items])
+            for uuid in vm_information_by_uuid:
+                if not uuid in parked_uuids:
+                    self.entity.log.warning("VMPARKING: No parked virtual machine with UUID %s" % uuid)
+                    rejected.append(({"uuid": uuid}, Exception("No parked virtual machine with UUID %s" % uuid)))
+            self.run_job("unpark", vm_items, _unpark_vm, _on_unparked)
+
+        if not self.entity.get_plugin("centraldb").central_agent_jid():
+            self.entity.log.warning("VMPARKING: cannot unpark because no central agent has been detected")
+            for uuid in vm_information_by_uuid:
+                rejected.append(({"uuid": uuid}, Exception("No central agent has been detected")))
+            _on_unparked([], [])
+            return
+        self.get_parked_vms(vm_information, _unpark_callback)
 
     def delete(self, vms_uuids):
         """
@@ -503,7 +538,9 @@ class TNVMParking (TNArchipelPlugin):
 
     def iq_park(self, iq):
         """
-        Park virtual machine
+        Park virtual machine. The result only means that the parking job
+        is started. The parked push sent at the end of the job gives the
+        status of each vm, with the error of the ones that failed.
         @type iq: xmpp.Protocol.Iq
         @param iq: the received IQ
         @rtype: xmpp.Protocol.Iq
@@ -556,7 +593,9 @@ class TNVMParking (TNArchipelPlugin):
 
     def iq_unpark(self, iq):
         """
-        Unpark virtual machine
+        Unpark virtual machine. The result only means that the unparking job
+        is started. The unparked push sent at the end of the job gives the
+        status of each vm, with the error of the ones that failed.
         @type iq: xmpp.Protocol.Iq
         @param iq: the received IQ
         @rtype: xmpp.Protocol.Iq
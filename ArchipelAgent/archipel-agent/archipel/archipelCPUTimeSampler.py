@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+#
+# archipelCPUTimeSampler.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains L{TNCPUTimeSampler}, the thread collecting the cputime of all the
+domains of the hypervisor, and L{TNCPUTimeSamples}, the ring buffer where
+each virtual machine keeps its last samples. The sampler also collects the
+memory, block and interface counters for the listeners that need them, so
+libvirt is polled by a single thread.
+"""
+
+import libvirt
+import time
+from array import array
+from threading import Event, Lock, Thread
+
+
+ARCHIPEL_CPUTIME_SAMPLING_INTERVAL  = 2.0
+ARCHIPEL_CPUTIME_SAMPLES_SIZE       = 4
+
+# stats requested to getAllDomainStats when a listener needs all the counters
+ARCHIPEL_CPUTIME_FULL_STATS         = libvirt.VIR_DOMAIN_STATS_CPU_TOTAL | libvirt.VIR_DOMAIN_STATS_BALLOON | libvirt.VIR_DOMAIN_STATS_VCPU\
+                                      | libvirt.VIR_DOMAIN_STATS_INTERFACE | libvirt.VIR_DOMAIN_STATS_BLOCK
+
+
+class TNCPUTimeSamples (object):
+    """
+    Fixed size ring buffer of (timestamp, cputime) samples.
+    """
+
+    def __init__(self, size=ARCHIPEL_CPUTIME_SAMPLES_SIZE):
+        """
+        Initialize the buffer.
+        @type size: int
+        @param size: the max number of samples
+        """
+        self.size       = size
+        self.timestamps = array("d", [0.0] * size)
+        self.cputimes   = array("d", [0.0] * size)
+        self.count      = 0
+        self.position   = 0
+        self.lock       = Lock()
+
+    def append(self, timestamp, cputime):
+        """
+        Add a sample, overwriting the oldest one if the buffer is full.
+        @type timestamp: float
+        @param timestamp: the time of the sample
+        @type cputime: long
+        @param cputime: the cputime of the domain, in nanoseconds
+        """
+        with self.lock:
+            self.timestamps[self.position] = timestamp
+            self.cputimes[self.position] = cputime
+            self.position = (self.position + 1) % self.size
+            self.count = min(self.count + 1, self.size)
+
+    def clear(self):
+        """
+        Remove all the samples.
+        """
+        with self.lock:
+            self.count = 0
+            self.position = 0
+
+    def last(self, number=2):
+        """
+        Return the last samples, the newest first.
+        @type number: int
+        @param number: the number of samples
+        @rtype: list
+        @return: list of tuple (timestamp, cputime)
+        """
+        with self.lock:
+            samples = []
+            for i in range(1, min(number, self.count) + 1):
+                index = (self.position - i) % self.size
+                samples.append((self.timestamps[index], self.cputimes[index]))
+            return samples
+
+
+class TNCPUTimeSampler (Thread):
+    """
+    This class collects, at regular interval, the cputime of all the
+    virtual machines of an hypervisor in a single batch, and stores them
+    in the cputime_samples of each virtual machine. When a listener is
+    due, the same batch also collects the other counters of the domains,
+    and gives them to the listener.
+    """
+
+    def __init__(self, hypervisor, interval=ARCHIPEL_CPUTIME_SAMPLING_INTERVAL):
+        """
+        Initialize the sampler.
+        @type hypervisor: L{TNArchipelHypervisor}
+        @param hypervisor: the hypervisor
+        @type interval: float
+        @param interval: number of seconds between two samples
+        """
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.hypervisor = hypervisor
+        self.interval   = interval
+        self.stopped    = Event()
+        self.listeners  = []
+        self.lock       = Lock()
+        self.use_domain_stats = hasattr(self.hypervisor.libvirt_connection, "getAllDomainStats")
+
+    def register_listener(self, callback, interval):
+        """
+        Register a method called with all the counters of the virtual
+        machines, at most every interval seconds. The counters are given
+        as a dict indexed by UUID of tuples (cputime, vcpus, memory,
+        read bytes, written bytes, received bytes, sent bytes), with the
+        timestamp of the batch: callback(timestamp, counters).
+        @type callback: function
+        @param callback: the method to call
+        @type interval: float
+        @param interval: number of seconds between two calls. It is rounded up to the sampling interval
+        """
+        with self.lock:
+            if not callback in [listener[0] for listener in self.listeners]:
+                self.listeners.append([callback, interval, time.time()])
+
+    def unregister_listener(self, callback):
+        """
+        Unregister a listener.
+        @type callback: function
+        @param callback: the registered method
+        """
+        with self.lock:
+            self.listeners = [listener for listener in self.listeners if not listener[0] == callback]
+
+    def get_devices(self, vm):
+        """
+        Get the disk and interface targets of a virtual machine.
+        @type vm: L{TNArchipelVirtualMachine}
+        @param vm: the virtual machine
+        @rtype: tuple
+        @return: the list of disk targets and the list of interface targets
+        """
+        disks = []
+        interfaces = []
+        if vm.definition and vm.definition.getTag("devices"):
+            for disk in vm.definition.getTag("devices").getTags("disk"):
+                if disk.getTag("target") and disk.getTag("source"):
+                    disks.append(disk.getTag("target").getAttr("dev"))
+            for interface in vm.definition.getTag("devices").getTags("interface"):
+                if interface.getTag("target"):
+                    interfaces.append(interface.getTag("target").getAttr("dev"))
+        return (disks, interfaces)
+
+    def collect_with_domain_stats(self, full=False):
+        """
+        Get the counters of all the active domains with a single getAllDomainStats call.
+        @type full: Boolean
+        @param full: if True, get all the counters, otherwise only the cputime
+        @rtype: dict
+        @return: tuple of counters, the cputime in nanoseconds first, indexed by UUID
+        """
+        counters = {}
+        stats = self.hypervisor.libvirt_connection.getAllDomainStats(full and ARCHIPEL_CPUTIME_FULL_STATS or libvirt.VIR_DOMAIN_STATS_CPU_TOTAL,
+                                                                      libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE)
+        for dom, record in stats:
+            if not "cpu.time" in record:
+                continue
+            if not full:
+                counters[dom.UUIDString()] = (record["cpu.time"],)
+                continue
+            read_bytes = written_bytes = received_bytes = sent_bytes = 0
+            for i in range(record.get("block.count", 0)):
+                read_bytes += record.get("block.%d.rd.bytes" % i, 0)
+                written_bytes += record.get("block.%d.wr.bytes" % i, 0)
+            for i in range(record.get("net.count", 0)):
+                received_bytes += record.get("net.%d.rx.bytes" % i, 0)
+                sent_bytes += record.get("net.%d.tx.bytes" % i, 0)
+            counters[dom.UUIDString()] = (record["cpu.time"], max(1, record.get("vcpu.current", 1)), record.get("balloon.current", 0),
+                                          read_bytes, written_bytes, received_bytes, sent_bytes)
+        return counters
+
+    def collect_with_domain_info(self, vms, full=False):
+        """
+        Get the counters of the given virtual machines domain by domain,
+        for libvirt versions without getAllDomainStats.
+        @type vms: list
+        @param vms: the L{TNArchipelVirtualMachine} to sample
+        @type full: Boolean
+        @param full: if True, get all the counters, otherwise only the cputime
+        @rtype: dict
+        @return: tuple of counters, the cputime in nanoseconds first, indexed by UUID
+        """
+        counters = {}
+        for vm in vms:
+            try:
+                dominfo = vm.domain.info()
+                if not dominfo[0] in (libvirt.VIR_DOMAIN_RUNNING, libvirt.VIR_DOMAIN_BLOCKED, libvirt.VIR_DOMAIN_PAUSED):
+                    continue
+                if not full:
+                    counters[vm.uuid] = (dominfo[4],)
+                    continue
+                read_bytes = written_bytes = received_bytes = sent_bytes = 0
+                disks, interfaces = self.get_devices(vm)
+                for disk in disks:
+                    stats = vm.domain.blockStats(disk)
+                    read_bytes += stats[1]
+                    written_bytes += stats[3]
+                for interface in interfaces:
+                    stats = vm.domain.interfaceStats(interface)
+                    received_bytes += stats[0]
+                    sent_bytes += stats[4]
+                counters[vm.uuid] = (dominfo[4], max(1, dominfo[3]), dominfo[2], read_bytes, written_bytes, received_bytes, sent_bytes)
+            except libvirt.libvirtError:
+                pass
+        return counters
+
+    def sample(self):
+        """
+        Take one sample for all the virtual machines, and give the
+        counters to the listeners that are due.
+        """
+        now = time.time()
+        with self.lock:
+            due = [listener for listener in self.listeners if listener[2] <= now]
+            for listener in due:
+                listener[2] += listener[1]
+                if listener[2] <= now:
+                    listener[2] = now + listener[1]
+        vms = [vm for vm in self.hypervisor.virtualmachines.values() if vm.domain and not vm.is_freeing and not vm.is_migrating]
+        counters = {}
+        if vms:
+            counters = None
+            if self.use_domain_stats:
+                try:
+                    counters = self.collect_with_domain_stats(full=len(due) > 0)
+                except libvirt.libvirtError as ex:
+                    self.hypervisor.log.warning("CPUSAMPLER: getAllDomainStats is not supported, using virDomainGetInfo: %s" % str(ex))
+                    self.use_domain_stats = False
+            if counters is None:
+                counters = self.collect_with_domain_info(vms, full=len(due) > 0)
+
+        now = time.time()
+        vm_counters = {}
+        for vm in vms:
+            if vm.uuid in counters:
+                vm.cputime_samples.append(now, counters[vm.uuid][0])
+                vm_counters[vm.uuid] = counters[vm.uuid]
+            else:
+                vm.cputime_samples.clear()
+
+        for listener in due:
+            try:
+                listener[0](now, vm_counters)
+            except Exception as ex:
+                self.hypervisor.log.error("CPUSAMPLER: listener %s failed: %s" % (listener[0], str(ex)))
+
+    def run(self):
+        """
+        Sample until stopped.
+        """
+        while not self.stopped.isSet():
+            try:
+                self.sample()
+            except Exception as ex:
+                self.hypervisor.log.error("CPUSAMPLER: unable to sample cputime: %s" % str(ex))
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        """
+        Stop the sampler.
+        """
+        self.stopped.set()
@@ -31,16 +31,21 @@ import libvirt
 import random
 import sqlite3
 import string
+import time
 import uuid as moduuid
-from threading import Thread
+from threading import Event, Lock, RLock, Thread
 
 from archipelcore.archipelAvatarControllableEntity import TNAvatarControllableEntity
 from archipelcore.archipelEntity import TNArchipelEntity
 from archipelcore.archipelHookableEntity import TNHookableEntity
+from archipelcore.archipelPermissionCenter import TNArchipelPermissionStore
 from archipelcore.archipelTaggableEntity import TNTaggableEntity
+from archipelcore.multiplexer import TNXMPPMultiplexer
+from archipelcore.reactor import TNXMPPReactor
 from archipelcore.utils import build_error_iq, build_error_message
 from archipelcore import xmpp
 
+from archipelCPUTimeSampler import TNCPUTimeSampler
 from archipelLibvirtEntity import ARCHIPEL_NS_LIBVIRT_GENERIC_ERROR
 from archipelVirtualMachine import TNArchipelVirtualMachine
 import archipelLibvirtEntity
@@ -74,6 +79,14 @@ ARCHIPEL_XMPP_SHOW_ONLINE                       = "Online"
 # number of seconds before central agent is considered AWOL
 ARCHIPEL_CENTRAL_AGENT_TIMEOUT                  = 5
 
+# startup of the virtual machines
+ARCHIPEL_VM_STARTUP_DEFAULT_CONCURRENCY         = 10
+ARCHIPEL_VM_STARTUP_TIMEOUT                     = 60
+ARCHIPEL_VM_STARTUP_REPORT_INTERVAL             = 2
+ARCHIPEL_VM_STARTUP_PRIORITY_RUNNING            = 0
+ARCHIPEL_VM_STARTUP_PRIORITY_AUTOSTART          = 1
+ARCHIPEL_VM_STARTUP_PRIORITY_SHUTOFF            = 2
+
 class TNThreadedVirtualMachine (Thread):
     """
     This class is used to run L{ArchipelVirtualMachine} main loop
@@ -110,11 +123,129 @@ class TNThreadedVirtualMachine (Thread):
     def run(self):
         """
         Overiddes super class method. Do the L{TNArchipelVirtualMachine} main loop.
+        If the VM is multiplexed, there is no loop: stanzas are processed by
+        the hypervisor's L{TNXMPPMultiplexer} thread.
         """
         self.xmppvm.connect()
+        if self.xmppvm.xmpp_multiplexer:
+            return
         self.xmppvm.loop()
 
 
+class TNVirtualMachinesStartupScheduler (Thread):
+    """
+    This class starts the L{TNThreadedVirtualMachine} of the hypervisor
+    when it wakes up. Only a limited number of virtual machines are
+    connecting to the XMPP server at the same time, and running domains
+    are started first, then autostart domains, then shut off domains.
+    """
+
+    def __init__(self, hypervisor, vm_threads, concurrency=ARCHIPEL_VM_STARTUP_DEFAULT_CONCURRENCY, timeout=ARCHIPEL_VM_STARTUP_TIMEOUT):
+        """
+        The contructor of the class.
+        @type hypervisor: L{TNArchipelHypervisor}
+        @param hypervisor: the hypervisor of the VMs
+        @type vm_threads: list
+        @param vm_threads: the L{TNThreadedVirtualMachine} to start
+        @type concurrency: int
+        @param concurrency: the max number of virtual machines connecting at the same time
+        @type timeout: int
+        @param timeout: number of seconds after which a virtual machine not online yet frees its slot
+        """
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.hypervisor     = hypervisor
+        self.vm_threads     = vm_threads
+        self.concurrency    = max(1, concurrency)
+        self.timeout        = timeout
+        self.lock           = Lock()
+        self.online_count   = 0
+        self.last_report    = 0
+        self.started_at     = None
+
+    def get_priority(self, vm_thread):
+        """
+        Compute the startup priority of a virtual machine from its libvirt domain.
+        @type vm_thread: L{TNThreadedVirtualMachine}
+        @param vm_thread: the virtual machine thread
+        @rtype: int
+        @return: the priority (lower is started first)
+        """
+        try:
+            domain = self.hypervisor.libvirt_connection.lookupByUUIDString(vm_thread.jid.getNode())
+            if domain.info()[0] in (libvirt.VIR_DOMAIN_RUNNING, libvirt.VIR_DOMAIN_BLOCKED, libvirt.VIR_DOMAIN_PAUSED):
+                return ARCHIPEL_VM_STARTUP_PRIORITY_RUNNING
+            if domain.autostart():
+                return ARCHIPEL_VM_STARTUP_PRIORITY_AUTOSTART
+        except libvirt.libvirtError:
+            pass
+        return ARCHIPEL_VM_STARTUP_PRIORITY_SHUTOFF
+
+    def on_vm_online(self, origin=None, user_info=None, parameters=None):
+        """
+        Called by the HOOK_ARCHIPELENTITY_XMPP_AUTHENTICATED of a starting virtual machine.
+        @type origin: L{TNArchipelEntity}
+        @param origin: the origin of the hook
+        @type user_info: Event
+        @param user_info: the event releasing the slot of the virtual machine
+        @type parameters: object
+        @param parameters: runtime arguments
+        """
+        user_info.set()
+        with self.lock:
+            self.online_count += 1
+            if time.time() - self.last_report < ARCHIPEL_VM_STARTUP_REPORT_INTERVAL:
+                return
+            self.last_report = time.time()
+        self.hypervisor.update_presence(presence_msg="Starting VMs %d/%d" % (self.online_count, len(self.vm_threads)))
+
+    def wait_for_slot(self, pending):
+        """
+        Wait until one of the pending virtual machines is online, or has timed out.
+        @type pending: list
+        @param pending: list of tuple (vm_thread, online event, deadline)
+        @rtype: int
+        @return: the number of virtual machines that have timed out
+        """
+        timed_out = 0
+        pending[0][1].wait(max(0, pending[0][2] - time.time()))
+        for item in [item for item in pending if item[1].isSet() or item[2] <= time.time()]:
+            pending.remove(item)
+            if not item[1].isSet():
+                timed_out += 1
+                self.hypervisor.log.warning("STARTUP: virtual machine %s is not online after %d seconds" % (item[0].jid, self.timeout))
+        return timed_out
+
+    def run(self):
+        """
+        Start the virtual machines, by priority, with at most
+        self.concurrency of them connecting at the same time.
+        """
+        self.started_at = time.time()
+        pending = []
+        timed_out = 0
+
+        for vm_thread in sorted(self.vm_threads, key=self.get_priority):
+            while len(pending) >= self.concurrency:
+                timed_out += self.wait_for_slot(pending)
+            online = Event()
+            vm = vm_thread.get_instance()
+            vm.register_hook("HOOK_ARCHIPELENTITY_XMPP_AUTHENTICATED", method=self.on_vm_online, user_info=online, oneshot=True)
+            pending.append((vm_thread, online, time.time() + self.timeout))
+            vm_thread.start()
+            self.hypervisor.perform_hooks("HOOK_HYPERVISOR_VM_WOKE_UP", vm)
+
+        while len(pending) > 0:
+            timed_out += self.wait_for_slot(pending)
+
+        duration = time.time() - self.started_at
+        self.hypervisor.vm_startup_stats = {"duration": "%.2f" % duration, "online": len(self.vm_threads) - timed_out,
+                                            "timedout": timed_out, "total": len(self.vm_threads)}
+        self.hypervisor.log.info("STARTUP: %d/%d virtual machines online in %.2f seconds" % (len(self.vm_threads) - timed_out, len(self.vm_threads), duration))
+        self.hypervisor.perform_hooks("HOOK_HYPERVISOR_WOKE_UP", self.hypervisor)
+        self.hypervisor.update_presence()
+
+
 class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLibvirtEntity, TNHookableEntity, TNAvatarControllableEntity, TNTaggableEntity):
     """
     This class represents a Hypervisor XMPP Capable. This is a XMPP client
@@ -139,15 +270,48 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         archipelLibvirtEntity.TNArchipelLibvirtEntity.__init__(self, configuration)
 
         self.virtualmachines = {}
+        self.virtualmachines_names = {}
         self.database_file = database_file
         self.xmppserveraddr = self.jid.getDomain()
         self.entity_type = "hypervisor"
         self.default_avatar = self.configuration.get("HYPERVISOR", "hypervisor_default_avatar")
         self.libvirt_event_callback_id = None
+        self.libvirt_domains_inventory = None
+        self.libvirt_domains_inventory_lock = Lock()
+        # protects virtualmachines, virtualmachines_names and the database, as vms can be soft allocated and freed by worker threads
+        self.virtualmachines_lock = RLock()
         self.vcard_infos = {}
         self.bad_chars_in_name = '(){}[]<>!@#$'
         self.check_for_central_agent = False
         self.already_wake_up = False
+        self.vm_multiplexer = None
+        self.vm_xmpp_domain = self.xmppserveraddr
+        self.vm_startup_concurrency = ARCHIPEL_VM_STARTUP_DEFAULT_CONCURRENCY
+        self.vm_startup_stats = None
+
+        if self.configuration.has_option("HYPERVISOR", "vm_startup_concurrency"):
+            self.vm_startup_concurrency = self.configuration.getint("HYPERVISOR", "vm_startup_concurrency")
+
+        if self.configuration.has_option("HYPERVISOR", "vm_xmpp_multiplexing") and self.configuration.getboolean("HYPERVISOR", "vm_xmpp_multiplexing"):
+            self.vm_xmpp_domain = self.configuration.get("HYPERVISOR", "vm_component_domain")
+            component_server = self.xmppserveraddr
+            component_port = 5347
+            component_roster_db = None
+            if self.configuration.has_option("HYPERVISOR", "vm_component_server"):
+                component_server = self.configuration.get("HYPERVISOR", "vm_component_server")
+            if self.configuration.has_option("HYPERVISOR", "vm_component_port"):
+                component_port = self.configuration.getint("HYPERVISOR", "vm_component_port")
+            if self.configuration.has_option("HYPERVISOR", "vm_component_roster_database_path"):
+                component_roster_db = self.configuration.get("HYPERVISOR", "vm_component_roster_database_path")
+            debug_mode = self.configuration.has_option("LOGGING", "xmpppy_debug") and self.configuration.getboolean("LOGGING", "xmpppy_debug")
+            self.log.info("Virtual machines will be multiplexed over component %s" % self.vm_xmpp_domain)
+            self.vm_multiplexer = TNXMPPMultiplexer(self.vm_xmpp_domain, self.configuration.get("HYPERVISOR", "vm_component_secret"),
+                                                    component_server, port=component_port, database_file=component_roster_db, debug=debug_mode)
+            self.vm_multiplexer.start()
+
+        if self.configuration.has_option("HYPERVISOR", "xmpp_reactor") and self.configuration.getboolean("HYPERVISOR", "xmpp_reactor"):
+            self.log.info("XMPP connections will be processed by a single reactor thread")
+            self.xmpp_reactor = TNXMPPReactor(self)
 
         try:
             central_db_configured = self.configuration.getboolean("MODULES", "centraldb")
@@ -169,6 +333,12 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         self.permission_center.start(database_file=self.permission_db_file)
         self.init_permissions()
 
+        # start the shared permission store of the virtual machines
+        self.vm_permission_store = None
+        if self.configuration.has_option("VIRTUALMACHINE", "vm_shared_permissions_database_path"):
+            self.vm_permission_store = TNArchipelPermissionStore(self.configuration.get("VIRTUALMACHINE", "vm_shared_permissions_database_path"))
+            self.vm_permission_store.start()
+
         # libvirt connection
         self.connect_libvirt()
 
@@ -217,6 +387,10 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         self.capabilities = self.get_capabilities()
         self.nodeinfo = self.get_nodeinfo()
 
+        # cputime of the virtual machines
+        self.cpu_sampler = TNCPUTimeSampler(self)
+        self.cpu_sampler.start()
+
         # action on auth
         self.register_hook("HOOK_ARCHIPELENTITY_XMPP_AUTHENTICATED", method=self.manage_vcard_hook)
         if not self.get_plugin("centraldb"):
@@ -395,7 +569,8 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
     def manage_persistence(self, vms=[], existing_vms_entities=[]):
         """
         After getting the status of local vms from central db (were they exist
-        else where or not ?), we proceed to instanciate vms
+        else where or not ?), we proceed to instanciate vms. The entities are
+        then started by a L{TNVirtualMachinesStartupScheduler}.
         """
         if len(vms) > 0 or len(existing_vms_entities) > 0:
             self.update_presence(presence_msg="Initializing...")
@@ -403,6 +578,7 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         self.database = sqlite3.connect(self.database_file, check_same_thread=False)
         c = self.database.cursor()
         existing_vms_entities_uuids = []
+        vm_threads = []
         for vm in existing_vms_entities:
             existing_vms_entities_uuids.append(vm["uuid"])
         for vm in vms:
@@ -417,8 +593,8 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
                 jid.setResource(self.jid.getNode().lower())
                 vm_thread = self.create_threaded_vm(jid, vm["password"], vm["name"], self.vcard_infos)
                 self.virtualmachines[vm_thread.jid.getNode()] = vm_thread.get_instance()
-                vm_thread.start()
-                self.perform_hooks("HOOK_HYPERVISOR_VM_WOKE_UP", vm_thread.get_instance())
+                self.index_vm_name(vm_thread.get_instance())
+                vm_threads.append(vm_thread)
             else:
                 self.log.warning("Vm entity %s already exist on another hypervisor, removing from local db and local libvirt." % string_jid)
                 c.execute("delete from virtualmachines where jid='%s'" % string_jid)
@@ -434,8 +610,14 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
                         except libvirt.libvirtError:
                              self.log.warning("Libvirt gave error while trying to destroy the existing vm %s" % (vm))
 
-        self.perform_hooks("HOOK_HYPERVISOR_WOKE_UP", self)
-        self.update_presence()
+        if len(vm_threads) == 0:
+            self.perform_hooks("HOOK_HYPERVISOR_WOKE_UP", self)
+            self.update_presence()
+            return
+
+        self.log.info("STARTUP: starting %d virtual machines, %d at a time" % (len(vm_threads), self.vm_startup_concurrency))
+        self.update_presence(presence_msg="Starting VMs 0/%d" % len(vm_threads))
+        TNVirtualMachinesStartupScheduler(self, vm_threads, concurrency=self.vm_startup_concurrency).start()
 
     def create_threaded_vm(self, jid, password, name, organizationInfo=None):
         """
@@ -468,6 +650,43 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
                 search = False
         return current_name
 
+    def index_vm_name(self, vm, name=None):
+        """
+        Add the vm in the name index.
+        @type vm: L{TNArchipelVirtualMachine}
+        @param vm: the virtual machine
+        @type name: string
+        @param name: the name to index. If None, the current name of the vm
+        """
+        if name is None:
+            name = vm.name
+        self.virtualmachines_names[name.upper()] = vm
+
+    def unindex_vm_name(self, vm, name=None):
+        """
+        Remove the vm from the name index.
+        @type vm: L{TNArchipelVirtualMachine}
+        @param vm: the virtual machine
+        @type name: string
+        @param name: the name to unindex. If None, the current name of the vm
+        """
+        if name is None:
+            name = vm.name
+        if self.virtualmachines_names.get(name.upper()) is vm:
+            del self.virtualmachines_names[name.upper()]
+
+    def reindex_vm_name(self, vm, old_name):
+        """
+        Update the name index after a vm has been renamed.
+        @type vm: L{TNArchipelVirtualMachine}
+        @param vm: the renamed virtual machine
+        @type old_name: string
+        @param old_name: the previous name of the vm
+        """
+        self.unindex_vm_name(vm, old_name)
+        if vm.uuid in self.virtualmachines:
+            self.index_vm_name(vm)
+
     def get_vm_by_name(self, name):
         """
         Return the vm object by name.
@@ -476,10 +695,7 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         @rtype: L{TNArchipelVirtualMachine}
         @return: the virtual machine or None
         """
-        for uuid, vm in self.virtualmachines.iteritems():
-            if vm.name.upper() == name.upper():
-                return vm
-        return None
+        return self.virtualmachines_names.get(name.upper(), None)
 
     def get_vm_by_uuid(self, uuid):
         """
@@ -506,27 +722,76 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
             vm = self.get_vm_by_uuid(identifier)
         return vm
 
+    def build_libvirt_domains_inventory(self):
+        """
+        List all the libvirt domains. If libvirt supports it, this is done with
+        two calls to listAllDomains, instead of a few calls per domain.
+        @rtype: dict
+        @return: dict of {"domain": virDomain, "persistent": Boolean} indexed by UUID
+        """
+        inventory = {}
+        if hasattr(self.libvirt_connection, "listAllDomains"):
+            try:
+                transient_uuids = set([dom.UUIDString() for dom in self.libvirt_connection.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_TRANSIENT)])
+                for dom in self.libvirt_connection.listAllDomains(0):
+                    uuid = dom.UUIDString()
+                    inventory[uuid] = {"domain": dom, "persistent": not uuid in transient_uuids}
+                return inventory
+            except (libvirt.libvirtError, AttributeError) as ex:
+                self.log.warning("Unable to use listAllDomains, falling back to listDomainsID: %s" % str(ex))
+                inventory = {}
+
+        for domID in self.libvirt_connection.listDomainsID():
+            dom = self.libvirt_connection.lookupByID(domID)
+            inventory[dom.UUIDString()] = {"domain": dom, "persistent": dom.isPersistent()}
+        for name in self.libvirt_connection.listDefinedDomains():
+            dom = self.libvirt_connection.lookupByName(name)
+            inventory[dom.UUIDString()] = {"domain": dom, "persistent": True}
+        return inventory
+
+    def update_libvirt_domains_inventory(self, dom, event):
+        """
+        Update the cached domain inventory according to a libvirt lifecycle event.
+        @type dom: virDomain
+        @param dom: the domain that triggered the event
+        @type event: int
+        @param event: the libvirt event
+        """
+        with self.libvirt_domains_inventory_lock:
+            if self.libvirt_domains_inventory is None:
+                return
+            uuid = dom.UUIDString()
+            try:
+                persistent = dom.isPersistent()
+                active = dom.isActive()
+            except libvirt.libvirtError:
+                persistent = False
+                active = False
+            if (event == libvirt.VIR_DOMAIN_EVENT_UNDEFINED and not active) or (not persistent and not active):
+                self.libvirt_domains_inventory.pop(uuid, None)
+            else:
+                self.libvirt_domains_inventory[uuid] = {"domain": dom, "persistent": persistent}
+
     def get_raw_libvirt_domains(self, only_persistant=True):
         """
         Returns a list of defined domain managed by libvirt
         that are not managed by Archipel.
+        If the hypervisor receives libvirt lifecycle events, the domain
+        inventory is cached and kept up to date by hypervisor_on_domain_event.
         """
-        domains = []
-        allDomainIDs = self.libvirt_connection.listDomainsID()
-        for domID in allDomainIDs:
-            dom = self.libvirt_connection.lookupByID(domID)
-            uuid = dom.UUIDString()
-            if not uuid in self.virtualmachines:
-                if dom.isPersistent() or not only_persistant:
-                    domains.append(dom)
+        with self.libvirt_domains_inventory_lock:
+            inventory = self.libvirt_domains_inventory
+            if inventory is None:
+                inventory = self.build_libvirt_domains_inventory()
+                if self.libvirt_event_callback_id is not None:
+                    self.libvirt_domains_inventory = inventory
+            entries = inventory.items()
 
-        allDomainNames = self.libvirt_connection.listDefinedDomains()
-        for name in allDomainNames:
-            dom = self.libvirt_connection.lookupByName(name)
-            uuid = dom.UUIDString()
+        domains = []
+        for uuid, entry in entries:
             if not uuid in self.virtualmachines:
-                domains.append(dom)
-
+                if entry["persistent"] or not only_persistant:
+                    domains.append(entry["domain"])
         return domains
 
     def libvirt_contains_domain_with_name(self, name, raise_error=False, name_check_level=ARCHIPEL_VM_NAME_CHECK_ALL):
@@ -562,6 +827,12 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         """
         Trigger when a domain trigger vbent. We care only about RESUMED and SHUTDOWNED from MIGRATED.
         """
+        try:
+            self.update_libvirt_domains_inventory(dom, event)
+        except Exception as ex:
+            self.log.error("EVENTINVENTORY: Unable to update the domain inventory, it will be rebuilt: %s" % str(ex))
+            self.libvirt_domains_inventory = None
+
         if event == libvirt.VIR_DOMAIN_EVENT_STOPPED and detail == libvirt.VIR_DOMAIN_EVENT_STOPPED_MIGRATED:
             try:
                 vmuuid = dom.UUIDString()
@@ -685,7 +956,7 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
             vm_uuid = str(moduuid.uuid1())
 
         vm_password = ''.join([random.choice(string.letters + string.digits) for i in range(self.configuration.getint("VIRTUALMACHINE", "xmpp_password_size"))])
-        vm_jid = xmpp.JID(node=vm_uuid.lower(), domain=self.xmppserveraddr.lower(), resource=self.jid.getNode().lower())
+        vm_jid = xmpp.JID(node=vm_uuid.lower(), domain=self.vm_xmpp_domain.lower(), resource=self.jid.getNode().lower())
 
         is_xen = self.local_libvirt_uri.upper().startswith(archipelLibvirtEntity.ARCHIPEL_HYPERVISOR_TYPE_XEN)
         blank_spaces_disallowed_in_config = self.configuration.has_option("VIRTUALMACHINE", "allow_blank_space_in_vm_name") \
@@ -727,9 +998,11 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
             vm.register_hook("HOOK_ARCHIPELENTITY_XMPP_AUTHENTICATED", method=vm.define_hook, user_info=definition, oneshot=True)
 
         self.log.info("Registering the new VM in hypervisor's database.")
-        self.database.execute("insert into virtualmachines values(?,?,?,?,?)", (str(vm_jid.getStripped()), vm_password, datetime.datetime.now(), '', name))
-        self.database.commit()
-        self.virtualmachines[vm_uuid] = vm
+        with self.virtualmachines_lock:
+            self.database.execute("insert into virtualmachines values(?,?,?,?,?)", (str(vm_jid.getStripped()), vm_password, datetime.datetime.now(), '', name))
+            self.database.commit()
+            self.virtualmachines[vm_uuid] = vm
+            self.index_vm_name(vm)
 
         self.update_presence()
         self.log.info("XMPP Virtual Machine instance sucessfully initialized.")
@@ -744,6 +1017,7 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
     def soft_alloc(self, jid, name, password, start=True, organization_info=None):
         """
         Perform light allocation (no registration, no subscription).
+        The VM may be given a new JID (see L{local_vm_jid}).
         @type jid: xmpp.JID
         @param jid: the JID of the migrated VM to alloc
         @type name: string
@@ -751,25 +1025,47 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         @type password: string
         @param password: the password of the migrated VM to alloc
         """
+        jid = self.local_vm_jid(jid)
         uuid = jid.getNode()
 
-        jid.setResource(self.jid.getNode().lower())
-        self.log.info("Starting xmpp threaded virtual machine with incoming jid : %s" % jid)
-        vm_thread = self.create_threaded_vm(jid, password, name , organization_info)
-        vm = vm_thread.get_instance()
-        self.log.info("Registering the new VM in hypervisor's database.")
-        self.database.execute("insert into virtualmachines values(?,?,?,?,?)", (str(jid.getStripped()), password, datetime.datetime.now(), '', name))
-        self.database.commit()
-        self.virtualmachines[uuid] = vm
+        with self.virtualmachines_lock:
+            jid.setResource(self.jid.getNode().lower())
+            self.log.info("Starting xmpp threaded virtual machine with incoming jid : %s" % jid)
+            vm_thread = self.create_threaded_vm(jid, password, name , organization_info)
+            vm = vm_thread.get_instance()
+            self.log.info("Registering the new VM in hypervisor's database.")
+            self.database.execute("insert into virtualmachines values(?,?,?,?,?)", (str(jid.getStripped()), password, datetime.datetime.now(), '', name))
+            self.database.commit()
+            self.virtualmachines[uuid] = vm
+            self.index_vm_name(vm)
 
-        self.update_presence()
-        self.log.info("Migrated XMPP VM is ready.")
-        self.perform_hooks("HOOK_HYPERVISOR_SOFT_ALLOC", vm)
-        if start:
-            vm_thread.start()
-            return vm
-        else:
-            return vm_thread
+            self.update_presence()
+            self.log.info("Migrated XMPP VM is ready.")
+            self.perform_hooks("HOOK_HYPERVISOR_SOFT_ALLOC", vm)
+            if start:
+                vm_thread.start()
+                return vm
+            else:
+                return vm_thread
+
+    def local_vm_jid(self, jid):
+        """
+        Return the JID a VM coming from another hypervisor can use here.
+        A multiplexed VM has a JID on the component domain of its
+        hypervisor, that no other hypervisor can serve. So a VM with a JID
+        on neither the XMPP server domain nor our VM domain is given a new
+        JID <uuid>@<our VM domain>. Its roster and vCard are not moved.
+        @type jid: xmpp.JID
+        @param jid: the JID of the VM
+        @rtype: xmpp.JID
+        @return: the JID to use
+        """
+        domain = jid.getDomain().lower()
+        if domain in (self.xmppserveraddr.lower(), self.vm_xmpp_domain.lower()):
+            return jid
+        local_jid = xmpp.JID(node=jid.getNode().lower(), domain=self.vm_xmpp_domain.lower())
+        self.log.warning("Virtual machine %s cannot be served on this hypervisor. It will use JID %s" % (jid.getStripped(), local_jid))
+        return local_jid
 
     def free(self, jid):
         """
@@ -791,10 +1087,11 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
         vm.terminate()
 
         self.log.info("Unregistering the VM from hypervisor's database.")
-        self.database.execute("delete from virtualmachines where jid=?", (jid.getStripped(),))
-        self.database.commit()
-
-        del self.virtualmachines[uuid]
+        with self.virtualmachines_lock:
+            self.database.execute("delete from virtualmachines where jid=?", (jid.getStripped(),))
+            self.database.commit()
+            del self.virtualmachines[uuid]
+            self.unindex_vm_name(vm)
 
         self.log.info("Starting the vm removing procedure.")
         vm.inband_unregistration()
@@ -818,18 +1115,28 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
 
         vm.undefine_and_disconnect()
 
-        try:
-            self.log.info("Unregistering the VM from hypervisor's database.")
-            self.database.execute("delete from virtualmachines where jid='%s'" % vm.jid.getStripped())
-            self.database.commit()
-        except Exception as ex:
-            self.log.error("Unable to remove VM from database: %s" % str(ex))
-        try:
-            del self.virtualmachines[uuid]
-        except Exception as ex:
-            self.log.error("Unable to remove VM from internal list: %s" % str(ex))
+        with self.virtualmachines_lock:
+            if self.vm_permission_store:
+                try:
+                    self.log.info("Exporting VM permissions from the shared permission store.")
+                    self.vm_permission_store.export_database(vm.jid.getStripped(), vm.permission_db_file)
+                    self.vm_permission_store.delete_entity(vm.jid.getStripped())
+                except Exception as ex:
+                    self.log.error("Unable to export VM permissions: %s" % str(ex))
 
-        self.update_presence()
+            try:
+                self.log.info("Unregistering the VM from hypervisor's database.")
+                self.database.execute("delete from virtualmachines where jid='%s'" % vm.jid.getStripped())
+                self.database.commit()
+            except Exception as ex:
+                self.log.error("Unable to remove VM from database: %s" % str(ex))
+            try:
+                del self.virtualmachines[uuid]
+                self.unindex_vm_name(vm)
+            except Exception as ex:
+                self.log.error("Unable to remove VM from internal list: %s" % str(ex))
+
+            self.update_presence()
 
         self.log.info("Virtual machine has been sucessfully soft freed.")
 
@@ -1098,7 +1405,7 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
             unanaged_domains = self.get_raw_libvirt_domains(only_persistant=True)
             for dom in unanaged_domains:
                 n = xmpp.Node("item", attrs={"managed": "False", "name": dom.name()})
-                n.addData("%s@%s" % (dom.UUIDString(), self.jid.getDomain()))
+                n.addData("%s@%s" % (dom.UUIDString(), self.vm_xmpp_domain))
                 nodes.append(n)
 
             reply.setQueryPayload(sorted(nodes, cmp=lambda x, y: cmp(x.getData(), y.getData())))
@@ -1281,9 +1588,11 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
                 vm = self.virtualmachines[uuid]
                 vm.terminate(clean_files=False)
                 self.log.info("Unregistering the VM from hypervisor's database.")
-                self.database.execute("delete from virtualmachines where jid=?", (jid.getStripped(),))
-                self.database.commit()
-                del self.virtualmachines[uuid]
+                with self.virtualmachines_lock:
+                    self.database.execute("delete from virtualmachines where jid=?", (jid.getStripped(),))
+                    self.database.commit()
+                    del self.virtualmachines[uuid]
+                    self.unindex_vm_name(vm)
                 self.log.info("Starting the vm removing procedure.")
                 vm.inband_unregistration()
                 self.log.info("unmanage virtual machine with UUID: %s" % uuid)
@@ -1380,4 +1689,7 @@ class TNArchipelHypervisor (TNArchipelEntity, archipelLibvirtEntity.TNArchipelLi
             except Exception as ex:
                 self.log.error("CENTRALDB: error when executing exit proc: %s"%ex)
 
+        self.cpu_sampler.stop()
+        if self.vm_multiplexer:
+            self.vm_multiplexer.stop()
         self.disconnect()
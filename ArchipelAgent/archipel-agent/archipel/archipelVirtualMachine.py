@@ -48,11 +48,13 @@ from threading import Timer
 from archipelcore.archipelAvatarControllableEntity import TNAvatarControllableEntity
 from archipelcore.archipelEntity import TNArchipelEntity
 from archipelcore.archipelHookableEntity import TNHookableEntity
+from archipelcore.archipelPermissionCenter import TNArchipelEntityPermissionCenter
 from archipelcore.archipelRosterQueryableEntity import TNRosterQueryableEntity
 from archipelcore.archipelTaggableEntity import TNTaggableEntity
 from archipelcore.utils import build_error_iq, build_error_message
 from archipelcore import xmpp
 
+from archipelCPUTimeSampler import TNCPUTimeSamples
 from archipelLibvirtEntity import ARCHIPEL_NS_LIBVIRT_GENERIC_ERROR, generate_mac_adress
 import archipelLibvirtEntity
 
@@ -107,6 +109,9 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
         TNArchipelEntity.__init__(self, jid, password, configuration, name)
 
         self.hypervisor = hypervisor
+        if hypervisor.vm_multiplexer and hypervisor.vm_multiplexer.can_serve(self.jid):
+            self.xmpp_multiplexer = hypervisor.vm_multiplexer
+        self.xmpp_reactor = hypervisor.xmpp_reactor
         self.libvirt_status = libvirt.VIR_DOMAIN_SHUTDOWN
         self.domain = None
         self.definition = None
@@ -124,9 +129,7 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
         self.vcard_infos = {}
         self.is_freeing = False
         self.inhibit_next_undefine_domain_event = False
-        self.cputime_samples=[]
-        self.cputime_sampling_Interval = 2.0
-        self.cputime_sampling_timer(self.cputime_sampling_Interval)
+        self.cputime_samples = TNCPUTimeSamples()
 
         if self.configuration.has_option("VIRTUALMACHINE", "vm_perm_path"):
             self.vm_perm_base_path = self.configuration.get("VIRTUALMACHINE", "vm_perm_path")
@@ -142,7 +145,14 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
 
         # start the permission center
         self.permission_db_file = "%s/%s" % (self.permfolder, self.configuration.get("VIRTUALMACHINE", "vm_permissions_database_path"))
-        self.permission_center.start(database_file=self.permission_db_file)
+        if self.hypervisor.vm_permission_store:
+            store = self.hypervisor.vm_permission_store
+            self.permission_center = TNArchipelEntityPermissionCenter(store, self.jid.getStripped(), root_admins=self.permission_admin_names)
+            if not store.has_entity(self.jid.getStripped()) and os.path.exists(self.permission_db_file):
+                self.log.info("Importing permissions from %s into the shared permission store" % self.permission_db_file)
+                store.import_database(self.jid.getStripped(), self.permission_db_file)
+        else:
+            self.permission_center.start(database_file=self.permission_db_file)
         self.init_permissions()
 
         # hooks
@@ -172,6 +182,10 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
         self.initialize_modules('archipel.plugin.core')
         self.initialize_modules('archipel.plugin.virtualmachine')
 
+        # write the permissions defined by the first VM in one transaction
+        if self.hypervisor.vm_permission_store:
+            self.hypervisor.vm_permission_store.flush_definitions()
+
 
     ### Overrides
 
@@ -340,7 +354,9 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
         self.hypervisor.libvirt_contains_domain_with_name(newname, raise_error=True)
 
         self.log.info("renaming VM from %s to %s" % (self.name, newname))
+        old_name = self.name
         self.change_name(newname, publish)
+        self.hypervisor.reindex_vm_name(self, old_name)
 
         if self.domain:
             self.inhibit_next_undefine_domain_event = True
@@ -746,31 +762,14 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
             return (data, size)
         return (None, (0, 0))
 
-    def cputime_sampling_timer(self, interval):
-        """
-        Create a threaded timer to take timestamp,cputime samples from actual domain
-        """
-        if self.domain and not self.is_freeing and not self.is_migrating:
-            try:
-                self.cputime_samples.insert(0, (time.time(), self.domain.info()[4]))
-                if len(self.cputime_samples) > 2:
-                    self.cputime_samples.pop()
-            except Exception as ex:
-                # @TODO: I'm sure there is a better way to do this.
-                # First, this thing should be only running when the VM is running
-                # instead of trying for nothing is the VM is not defined and running.
-                self.log.warning("It seems the VM is gone, certainly due to migration. Stopping cpu usage collector.")
-                return
-
-        if not self.is_migrating: # for some reason this is not working...
-            Timer(interval, self.cputime_sampling_timer, [interval]).start()
-
     def compute_cpu_usage(self):
         """
-        Return the vm CPU usage in percent between two samples
+        Return the vm CPU usage in percent between the two last samples
+        taken by the hypervisor's L{TNCPUTimeSampler}
         """
         try:
-            prtCPU = 100 * (self.cputime_samples[0][1] - self.cputime_samples[1][1]) / ((self.cputime_samples[0][0] - self.cputime_samples[1][0]) * self.hypervisor.get_nodeinfo()['nrCoreperSocket'] * 1000000000)
+            samples = self.cputime_samples.last(2)
+            prtCPU = 100 * (samples[0][1] - samples[1][1]) / ((samples[0][0] - samples[1][0]) * self.hypervisor.nodeinfo['nrCoreperSocket'] * 1000000000)
         except:
             prtCPU = 0
 
@@ -1026,6 +1025,10 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
         if self.hypervisor.jid.getStripped() == destination_jid.getStripped():
             raise Exception('Virtual machine is already running on %s' % destination_jid.getStripped())
 
+        # destination hypervisor reads permissions from the VM folder
+        if self.hypervisor.vm_permission_store:
+            self.hypervisor.vm_permission_store.export_database(self.jid.getStripped(), self.permission_db_file)
+
         if self.domain.info()[0] == libvirt.VIR_DOMAIN_SHUTOFF:
             self.migrate_not_running_step1(destination_jid)
         else:
@@ -1178,7 +1181,10 @@ class TNArchipelVirtualMachine (TNArchipelEntity, TNHookableEntity, TNAvatarCont
         self.perform_hooks("HOOK_VM_TERMINATE")
         self.permission_center.close_database()
         if clean_files:
-            os.unlink(self.permission_db_file)
+            if self.hypervisor.vm_permission_store:
+                self.permission_center.delete_entity()
+            if os.path.exists(self.permission_db_file):
+                os.unlink(self.permission_db_file)
             self.remove_folder()
 
 
@@ -105,6 +105,7 @@ setup(name='archipel-agent',
         """,
       scripts = [
         'install/bin/archipel-importvirtualmachine',
+        'install/bin/archipel-migratepermissions',
         'install/bin/archipel-updatedomain',
         'install/bin/archipel-initinstall',
         'install/bin/archipel-commandsbytag',
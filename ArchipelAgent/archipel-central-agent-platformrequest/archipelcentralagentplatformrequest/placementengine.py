@@ -0,0 +1,449 @@
+# -*- coding: utf-8 -*-
+#
+# placementengine.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains L{TNPlacementEngine}, that chooses the hypervisors where virtual
+machines should be created.
+
+The engine keeps a capacity vector for each hypervisor: the number of vms,
+and the vcpus and memory they are allocated, and the statistics pushed by
+the hypervisors on each keepalive (as named by the required_stats of the
+computing unit, for instance "memory.free"). The vectors are read from the
+central database when the agent becomes central agent, then kept up to date
+by the hooks of the central agent, each time a vm or an hypervisor is
+registered, updated or unregistered.
+
+The placements made by the engine are reserved until the vms are registered
+in the central database, so the following requests take them into account.
+The anti-affinity tags of the requested vms are kept until they are
+registered, then written in the central database with them. The hypervisors
+to avoid for a tag are read from there, so they are known whoever placed the
+vms and survive a restart. The
+scoring is done by the computing unit. A batch of vms is packed
+first-fit-decreasing, each placement consuming the capacity it is given.
+"""
+
+import heapq
+import time
+from threading import RLock
+
+
+# number of seconds a placement is reserved if its vm doesn't show up in the central database
+ARCHIPEL_PLACEMENT_RESERVATION_TTL  = 300
+
+
+class TNPlacementEngine (object):
+    """
+    This class scores and places virtual machines on the online hypervisors.
+    """
+
+    def __init__(self, entity, computing_unit, reservation_ttl=ARCHIPEL_PLACEMENT_RESERVATION_TTL):
+        """
+        Initialize the engine.
+        @type entity: L{TNArchipelCentralAgent}
+        @param entity: the central agent
+        @type computing_unit: L{TNBasicPlatformScoreComputing}
+        @param computing_unit: the computing unit scoring the hypervisors
+        @type reservation_ttl: int
+        @param reservation_ttl: number of seconds a placement is reserved
+        """
+        self.entity             = entity
+        self.computing_unit     = computing_unit
+        self.reservation_ttl    = reservation_ttl
+        self.hypervisors        = {}
+        self.online             = set()
+        self.vms                = {}
+        self.reservations       = []
+        self.tags               = {}
+        self.pending_tags       = {}
+        self.lock               = RLock()
+
+    ### Capacities
+
+    def stat_names(self):
+        """
+        @rtype: list
+        @return: the names of the statistics stored in the columns stat1, stat2 and stat3
+        """
+        return ["%s.%s" % (stat["major"], stat["minor"]) for stat in self.computing_unit.required_stats][:3]
+
+    def load(self):
+        """
+        Read the capacity vectors and the tags from the central database.
+        """
+        with self.lock:
+            self.hypervisors = {}
+            self.online = set()
+            self.vms = {}
+            self.tags = {}
+            for row in self.entity.database.execute("select jid, status, stat1, stat2, stat3 from hypervisors"):
+                self.set_hypervisor({"jid": row[0], "status": row[1], "stat1": row[2], "stat2": row[3], "stat3": row[4]})
+            for row in self.entity.database.execute("select uuid, hypervisor, vcpus, memory, tag from vms"):
+                self.add_vm(row[0], row[1], row[2], row[3], row[4])
+            self.entity.log.info("PLATFORMREQ: capacities of %d hypervisors and %d vms loaded" % (len(self.hypervisors), len(self.vms)))
+
+    def capacity(self, jid):
+        """
+        @type jid: string
+        @param jid: the hypervisor
+        @rtype: dict
+        @return: the capacity vector of the hypervisor, created if needed
+        """
+        if not jid in self.hypervisors:
+            self.hypervisors[jid] = {"vms": 0, "vcpus": 0, "memory": 0}
+        return self.hypervisors[jid]
+
+    def set_hypervisor(self, entry):
+        """
+        Update the status and the statistics of an hypervisor.
+        @type entry: dict
+        @param entry: the written columns of the hypervisor, including jid
+        """
+        jid = str(entry["jid"])
+        capacity = self.capacity(jid)
+        stat_names = self.stat_names()
+        for i in range(len(stat_names)):
+            try:
+                capacity[stat_names[i]] = float(entry["stat%d" % (i + 1)])
+            except (KeyError, TypeError, ValueError):
+                pass
+        if entry.get("status") == "Online":
+            self.online.add(jid)
+        elif entry.get("status") is not None:
+            self.online.discard(jid)
+
+    def add_vm(self, uuid, hypervisor, vcpus, memory, tag):
+        """
+        Add a vm to the capacity vector of its hypervisor.
+        @type uuid: string
+        @param uuid: the uuid of the vm
+        @type hypervisor: string
+        @param hypervisor: the jid of the hypervisor
+        @type vcpus: int
+        @param vcpus: the vcpus of the vm
+        @type memory: int
+        @param memory: the memory of the vm (KiB)
+        @type tag: string
+        @param tag: the anti-affinity tag of the vm
+        """
+        hypervisor = str(hypervisor)
+        vcpus = int(vcpus or 0)
+        memory = int(memory or 0)
+        self.vms[uuid] = (hypervisor, vcpus, memory, tag or "")
+        capacity = self.capacity(hypervisor)
+        capacity["vms"] += 1
+        capacity["vcpus"] += vcpus
+        capacity["memory"] += memory
+        if tag:
+            hypervisors = self.tags.setdefault(tag, {})
+            hypervisors[hypervisor] = hypervisors.get(hypervisor, 0) + 1
+
+    def remove_vm(self, uuid):
+        """
+        Remove a vm from the capacity vector of its hypervisor.
+        @type uuid: string
+        @param uuid: the uuid of the vm
+        @rtype: tuple
+        @return: the (hypervisor, vcpus, memory, tag) of the vm, or None if it is unknown
+        """
+        if not uuid in self.vms:
+            return None
+        hypervisor, vcpus, memory, tag = self.vms.pop(uuid)
+        capacity = self.capacity(hypervisor)
+        capacity["vms"] -= 1
+        capacity["vcpus"] -= vcpus
+        capacity["memory"] -= memory
+        if tag:
+            hypervisors = self.tags[tag]
+            hypervisors[hypervisor] -= 1
+            if not hypervisors[hypervisor]:
+                del hypervisors[hypervisor]
+            if not hypervisors:
+                del self.tags[tag]
+        return (hypervisor, vcpus, memory, tag)
+
+    def expire_reservations(self, now):
+        """
+        Drop the reservations and the pending tags which are too old.
+        @type now: float
+        @param now: the current time
+        """
+        self.reservations = [reservation for reservation in self.reservations if reservation[0] > now]
+        for uuid, (expiry, tag) in self.pending_tags.items():
+            if expiry <= now:
+                del self.pending_tags[uuid]
+
+    def consume(self, capacity, demand):
+        """
+        Remove the demand of a vm from a capacity vector.
+        @type capacity: dict
+        @param capacity: the capacity vector
+        @type demand: dict
+        @param demand: the demand of the vm
+        """
+        capacity["vms"] += 1
+        capacity["vcpus"] += demand.get("vcpus", 0)
+        capacity["memory"] += demand.get("memory", 0)
+        if "memory.free" in capacity:
+            capacity["memory.free"] -= demand.get("memory", 0)
+
+    def get_capacities(self):
+        """
+        @rtype: dict
+        @return: the capacity vectors of the online hypervisors, minus the reservations, indexed by jid
+        """
+        with self.lock:
+            self.expire_reservations(time.time())
+            capacities = dict([(jid, dict(self.hypervisors[jid])) for jid in self.online])
+            for expiry, jid, demand in self.reservations:
+                if jid in capacities:
+                    self.consume(capacities[jid], demand)
+            return capacities
+
+    ### Tags
+
+    def remember_tag(self, demand):
+        """
+        Keep the anti-affinity tag of a vm until it is registered.
+        @type demand: dict
+        @param demand: the demand of the vm
+        """
+        if demand.get("uuid") and demand.get("tag"):
+            with self.lock:
+                self.pending_tags[demand["uuid"]] = (time.time() + self.reservation_ttl, demand["tag"])
+
+    def tagged_hypervisors(self, tag):
+        """
+        @type tag: string
+        @param tag: the anti-affinity tag
+        @rtype: set
+        @return: the hypervisors hosting or reserved for a vm with this tag
+        """
+        if not tag:
+            return set()
+        hypervisors = set(self.tags.get(tag, {}).keys())
+        for expiry, jid, demand in self.reservations:
+            if demand.get("tag") == tag:
+                hypervisors.add(jid)
+        return hypervisors
+
+    ### Hooks
+
+    def hook_central_agent_activated(self, origin, user_info, arguments):
+        """
+        Called by HOOK_CENTRALAGENT_ACTIVATED. Load the capacity vectors.
+        @type origin: L{TNArchipelCentralAgent}
+        @param origin: the central agent
+        @type user_info: object
+        @param user_info: not used
+        @type arguments: object
+        @param arguments: not used
+        """
+        self.load()
+
+    def hook_vms_registered(self, origin, user_info, arguments):
+        """
+        Called by HOOK_CENTRALAGENT_VM_REGISTERED. Add the vms to the capacity
+        vectors, write their pending tags in the central database, and drop
+        their reservations.
+        @type origin: L{TNArchipelCentralAgent}
+        @param origin: the central agent
+        @type user_info: object
+        @param user_info: not used
+        @type arguments: list
+        @param arguments: the registered vms
+        """
+        with self.lock:
+            now = time.time()
+            tagged = []
+            for entry in arguments:
+                # registering a vm again keeps its tag
+                previous = self.remove_vm(entry["uuid"])
+                tag = previous and previous[3] or ""
+                expiry, pending_tag = self.pending_tags.pop(entry["uuid"], (0, None))
+                if expiry > now:
+                    tag = pending_tag
+                    tagged.append({"uuid": entry["uuid"], "tag": tag})
+                self.add_vm(entry["uuid"], entry.get("hypervisor"), entry.get("vcpus"), entry.get("memory"), tag)
+            if tagged:
+                self.entity.db_commit("update vms set tag=:tag where uuid=:uuid", tagged)
+            registered = set([entry["uuid"] for entry in arguments])
+            self.reservations = [reservation for reservation in self.reservations if not reservation[2].get("uuid") in registered]
+
+    def hook_vms_updated(self, origin, user_info, arguments):
+        """
+        Called by HOOK_CENTRALAGENT_VM_UPDATED. Move the vms to their new
+        hypervisor, with their new resources.
+        @type origin: L{TNArchipelCentralAgent}
+        @param origin: the central agent
+        @type user_info: object
+        @param user_info: not used
+        @type arguments: list
+        @param arguments: the written columns of the vms, including uuid
+        """
+        with self.lock:
+            for entry in arguments:
+                previous = self.remove_vm(entry["uuid"])
+                if not previous:
+                    continue
+                hypervisor, vcpus, memory, tag = previous
+                self.add_vm(entry["uuid"], entry.get("hypervisor", hypervisor), entry.get("vcpus", vcpus), entry.get("memory", memory), entry.get("tag", tag))
+
+    def hook_vms_unregistered(self, origin, user_info, arguments):
+        """
+        Called by HOOK_CENTRALAGENT_VM_UNREGISTERED. Remove the vms from the
+        capacity vectors.
+        @type origin: L{TNArchipelCentralAgent}
+        @param origin: the central agent
+        @type user_info: object
+        @param user_info: not used
+        @type arguments: list
+        @param arguments: the unregistered vms
+        """
+        with self.lock:
+            for entry in arguments:
+                self.remove_vm(entry["uuid"])
+
+    def hook_hypervisors_updated(self, origin, user_info, arguments):
+        """
+        Called by HOOK_CENTRALAGENT_HYP_REGISTERED and HOOK_CENTRALAGENT_HYP_UPDATED.
+        Update the status and the statistics of the hypervisors.
+        @type origin: L{TNArchipelCentralAgent}
+        @param origin: the central agent
+        @type user_info: object
+        @param user_info: not used
+        @type arguments: list
+        @param arguments: the written columns of the hypervisors, including jid
+        """
+        with self.lock:
+            for entry in arguments:
+                self.set_hypervisor(entry)
+
+    def hook_hypervisors_unregistered(self, origin, user_info, arguments):
+        """
+        Called by HOOK_CENTRALAGENT_HYP_UNREGISTERED. The hypervisors are not
+        used anymore. Their vms, if any, stay counted until they are moved.
+        @type origin: L{TNArchipelCentralAgent}
+        @param origin: the central agent
+        @type user_info: object
+        @param user_info: not used
+        @type arguments: list
+        @param arguments: the unregistered hypervisors
+        """
+        with self.lock:
+            for entry in arguments:
+                self.online.discard(str(entry["jid"]))
+
+    ### Placement
+
+    def candidates(self, capacities, demand, excluded):
+        """
+        Score the hypervisors able to host a vm.
+        @type capacities: dict
+        @param capacities: the capacity vectors, indexed by jid
+        @type demand: dict
+        @param demand: the demand of the vm
+        @type excluded: set
+        @param excluded: the hypervisors which must not be used
+        @rtype: generator
+        @return: tuples (score, jid)
+        """
+        for jid, capacity in capacities.iteritems():
+            if jid in excluded or not self.computing_unit.placement_fits(capacity, demand):
+                continue
+            score = self.computing_unit.placement_score(capacity, demand)
+            if score:
+                yield (score, jid)
+
+    def top(self, demand, limit=10):
+        """
+        Find the best hypervisors for a vm, without reserving anything. The
+        tag of the vm is kept until it is registered.
+        @type demand: dict
+        @param demand: the demand of the vm: memory (KiB), vcpus, tag
+        @type limit: int
+        @param limit: the max number of hypervisors
+        @rtype: list
+        @return: list of dict {"jid", "score"}, the best first
+        """
+        self.remember_tag(demand)
+        with self.lock:
+            capacities = self.get_capacities()
+            excluded = self.tagged_hypervisors(demand.get("tag"))
+            best = heapq.nlargest(limit, self.candidates(capacities, demand, excluded))
+        return [{"jid": jid, "score": score} for score, jid in best]
+
+    def reserve(self, jid, demand):
+        """
+        Reserve the demand of a vm on an hypervisor.
+        @type jid: string
+        @param jid: the hypervisor
+        @type demand: dict
+        @param demand: the demand of the vm
+        """
+        with self.lock:
+            self.reservations.append((time.time() + self.reservation_ttl, jid, demand))
+            self.remember_tag(demand)
+
+    def place(self, demands):
+        """
+        Place several vms. Each placement consumes the capacity of its
+        hypervisor before the next one is chosen, and is reserved.
+        @type demands: list
+        @param demands: the demands of the vms: memory (KiB), vcpus, tag, uuid
+        @rtype: list
+        @return: the chosen jid for each demand, in the same order. None if a vm cannot be placed
+        """
+        placements = []
+        excluded = {}
+        with self.lock:
+            capacities = self.get_capacities()
+            for demand in demands:
+                tag = demand.get("tag")
+                if not tag in excluded:
+                    excluded[tag] = self.tagged_hypervisors(tag)
+                best = heapq.nlargest(1, self.candidates(capacities, demand, excluded[tag]))
+                if not best:
+                    placements.append(None)
+                    continue
+                jid = best[0][1]
+                self.consume(capacities[jid], demand)
+                self.reserve(jid, demand)
+                if tag:
+                    excluded[tag].add(jid)
+                placements.append(jid)
+        return placements
+
+    def pack(self, demands):
+        """
+        Place a batch of vms, first-fit-decreasing: the biggest vms (memory,
+        then vcpus) are placed first, while the hypervisors still have room
+        for them, and the smaller ones fill the remaining capacity.
+        @type demands: list
+        @param demands: the demands of the vms: memory (KiB), vcpus, tag, uuid
+        @rtype: list
+        @return: the chosen jid for each demand, in the given order. None if a vm cannot be placed
+        """
+        order = sorted(range(len(demands)), key=lambda i: (demands[i].get("memory", 0), demands[i].get("vcpus", 0)), reverse=True)
+        placements = [None] * len(demands)
+        for index, jid in zip(order, self.place([demands[i] for i in order])):
+            placements[index] = jid
+        return placements
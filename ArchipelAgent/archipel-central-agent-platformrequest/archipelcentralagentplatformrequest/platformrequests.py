@@ -26,10 +26,11 @@ from archipelcore.archipelPlugin import TNArchipelPlugin
 from archipelcore.utils import build_error_iq
 from archipelcore import xmpp
 
+from placementengine import TNPlacementEngine
 from scorecomputing import TNBasicPlatformScoreComputing
 
 
-ARCHIPEL_NS_PLATFORM = "archipel:centralagent:platform"
+ARCHIPEL_NS_PLATFORM            = "archipel:centralagent:platform"
 
 
 class TNPlatformRequests (TNArchipelPlugin):
@@ -48,6 +49,18 @@ class TNPlatformRequests (TNArchipelPlugin):
         self.computing_unit = None
         # get computing unit plugin if present
         self.load_computing_unit()
+        self.load_placement_weights()
+        self.placement = TNPlacementEngine(self.entity, self.computing_unit)
+        # the capacity vectors are kept up to date by the central agent
+        self.entity.register_hook("HOOK_CENTRALAGENT_ACTIVATED", method=self.placement.hook_central_agent_activated)
+        self.entity.register_hook("HOOK_CENTRALAGENT_VM_REGISTERED", method=self.placement.hook_vms_registered)
+        self.entity.register_hook("HOOK_CENTRALAGENT_VM_UPDATED", method=self.placement.hook_vms_updated)
+        self.entity.register_hook("HOOK_CENTRALAGENT_VM_UNREGISTERED", method=self.placement.hook_vms_unregistered)
+        self.entity.register_hook("HOOK_CENTRALAGENT_HYP_REGISTERED", method=self.placement.hook_hypervisors_updated)
+        self.entity.register_hook("HOOK_CENTRALAGENT_HYP_UPDATED", method=self.placement.hook_hypervisors_updated)
+        self.entity.register_hook("HOOK_CENTRALAGENT_HYP_UNREGISTERED", method=self.placement.hook_hypervisors_unregistered)
+        # permissions
+        self.entity.permission_center.create_permission("platform_place", "Authorizes users to place batches of virtual machines", False)
 
     ### Plugin interface
 
@@ -99,6 +112,21 @@ class TNPlatformRequests (TNArchipelPlugin):
             self.entity.log.warning("PLATFORMREQ: using dummy computing unit. It returns random values !")
 
 
+    def load_placement_weights(self):
+        """
+        Override the placement weights of the computing unit with
+        PLATFORMREQUEST:placement_weights, if set.
+        """
+        if not self.configuration.has_option("PLATFORMREQUEST", "placement_weights"):
+            return
+        for weight in self.configuration.get("PLATFORMREQUEST", "placement_weights").split(","):
+            if not weight.strip():
+                continue
+            name, value = weight.split(":")
+            self.computing_unit.placement_weights[name.strip()] = float(value)
+        self.entity.log.info("PLATFORMREQ: placement weights are %s" % self.computing_unit.placement_weights)
+
+
     ### XMPP Management
 
     def process_iq(self, conn, iq):
@@ -106,6 +134,7 @@ class TNPlatformRequests (TNArchipelPlugin):
         This method is invoked when a ARCHIPEL_NS_PLATFORM IQ is received.
         It understands IQ of type:
             - request
+            - place
         @type conn: xmpp.Dispatcher
         @param conn: ths instance of the current connection that send the stanza
         @type iq: xmpp.Protocol.Iq
@@ -113,8 +142,12 @@ class TNPlatformRequests (TNArchipelPlugin):
         """
         reply = None
         action = self.entity.check_acp(conn, iq)
+        if action == "place":
+            self.entity.check_perm(conn, iq, action, -1, prefix="platform_")
         if action == "request":
             reply = self.iq_request(iq)
+        elif action == "place":
+            reply = self.iq_place(iq)
         if reply:
             conn.send(reply)
             raise xmpp.protocol.NodeProcessed
@@ -129,11 +162,55 @@ class TNPlatformRequests (TNArchipelPlugin):
         """
         try:
             reply = iq.buildReply("result")
-            limit = iq.getTag("query").getTag("archipel").getAttr("limit")
-            computed_items = self.computing_unit.score(self.entity.database, limit=limit)
+            request = iq.getTag("query").getTag("archipel")
+            limit = int(request.getAttr("limit") or 10)
+            computed_items = self.placement.top(self.parse_demand(request), limit=limit)
             self.entity.log.debug("PLATFORMREQ: computed items : %s" % computed_items)
             for computed_item in computed_items:
                 reply.addChild("hypervisor", attrs=computed_item)
         except Exception as ex:
             reply = build_error_iq(self, ex, iq)
         return reply
+
+    def parse_demand(self, node):
+        """
+        Read the resources requested for a virtual machine.
+        @type node: xmpp.Node
+        @param node: the node, with optional attributes memory (KiB), vcpus, tag and uuid
+        @rtype: dict
+        @return: the demand
+        """
+        demand = {"memory": int(node.getAttr("memory") or 0), "vcpus": int(node.getAttr("vcpus") or 0)}
+        if node.getAttr("tag"):
+            demand["tag"] = node.getAttr("tag")
+        if node.getAttr("uuid"):
+            demand["uuid"] = node.getAttr("uuid")
+        return demand
+
+    def iq_place(self, iq):
+        """
+        Place a batch of virtual machines. Each vm child gives the resources
+        of a virtual machine (see L{parse_demand}). The reply gives the chosen
+        hypervisor of each vm, which stays reserved until the vm is registered
+        or the reservation expires. The vms are not allocated: the requester
+        sends the alloc to each hypervisor itself, so it owns the new vms.
+        @type iq: xmpp.Protocol.Iq
+        @param iq: the received IQ
+        @rtype: xmpp.Protocol.Iq
+        @return: a ready to send IQ containing the result of the action
+        """
+        try:
+            reply = iq.buildReply("result")
+            request = iq.getTag("query").getTag("archipel")
+            nodes = request.getTags("vm")
+            placements = self.placement.pack([self.parse_demand(node) for node in nodes])
+            self.entity.log.info("PLATFORMREQ: placed %d of %d vms" % (len([jid for jid in placements if jid]), len(nodes)))
+            for index in range(len(nodes)):
+                result = {"index": index, "hypervisor": placements[index] or "", "status": placements[index] and "placed" or "unplaced"}
+                for attr in ("uuid", "name"):
+                    if nodes[index].getAttr(attr):
+                        result[attr] = nodes[index].getAttr(attr)
+                reply.addChild("vm", attrs=result)
+        except Exception as ex:
+            reply = build_error_iq(self, ex, iq)
+        return reply
@@ -20,6 +20,11 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+# scales used to bring the placement features between 0 and 1
+ARCHIPEL_PLACEMENT_MEMORY_SCALE     = 256000000.0 # KiB
+ARCHIPEL_PLACEMENT_VCPUS_SCALE      = 32.0
+
+
 class TNBasicPlatformScoreComputing (object):
     """
     This class is a basic score computing. If you want to provide
@@ -35,8 +40,9 @@ class TNBasicPlatformScoreComputing (object):
         """
         # required_stats to be written to central db regularly for score computing
         # should be in the form i.e. [ { "major": "(memory|cpu|load)", "minor": "free" } ]
-        required_stats = []
-        pass
+        self.required_stats = []
+        # weights of the placement features. see placement_features
+        self.placement_weights = {"vms": 1.0}
 
     ## Plugin
 
@@ -76,3 +82,61 @@ class TNBasicPlatformScoreComputing (object):
         for row in rows:
             hyp_list.append({"jid":row[0], "score": random.random()}) # yeah! that's a big computing
         return hyp_list
+
+    ## Placement
+
+    def placement_fits(self, capacity, demand):
+        """
+        Check if an hypervisor can host a virtual machine.
+        @type capacity: dict
+        @param capacity: the capacity vector of the hypervisor: vms, vcpus, memory and the required stats
+        @type demand: dict
+        @param demand: the demand of the virtual machine: memory (KiB), vcpus
+        @rtype: Boolean
+        @return: True if the virtual machine fits
+        """
+        if "memory.free" in capacity:
+            return capacity["memory.free"] >= demand.get("memory", 0)
+        return True
+
+    def placement_features(self, capacity, demand):
+        """
+        Compute the placement features of an hypervisor. Each feature is
+        between 0 and 1, the highest the better. The features depending on
+        a statistic that is not in required_stats are not computed.
+        @type capacity: dict
+        @param capacity: the capacity vector of the hypervisor
+        @type demand: dict
+        @param demand: the demand of the virtual machine
+        @rtype: dict
+        @return: the features, indexed by name
+        """
+        features = {"vms": 1.0 / (1 + capacity["vms"]),
+                    "vcpus": 1.0 / (1 + (capacity["vcpus"] + demand.get("vcpus", 0)) / ARCHIPEL_PLACEMENT_VCPUS_SCALE)}
+        if "memory.free" in capacity:
+            features["memory"] = max(0.0, min(1.0, (capacity["memory.free"] - demand.get("memory", 0)) / ARCHIPEL_PLACEMENT_MEMORY_SCALE))
+        if "load.one" in capacity:
+            features["load"] = 1.0 / (1 + max(0.0, capacity["load.one"]))
+        return features
+
+    def placement_score(self, capacity, demand):
+        """
+        Score an hypervisor for a virtual machine: the weighted average of
+        its placement features. Return 0.0 or None to decline.
+        @type capacity: dict
+        @param capacity: the capacity vector of the hypervisor
+        @type demand: dict
+        @param demand: the demand of the virtual machine
+        @rtype: float
+        @return: the score, between 0 and 1
+        """
+        features = self.placement_features(capacity, demand)
+        total_weight = 0.0
+        score = 0.0
+        for name, weight in self.placement_weights.iteritems():
+            if name in features:
+                score += weight * features[name]
+                total_weight += weight
+        if not total_weight:
+            return None
+        return score / total_weight
@@ -25,7 +25,7 @@ Contains L{TNArchipelCentralAgent}, the entities used for central agent.
 
 import datetime
 import random
-import sqlite3
+import time
 
 from archipelcore.archipelAvatarControllableEntity import TNAvatarControllableEntity
 from archipelcore.archipelEntity import TNArchipelEntity
@@ -35,10 +35,14 @@ from archipelcore.pubsub import TNPubSubNode
 from archipelcore.utils import build_error_iq, build_error_message
 from archipelcore import xmpp
 
+from archipelCentralDatabase import TNCentralDatabase, definition_hash, domain_name, domain_resources, to_epoch
+from archipelHypervisorsLiveness import TNHypervisorsLiveness
+
 ARCHIPEL_CENTRAL_AGENT_KEEPALIVE         = 4  #seconds please change it according to centraldb agent plugin
 ARCHIPEL_CENTRAL_AGENT_TIMEOUT           = 10 #seconds
 ARCHIPEL_CENTRAL_HYP_CHECK_FREQUENCY     = 30 #ticks
 ARCHIPEL_CENTRAL_HYP_CHECK_TIMEOUT       = 60 #seconds
+ARCHIPEL_CENTRAL_DB_FLUSH_INTERVAL       = 2  #seconds
 
 # this pubsub is subscribed by all hypervisors and carries the keepalive messages
 # for the central agent
@@ -86,6 +90,15 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         self.init_permissions()
 
 
+        # create hooks before the modules, so they can register to them
+        self.create_hook("HOOK_CENTRALAGENT_ACTIVATED")
+        self.create_hook("HOOK_CENTRALAGENT_VM_REGISTERED")
+        self.create_hook("HOOK_CENTRALAGENT_VM_UPDATED")
+        self.create_hook("HOOK_CENTRALAGENT_VM_UNREGISTERED")
+        self.create_hook("HOOK_CENTRALAGENT_HYP_REGISTERED")
+        self.create_hook("HOOK_CENTRALAGENT_HYP_UPDATED")
+        self.create_hook("HOOK_CENTRALAGENT_HYP_UNREGISTERED")
+
         # module inits
         self.initialize_modules('archipel.plugin.core')
         self.initialize_modules('archipel.plugin.centralagent')
@@ -94,12 +107,6 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         self.register_hook("HOOK_ARCHIPELENTITY_XMPP_AUTHENTICATED", method=self.hook_xmpp_authenticated)
         self.register_hook("HOOK_ARCHIPELENTITY_XMPP_AUTHENTICATED", method=self.manage_vcard_hook)
 
-        # create hooks
-        self.create_hook("HOOK_CENTRALAGENT_VM_REGISTERED")
-        self.create_hook("HOOK_CENTRALAGENT_VM_UNREGISTERED")
-        self.create_hook("HOOK_CENTRALAGENT_HYP_REGISTERED")
-        self.create_hook("HOOK_CENTRALAGENT_HYP_UNREGISTERED")
-
 
         self.central_agent_jid_val = None
 
@@ -107,8 +114,12 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         self.is_central_agent     = False
         self.salt                 = random.random()
         self.random_wait          = random.random()
-        self.database             = sqlite3.connect(self.configuration.get("CENTRALAGENT", "database"), check_same_thread=False)
-        self.database.row_factory = sqlite3.Row
+        self.database             = TNCentralDatabase(self.configuration.get("CENTRALAGENT", "database"))
+        self.last_db_flush        = datetime.datetime.now()
+        self.hypervisors_liveness = TNHypervisorsLiveness(ARCHIPEL_CENTRAL_HYP_CHECK_TIMEOUT)
+        self.db_flush_interval    = ARCHIPEL_CENTRAL_DB_FLUSH_INTERVAL
+        if self.configuration.has_option("CENTRALAGENT", "database_flush_interval"):
+            self.db_flush_interval = self.configuration.getfloat("CENTRALAGENT", "database_flush_interval")
 
         # defining the structure of the keepalive pubsub event
         self.keepalive_event      = xmpp.Node("event",attrs={"type":"keepalive","jid":self.jid})
@@ -162,6 +173,7 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
             - get_existing_vms_instances
             - register_hypervisors
             - register_vms
+            - sync_vms
             - update_vms
             - update_hypervisors
             - unregister_hypervisors
@@ -183,6 +195,8 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
             reply = self.iq_register_hypervisors(iq)
         elif action == "register_vms":
             reply = self.iq_register_vms(iq)
+        elif action == "sync_vms":
+            reply = self.iq_sync_vms(iq)
         elif action == "update_vms":
             reply = self.iq_update_vms(iq)
         elif action == "update_vms_domain":
@@ -247,6 +261,8 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         """
         self.is_central_agent = True
         self.manage_database()
+        self.hypervisors_liveness.load(self.database.execute("select jid, last_seen, status from hypervisors"))
+        self.perform_hooks("HOOK_CENTRALAGENT_ACTIVATED")
         initial_keepalive      = xmpp.Node("event",attrs={"type":"keepalive","jid":self.jid})
         initial_keepalive.setAttr("force_update","true")
         initial_keepalive.setAttr("salt",self.salt)
@@ -311,6 +327,7 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
                         self.log.debug("CENTRALAGENT: stepping down")
                         self.change_presence("away","Standby")
                         self.is_central_agent = False
+                        self.database.discard_updates()
                     else:
                         self.log.debug("CENTRALAGENT: election won")
                         return
@@ -327,9 +344,11 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         try:
             read_event = iq.getTag("query").getTag("archipel").getTag("event")
             columns = read_event.getAttr("columns")
-            where_statement = read_event.getAttr("where_statement")
+            if read_event.getAttr("where_statement"):
+                raise Exception("where_statement is not supported anymore, use the structured filters")
             reply = iq.buildReply("result")
-            entries = self.read_hypervisors(columns, where_statement)
+            jids = self.unpack_keys(iq, "jid")
+            entries = self.read_hypervisors(columns, jids, read_event.getAttr("status"))
             for entry in self.pack_entries(entries):
                 reply.addChild(node = entry)
         except Exception as ex:
@@ -345,9 +364,14 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         try:
             read_event = iq.getTag("query").getTag("archipel").getTag("event")
             columns = read_event.getAttr("columns")
-            where_statement = read_event.getAttr("where_statement")
+            if read_event.getAttr("where_statement"):
+                raise Exception("where_statement is not supported anymore, use the structured filters")
             reply = iq.buildReply("result")
-            entries = self.read_vms(columns, where_statement)
+            uuids = self.unpack_keys(iq, "uuid")
+            parked = read_event.getAttr("parked") == "true"
+            limit = read_event.getAttr("limit")
+            entries = self.read_vms(columns, uuids, read_event.getAttr("hypervisor"), parked, read_event.getAttr("order"),
+                                    limit and int(limit), int(read_event.getAttr("offset") or 0))
             for entry in self.pack_entries(entries):
                 reply.addChild(node = entry)
         except Exception as ex:
@@ -404,6 +428,24 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
             reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_CENTRALAGENT)
         return reply
 
+    def iq_sync_vms(self,iq):
+        """
+        Called when the central agent receives the definition hashes of the
+        vms of an hypervisor.
+        @type iq: xmpp.Iq
+        @param iq: received Iq
+        """
+        try:
+            read_event = iq.getTag("query").getTag("archipel").getTag("event")
+            reply = iq.buildReply("result")
+            entries = self.unpack_entries(iq)
+            entries = self.sync_vms(entries, read_event.getAttr("jid"))
+            for entry in self.pack_entries(entries):
+                reply.addChild(node = entry)
+        except Exception as ex:
+            reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_CENTRALAGENT)
+        return reply
+
     def iq_update_vms(self,iq):
         """
         Called when the central agent receives a vms update event.
@@ -480,58 +522,50 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
             reply = build_error_iq(self, ex, iq, ARCHIPEL_ERROR_CODE_CENTRALAGENT)
         return reply
 
-    def read_hypervisors(self, columns, where_statement):
+    def read_hypervisors(self, columns, jids=None, status=None):
         """
         Reads list of hypervisors in central db.
+        @type columns: string
+        @param columns: comma separated list of columns, or "*"
+        @type jids: list
+        @param jids: if set, only read these hypervisors
+        @type status: string
+        @param status: if set, only read the hypervisors with this status
+        @rtype: list
+        @return: list of dict, indexed by column
         """
-        read_statement = "select %s from hypervisors" % columns
-        if where_statement:
-            read_statement += " where %s" % where_statement
-        rows = self.database.execute(read_statement)
-        ret = []
-        for row in rows:
-            ret.append({"jid":row[0], "last_seen":row[1], "status":row[2]})
-        return ret
+        return self.database.select_hypervisors(columns, jids, status)
 
-    def read_vms(self, columns, where_statement):
+    def read_vms(self, columns, uuids=None, hypervisor=None, parked=False, order=None, limit=None, offset=0):
         """
         Read list of vms in central db.
+        @type columns: string
+        @param columns: comma separated list of columns, or "*"
+        @type uuids: list
+        @param uuids: if set, only read these vms
+        @type hypervisor: string
+        @param hypervisor: if set, only read the vms of this hypervisor
+        @type parked: Boolean
+        @param parked: if True, only read the parked vms
+        @type order: string
+        @param order: if set, the column to sort the vms by
+        @type limit: int
+        @param limit: if set, the max number of vms to read
+        @type offset: int
+        @param offset: the number of vms to skip
+        @rtype: list
+        @return: list of dict, indexed by column
         """
-        read_statement = "select %s from vms" % columns
-        if where_statement:
-            read_statement += " where %s" % where_statement
-        rows = self.database.execute(read_statement)
-        ret = []
-        for row in rows:
-            if columns == "*":
-                ret.append({"uuid":row[0], "parker":row[1], "creation_date":row[2], "domain":row[3], "hypervisor":row[4]})
-            else:
-                res = {}
-                i = 0
-                for col in columns.split(","):
-                    res[col]=row[i]
-                    i+=1
-                ret.append(res)
-        return ret
+        return self.database.select_vms(columns, uuids, hypervisor, parked, order, limit, offset)
 
     def get_existing_vms_instances(self, entries, origin_hyp):
         """
         Based on a list of vms, and an hypervisor, return list of vms which
         are defined in another, currently running, hypervisor.
         """
-        uuids = []
-        for entry in entries:
-            uuids.append(entry["uuid"])
-        read_statement = "select vms.uuid from vms join hypervisors on hypervisors.jid=vms.hypervisor where (vms.uuid='"
-        read_statement += "' or vms.uuid='".join(uuids)
-        read_statement += "') and hypervisors.jid != '%s'" % origin_hyp
-        read_statement += " and hypervisors.status='Online'"
-
+        uuids = [entry["uuid"] for entry in entries]
         self.log.debug("CENTRALAGENT: Check if vm uuids %s exist elsewhere " % uuids)
-        rows = self.database.execute(read_statement)
-        ret = []
-        for row in rows:
-            ret.append({"uuid":row[0]})
+        ret = [{"uuid": uuid} for uuid in self.database.select_vms_running_elsewhere(uuids, str(origin_hyp))]
         self.log.debug("CENTRALAGENT: We found %s on %s vms existing on others hypervistors." % (len(ret), len(uuids)))
         return ret
 
@@ -540,18 +574,8 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         Based on a list of vms, and an hypervisor, return list of vms which
         are parked (have no hypervisor, or have a hypervisor which is not online)
         """
-        uuids = []
-        for entry in entries:
-            uuids.append(entry["uuid"])
-        read_statement = "select uuid, domain from vms where uuid=('"
-        read_statement += "' or vms.uuid='".join(uuids)
-        read_statement += "') and hypervisor='None' or hypervisor not in (select jid from hypervisors where status='Online')"
         self.log.debug("CENTRALDB: Get parked vms from database")
-
-        rows = self.database.execute(read_statement)
-        ret = []
-        for row in rows:
-            ret.append({"uuid":row[0], "domain":row[1]})
+        ret = self.read_vms("uuid,domain", [entry["uuid"] for entry in entries], parked=True)
         self.log.debug("CENTRALDB: We found %s parked vms" % len(ret))
         return ret
 
@@ -561,7 +585,8 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         @type entries: List
         @param entries: list of hypervisors
         """
-        self.db_commit("insert into hypervisors values(:jid, :last_seen, :status, :stat1, :stat2, :stat3)", entries)
+        self.db_commit("insert into hypervisors values(:jid, :last_seen, :status, :stat1, :stat2, :stat3)", self.convert_last_seen(entries))
+        self.track_hypervisors(entries)
 
     def register_vms(self,entries):
         """
@@ -569,20 +594,44 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         @type entries: List
         @param entries: list of vms
         """
-        self.db_commit("insert into vms values(:uuid, :parker, :creation_date, :domain, :hypervisor)",entries)
+        # registering a vm again replaces its row, but keeps its tag
+        self.db_commit("insert into vms (uuid, parker, creation_date, domain, hypervisor, vcpus, memory, name, tag)\
+                        values(:uuid, :parker, :creation_date, :domain, :hypervisor, :vcpus, :memory, :name,\
+                        coalesce((select tag from vms where uuid=:uuid), ''))", self.add_domain_resources(entries))
+
+    def sync_vms(self, entries, hypervisor):
+        """
+        Compare the definitions of the vms of an hypervisor with the central db.
+        The vms which are up to date are assigned to the hypervisor, the
+        others must be registered again.
+        @type entries: List
+        @param entries: list of vms, with uuid and domain_hash
+        @type hypervisor: string
+        @param hypervisor: the jid of the hypervisor
+        @rtype: List
+        @return: the list of vms the hypervisor must register
+        """
+        hashes = dict([(entry["uuid"], entry.get("domain_hash")) for entry in entries])
+        up_to_date = set()
+        for vm in self.read_vms("uuid,domain", hashes.keys()):
+            if definition_hash(vm["domain"]) == hashes[vm["uuid"]]:
+                up_to_date.add(vm["uuid"])
+        if up_to_date:
+            updates = [{"uuid": uuid, "hypervisor": hypervisor} for uuid in up_to_date]
+            self.db_queue_updates("vms", updates)
+            self.perform_hooks("HOOK_CENTRALAGENT_VM_UPDATED", updates)
+        self.log.debug("CENTRALAGENT: %s has %d vms, %d are up to date" % (hypervisor, len(hashes), len(up_to_date)))
+        return [{"uuid": uuid} for uuid in hashes if not uuid in up_to_date]
 
     def update_vms(self,entries):
         """
-        Update a list of vms in central db.
+        Update a list of vms in central db. The updates are queued
+        and written by the next flush.
         @type entries: List
         @param entries: list of vms
         """
-        update_snipplets=[]
-        for key,val in entries[0].iteritems():
-            if key!="uuid":
-                update_snipplets.append("%s=:%s" % (key, key))
-        command = "update vms set %s where uuid=:uuid" % (", ".join(update_snipplets))
-        self.db_commit(command, entries)
+        self.db_queue_updates("vms", self.add_domain_resources(entries))
+        self.perform_hooks("HOOK_CENTRALAGENT_VM_UPDATED", entries)
 
     def update_vms_domain(self,entries):
         """
@@ -647,22 +696,58 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
                 results.append({"result": result, "uuid": uuid, "error": error})
 
         if len(entries_to_commit) >0 :
-            command = "update vms set domain=:domain where uuid=:uuid"
-            self.db_commit(command, entries_to_commit)
+            command = "update vms set domain=:domain, vcpus=:vcpus, memory=:memory, name=:name where uuid=:uuid"
+            self.db_commit(command, self.add_domain_resources(entries_to_commit))
+            self.perform_hooks("HOOK_CENTRALAGENT_VM_UPDATED", entries_to_commit)
         return results
 
     def update_hypervisors(self,entries):
         """
-        Update a list of hypervisors in central db.
+        Update a list of hypervisors in central db. The updates are queued
+        and written by the next flush.
+        @type entries: List
+        @param entries: list of vms
+        """
+        self.db_queue_updates("hypervisors", self.convert_last_seen(entries))
+        self.track_hypervisors(entries)
+        self.perform_hooks("HOOK_CENTRALAGENT_HYP_UPDATED", entries)
+
+    def convert_last_seen(self, entries):
+        """
+        Hypervisors send last_seen as a date string, it is stored as an epoch.
+        @type entries: List
+        @param entries: list of hypervisors
+        @rtype: List
+        @return: the entries, with last_seen converted
+        """
+        for entry in entries:
+            if entry.get("last_seen") is not None:
+                entry["last_seen"] = to_epoch(entry["last_seen"])
+        return entries
+
+    def add_domain_resources(self, entries):
+        """
+        Add the vcpus, the memory and the name read from the domain to
+        each vm whose domain is written.
         @type entries: List
         @param entries: list of vms
+        @rtype: List
+        @return: the entries, with vcpus, memory and name added
+        """
+        for entry in entries:
+            if "domain" in entry:
+                entry["vcpus"], entry["memory"] = domain_resources(entry["domain"])
+                entry["name"] = domain_name(entry["domain"])
+        return entries
+
+    def track_hypervisors(self, entries):
+        """
+        Report the written last_seen and status to the liveness tracker.
+        @type entries: List
+        @param entries: list of hypervisors
         """
-        update_snipplets=[]
-        for key,val in entries[0].iteritems():
-            if key!="jid":
-                update_snipplets.append("%s=:%s" % (key, key))
-        command = "update hypervisors set %s where jid=:jid" % (", ".join(update_snipplets))
-        self.db_commit(command, entries)
+        for entry in entries:
+            self.hypervisors_liveness.update(str(entry["jid"]), entry.get("last_seen"), entry.get("status"))
 
     def unregister_hypervisors(self,entries):
         """
@@ -671,6 +756,8 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         @param entries: list of hypervisors
         """
         self.db_commit("delete from hypervisors where jid=:jid, last_seen=:last_seen, status=:status",entries)
+        for entry in entries:
+            self.hypervisors_liveness.remove(str(entry["jid"]))
 
     def unregister_vms(self, entries):
         """
@@ -679,15 +766,10 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         @param entries: list of vms
         """
         # first, we extract jid so that the hypervisor can unregister them
-        uuids = []
-        for entry in entries:
-            uuids.append(entry["uuid"])
-        where_statement = "uuid = '"
-        where_statement += "' or uuid='".join(uuids)
-        where_statement += "'"
+        uuids = [entry["uuid"] for entry in entries]
 
         # list of vms which have been found in central db, including uuid and jid
-        cleaned_entries = self.read_vms("uuid,domain", where_statement)
+        cleaned_entries = self.read_vms("uuid,domain", uuids)
         for i in range(len(cleaned_entries)):
             domain_xml =  cleaned_entries[i]["domain"]
             if domain_xml != "None":
@@ -715,6 +797,21 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
             entries.append(entry_dict)
         return entries
 
+    def unpack_keys(self, iq, key):
+        """
+        Unpack the list of keys used to filter a read.
+        @type iq: xmpp.Iq
+        @param iq: received Iq
+        @type key: string
+        @param key: the name of the key ("uuid" or "jid")
+        @rtype: list
+        @return: the list of keys, or None if the read is not filtered
+        """
+        entries = self.unpack_entries(iq)
+        if not entries:
+            return None
+        return [entry[key] for entry in entries if key in entry]
+
     def pack_entries(self, entries):
         """
         Pack the list of entries to send to remote entity.
@@ -735,28 +832,51 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         if self.is_central_agent:
             self.log.debug("CENTRALAGENT: commit '%s' with entries %s" % (command, entries) )
             self.database.executemany(command, entries)
-            self.database.commit()
         else:
             raise Exception("CENTRALAGENT: we are not central agent")
 
+    def db_queue_updates(self, table, entries):
+        """
+        Queue updates, they will be written by the next db_flush.
+        @type table: string
+        @param table: "vms" or "hypervisors"
+        @type entries: List
+        @param entries: list of updates, including the key of the table
+        """
+        if self.is_central_agent:
+            self.database.queue_updates(table, entries)
+            if self.db_flush_interval <= 0:
+                self.db_flush()
+        else:
+            raise Exception("CENTRALAGENT: we are not central agent")
+
+    def db_flush(self):
+        """
+        Write the queued updates.
+        """
+        try:
+            count = self.database.flush_updates()
+            if count:
+                self.log.debug("CENTRALAGENT: %d rows flushed to database. counters: %s" % (count, self.database.write_counters))
+        except Exception as ex:
+            self.log.error("CENTRALAGENT: unable to flush the updates to database: %s" % str(ex))
+        self.last_db_flush = datetime.datetime.now()
+
     def check_hyps(self):
         """
         Check that hypervisors are alive.
         """
         self.log.debug("CENTRALAGENT: Checking hypervisors state")
-        now = datetime.datetime.now()
-        rows = self.database.execute("select jid,last_seen,status from hypervisors;")
+        timed_out, recovered = self.hypervisors_liveness.check(int(time.time()))
         hypervisor_to_update = []
 
-        for row in rows:
-            jid, last_seen, status = row
-            last_seen_date = datetime.datetime.strptime(last_seen, "%Y-%m-%d %H:%M:%S.%f")
-            if (now - last_seen_date).seconds > ARCHIPEL_CENTRAL_HYP_CHECK_TIMEOUT and status == "Online":
-                self.log.warning("CENTRALAGENT: Hypervisor %s timed out" % jid)
-                hypervisor_to_update.append({"jid": jid, "status": "Unreachable"})
-            elif (now - last_seen_date).seconds <= ARCHIPEL_CENTRAL_HYP_CHECK_TIMEOUT and status == "Unreachable":
-                self.log.info("CENTRALAGENT: Hypervisor %s is back up Online" % jid)
-                hypervisor_to_update.append({"jid": jid, "status": "Online"})
+        for jid in timed_out:
+            self.log.warning("CENTRALAGENT: Hypervisor %s timed out" % jid)
+            hypervisor_to_update.append({"jid": jid, "status": "Unreachable"})
+
+        for jid in recovered:
+            self.log.info("CENTRALAGENT: Hypervisor %s is back up Online" % jid)
+            hypervisor_to_update.append({"jid": jid, "status": "Online"})
 
         if hypervisor_to_update:
             self.update_hypervisors(hypervisor_to_update)
@@ -769,11 +889,11 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
         """
         Create and / or recover the parking database
         """
-        self.database.execute("create table if not exists vms (uuid text unique on conflict replace, parker string, creation_date date, domain string, hypervisor string)")
-        self.database.execute("create table if not exists hypervisors (jid text unique on conflict replace, last_seen date, status string, stat1 int, stat2 int, stat3 int)")
+        initial_version, version = self.database.upgrade_schema()
+        if not initial_version == version:
+            self.log.info("CENTRALAGENT: database schema upgraded from version %d to %d" % (initial_version, version))
         #By default on startup, put everything in the parking. Hypervisors will announce their vms.
-        self.database.execute("update vms set hypervisor='None';")
-        self.database.commit()
+        self.database.execute("update vms set hypervisor='None';", commit=True)
 
     ### Event loop
 
@@ -792,6 +912,9 @@ class TNArchipelCentralAgent (TNArchipelEntity, TNHookableEntity, TNAvatarContro
                     self.become_central_agent()
 
             elif self.is_central_agent: # we are central agent
+                if (datetime.datetime.now() - self.last_db_flush).total_seconds() >= self.db_flush_interval:
+                    self.db_flush()
+
                 if (datetime.datetime.now() - self.last_keepalive_sent).seconds >= ARCHIPEL_CENTRAL_AGENT_KEEPALIVE:
                     self.central_keepalive_pubsub.add_item(self.keepalive_event_with_date())
                     self.last_keepalive_sent = datetime.datetime.now()
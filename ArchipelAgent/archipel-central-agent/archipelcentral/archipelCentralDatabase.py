@@ -0,0 +1,516 @@
+# -*- coding: utf-8 -*-
+#
+# archipelCentralDatabase.py
+#
+# Copyright (C) 2013 Nicolas Ochem <nicolas.ochem@free.fr>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains L{TNCentralDatabase}, the access to the database of the central agent.
+
+All the queries use bound parameters. Lists of keys are passed as IN lists,
+padded to a few fixed sizes so the prepared statements can be reused from the
+sqlite statement cache, or through a temporary table when they are too long.
+
+The schema is versioned with the user_version pragma, and upgraded by
+L{TNCentralDatabase.upgrade_schema} when the agent becomes central agent.
+
+Updates of vms and hypervisors can be queued: they are merged by key, and
+written in a single transaction by L{TNCentralDatabase.flush_updates}. Any
+other access to the database flushes them first, so reads always see them.
+"""
+
+import datetime
+import hashlib
+import re
+import sqlite3
+import time
+from threading import RLock
+from xml.sax.saxutils import unescape
+
+
+# number of prepared statements kept by sqlite3
+ARCHIPEL_CENTRALDB_CACHED_STATEMENTS    = 256
+
+# sizes of the IN lists. A list of keys is padded to the next size. Longer
+# lists are stored in a temporary table and joined
+ARCHIPEL_CENTRALDB_IN_LIST_SIZES        = (1, 8, 32, 128, 512)
+
+ARCHIPEL_CENTRALDB_VMS_COLUMNS          = ("uuid", "parker", "creation_date", "domain", "hypervisor", "vcpus", "memory", "name", "tag")
+ARCHIPEL_CENTRALDB_HYPERVISORS_COLUMNS  = ("jid", "last_seen", "status", "stat1", "stat2", "stat3")
+
+# the key column and the columns of the tables accepting queued updates
+ARCHIPEL_CENTRALDB_UPDATABLE_TABLES     = {"vms": ("uuid", ARCHIPEL_CENTRALDB_VMS_COLUMNS),
+                                           "hypervisors": ("jid", ARCHIPEL_CENTRALDB_HYPERVISORS_COLUMNS)}
+
+# version of the schema created by upgrade_schema
+ARCHIPEL_CENTRALDB_SCHEMA_VERSION       = 5
+
+# name and resources read from the domain definitions, and multipliers of the memory units to KiB
+ARCHIPEL_CENTRALDB_NAME_REGEX           = re.compile(r"<name>\s*([^<]*?)\s*</name>")
+ARCHIPEL_CENTRALDB_VCPU_REGEX           = re.compile(r"<vcpu\b[^>]*>\s*(\d+)\s*</vcpu>")
+ARCHIPEL_CENTRALDB_MEMORY_REGEX         = re.compile(r"<memory\b([^>]*)>\s*(\d+)\s*</memory>")
+ARCHIPEL_CENTRALDB_MEMORY_UNIT_REGEX    = re.compile(r"unit=[\"']([a-zA-Z]+)[\"']")
+ARCHIPEL_CENTRALDB_MEMORY_UNITS         = {"b": 1.0 / 1024, "bytes": 1.0 / 1024, "k": 1, "kib": 1, "kb": 1000.0 / 1024,
+                                           "m": 1024, "mib": 1024, "mb": 1000000.0 / 1024,
+                                           "g": 1048576, "gib": 1048576, "gb": 1000000000.0 / 1024}
+
+# a vm is parked when it has no hypervisor, or when its hypervisor is not online
+ARCHIPEL_CENTRALDB_PARKED_CONDITION     = "(vms.hypervisor='None' or vms.hypervisor not in (select jid from hypervisors where status='Online'))"
+
+
+def to_epoch(value):
+    """
+    Convert a date sent by an hypervisor to an epoch.
+    @type value: string, datetime or number
+    @param value: the date, either an epoch or a local date in database format
+    @rtype: int
+    @return: the number of seconds since the epoch
+    """
+    if isinstance(value, datetime.datetime):
+        return int(time.mktime(value.timetuple()))
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        pass
+    for date_format in ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S"):
+        try:
+            return int(time.mktime(datetime.datetime.strptime(str(value), date_format).timetuple()))
+        except ValueError:
+            continue
+    raise Exception("Invalid date %s" % value)
+
+
+def definition_hash(domain):
+    """
+    Compute the hash of a domain definition, as done by the hypervisors when
+    they synchronize their vms. The whitespaces are collapsed, because XML
+    attributes values are normalized when sent over XMPP.
+    @type domain: string
+    @param domain: the domain definition
+    @rtype: string
+    @return: the hexadecimal sha1 of the definition
+    """
+    if domain is None:
+        domain = "None"
+    if isinstance(domain, unicode):
+        domain = domain.encode("utf-8")
+    return hashlib.sha1(" ".join(domain.split())).hexdigest()
+
+
+def domain_resources(domain):
+    """
+    Read the resources allocated to a domain from its definition.
+    @type domain: string
+    @param domain: the domain definition
+    @rtype: tuple
+    @return: the number of vcpus and the memory in KiB
+    """
+    vcpus = memory = 0
+    if domain:
+        match = ARCHIPEL_CENTRALDB_VCPU_REGEX.search(domain)
+        if match:
+            vcpus = int(match.group(1))
+        match = ARCHIPEL_CENTRALDB_MEMORY_REGEX.search(domain)
+        if match:
+            unit = ARCHIPEL_CENTRALDB_MEMORY_UNIT_REGEX.search(match.group(1))
+            multiplier = ARCHIPEL_CENTRALDB_MEMORY_UNITS.get(unit.group(1).lower(), 1) if unit else 1
+            memory = int(int(match.group(2)) * multiplier)
+    return (vcpus, memory)
+
+
+def domain_name(domain):
+    """
+    Read the name of a domain from its definition.
+    @type domain: string
+    @param domain: the domain definition
+    @rtype: string
+    @return: the name, or an empty string if there is none
+    """
+    if not domain:
+        return ""
+    match = ARCHIPEL_CENTRALDB_NAME_REGEX.search(domain)
+    if not match:
+        return ""
+    return unescape(match.group(1))
+
+
+class TNCentralDatabase (object):
+    """
+    This class wraps the sqlite connection of the central agent and
+    provides the queries it performs.
+    """
+
+    def __init__(self, path):
+        """
+        Open the database.
+        @type path: string
+        @param path: the path of the sqlite file
+        """
+        self.lock                   = RLock()
+        self.pending_updates        = {}
+        self.write_counters         = {"queued": 0, "coalesced": 0, "flushed": 0, "dropped": 0}
+        self.connection             = sqlite3.connect(path, check_same_thread=False, cached_statements=ARCHIPEL_CENTRALDB_CACHED_STATEMENTS)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("pragma journal_mode=WAL")
+        self.connection.execute("pragma synchronous=NORMAL")
+        self.connection.execute("create temp table if not exists query_keys (key text primary key)")
+
+    ### Raw access
+
+    def execute(self, statement, parameters=(), commit=False):
+        """
+        Execute a statement.
+        @type statement: string
+        @param statement: the sql statement
+        @type parameters: tuple or dict
+        @param parameters: the values bound to the statement
+        @type commit: Boolean
+        @param commit: if True, commit after execution
+        @rtype: list
+        @return: the rows returned by the statement
+        """
+        with self.lock:
+            self.flush_updates()
+            rows = self.connection.execute(statement, parameters).fetchall()
+            if commit:
+                self.connection.commit()
+            return rows
+
+    def executemany(self, statement, entries):
+        """
+        Execute a statement for each entry, and commit.
+        @type statement: string
+        @param statement: the sql statement
+        @type entries: list
+        @param entries: the values bound to the statement, one per execution
+        """
+        with self.lock:
+            self.flush_updates()
+            try:
+                self.connection.executemany(statement, entries)
+                self.connection.commit()
+            except:
+                self.connection.rollback()
+                raise
+
+    def commit(self):
+        """
+        Commit the current transaction.
+        """
+        with self.lock:
+            self.connection.commit()
+
+    ### Queued updates
+
+    def queue_updates(self, table, entries):
+        """
+        Queue updates of a table. The updates of the same row are merged,
+        the last value of each column wins.
+        @type table: string
+        @param table: "vms" or "hypervisors"
+        @type entries: list
+        @param entries: list of dict, indexed by column. Must contain the key column
+        """
+        key, columns = ARCHIPEL_CENTRALDB_UPDATABLE_TABLES[table]
+        for entry in entries:
+            self.check_columns(",".join(entry.keys()), columns)
+            if not key in entry:
+                raise Exception("Update of %s without %s" % (table, key))
+        with self.lock:
+            for entry in entries:
+                pending = self.pending_updates.get((table, entry[key]))
+                if pending:
+                    pending.update(entry)
+                    self.write_counters["coalesced"] += 1
+                else:
+                    self.pending_updates[(table, entry[key])] = dict(entry)
+                self.write_counters["queued"] += 1
+
+    def flush_updates(self):
+        """
+        Write the queued updates in a single transaction. If the
+        transaction fails, the updates are dropped.
+        @rtype: int
+        @return: the number of rows updated
+        """
+        with self.lock:
+            if not self.pending_updates:
+                return 0
+            pending = self.pending_updates
+            self.pending_updates = {}
+            statements = {}
+            for (table, _), entry in pending.iteritems():
+                columns = tuple(sorted(entry.keys()))
+                statements.setdefault((table, columns), []).append(entry)
+            try:
+                for (table, columns), entries in statements.iteritems():
+                    key = ARCHIPEL_CENTRALDB_UPDATABLE_TABLES[table][0]
+                    assignments = ", ".join(["%s=:%s" % (column, column) for column in columns if not column == key])
+                    if assignments:
+                        self.connection.executemany("update %s set %s where %s=:%s" % (table, assignments, key, key), entries)
+                self.connection.commit()
+            except:
+                self.connection.rollback()
+                self.write_counters["dropped"] += len(pending)
+                raise
+            self.write_counters["flushed"] += len(pending)
+            return len(pending)
+
+    def discard_updates(self):
+        """
+        Drop the queued updates.
+        """
+        with self.lock:
+            self.write_counters["dropped"] += len(self.pending_updates)
+            self.pending_updates = {}
+
+    ### Schema
+
+    def get_schema_version(self):
+        """
+        @rtype: int
+        @return: the version of the schema of the database
+        """
+        return self.execute("pragma user_version")[0][0]
+
+    def upgrade_schema(self):
+        """
+        Create the tables, or upgrade them to ARCHIPEL_CENTRALDB_SCHEMA_VERSION.
+        Each step runs in its own exclusive transaction.
+        @rtype: tuple
+        @return: the versions before and after the upgrade
+        """
+        migrations = {1: self.migrate_to_1, 2: self.migrate_to_2, 3: self.migrate_to_3, 4: self.migrate_to_4,
+                      5: self.migrate_to_5}
+        with self.lock:
+            initial_version = self.get_schema_version()
+            if initial_version > ARCHIPEL_CENTRALDB_SCHEMA_VERSION:
+                raise Exception("Database schema version %d is newer than the supported version %d" % (initial_version, ARCHIPEL_CENTRALDB_SCHEMA_VERSION))
+            self.connection.commit()
+            self.connection.isolation_level = None
+            try:
+                for version in range(initial_version + 1, ARCHIPEL_CENTRALDB_SCHEMA_VERSION + 1):
+                    self.connection.execute("begin immediate")
+                    try:
+                        # another central agent may have upgraded the shared database meanwhile
+                        if self.get_schema_version() < version:
+                            migrations[version]()
+                            self.connection.execute("pragma user_version=%d" % version)
+                        self.connection.execute("commit")
+                    except:
+                        self.connection.execute("rollback")
+                        raise
+            finally:
+                self.connection.isolation_level = ""
+            return (initial_version, self.get_schema_version())
+
+    def migrate_to_1(self):
+        """
+        Create the original tables.
+        """
+        self.connection.execute("create table if not exists vms (uuid text unique on conflict replace, parker string, creation_date date, domain string, hypervisor string)")
+        self.connection.execute("create table if not exists hypervisors (jid text unique on conflict replace, last_seen date, status string, stat1 int, stat2 int, stat3 int)")
+
+    def migrate_to_2(self):
+        """
+        Store last_seen as an epoch, and index the columns used to find
+        the parked vms and the online hypervisors.
+        """
+        self.connection.execute("create table hypervisors_v2 (jid text unique on conflict replace, last_seen integer, status string, stat1 int, stat2 int, stat3 int)")
+        # previous versions stored the local time as text
+        self.connection.execute("insert into hypervisors_v2 select jid, coalesce(cast(strftime('%s', last_seen, 'utc') as integer), 0),\
+                                 status, stat1, stat2, stat3 from hypervisors")
+        self.connection.execute("drop table hypervisors")
+        self.connection.execute("alter table hypervisors_v2 rename to hypervisors")
+        self.connection.execute("create index if not exists hypervisors_status on hypervisors (status, last_seen)")
+        self.connection.execute("create index if not exists vms_hypervisor on vms (hypervisor)")
+
+    def migrate_to_3(self):
+        """
+        Store the vcpus and the memory of the vms, read from their definitions.
+        """
+        self.connection.execute("alter table vms add column vcpus integer default 0")
+        self.connection.execute("alter table vms add column memory integer default 0")
+        resources = []
+        for uuid, domain in self.connection.execute("select uuid, domain from vms").fetchall():
+            vcpus, memory = domain_resources(domain)
+            resources.append({"uuid": uuid, "vcpus": vcpus, "memory": memory})
+        self.connection.executemany("update vms set vcpus=:vcpus, memory=:memory where uuid=:uuid", resources)
+
+    def migrate_to_4(self):
+        """
+        Store the names of the vms, read from their definitions, so the
+        vms can be listed in order and by page.
+        """
+        self.connection.execute("alter table vms add column name string default ''")
+        names = [{"uuid": uuid, "name": domain_name(domain)} for uuid, domain in self.connection.execute("select uuid, domain from vms").fetchall()]
+        self.connection.executemany("update vms set name=:name where uuid=:uuid", names)
+        self.connection.execute("create index if not exists vms_name on vms (name, uuid)")
+
+    def migrate_to_5(self):
+        """
+        Store the anti-affinity tag of the vms, given when they are placed.
+        """
+        self.connection.execute("alter table vms add column tag string default ''")
+        self.connection.execute("create index if not exists vms_tag on vms (tag)")
+
+    ### Query helpers
+
+    def check_columns(self, columns, allowed):
+        """
+        Check a list of columns requested by a remote entity.
+        @type columns: string
+        @param columns: comma separated list of columns, or "*"
+        @type allowed: tuple
+        @param allowed: the columns of the table
+        @rtype: list
+        @return: the list of columns
+        """
+        if not columns or columns.strip() == "*":
+            return list(allowed)
+        ret = []
+        for column in columns.split(","):
+            column = column.strip()
+            if not column in allowed:
+                raise Exception("Unknown column %s" % column)
+            ret.append(column)
+        return ret
+
+    def select(self, statement, parameters=None, keys=None):
+        """
+        Execute a select statement. If keys is given, the statement must
+        contain a %(keys)s placeholder, replaced by something that can
+        follow an IN operator.
+        @type statement: string
+        @param statement: the sql statement, with named parameters
+        @type parameters: dict
+        @param parameters: the values bound to the statement
+        @type keys: list
+        @param keys: the keys to look for
+        @rtype: list
+        @return: the rows returned by the statement
+        """
+        parameters = dict(parameters or {})
+        if keys is None:
+            return self.execute(statement, parameters)
+
+        keys = list(set(keys))
+        if not keys:
+            return []
+
+        with self.lock:
+            self.flush_updates()
+            if len(keys) > ARCHIPEL_CENTRALDB_IN_LIST_SIZES[-1]:
+                try:
+                    self.connection.executemany("insert or ignore into temp.query_keys values (?)", [(key,) for key in keys])
+                    return self.connection.execute(statement % {"keys": "(select key from temp.query_keys)"}, parameters).fetchall()
+                finally:
+                    self.connection.execute("delete from temp.query_keys")
+                    self.connection.commit()
+
+            size = [size for size in ARCHIPEL_CENTRALDB_IN_LIST_SIZES if size >= len(keys)][0]
+            keys.extend([keys[-1]] * (size - len(keys)))
+            for i in range(size):
+                parameters["key%d" % i] = keys[i]
+            placeholders = ", ".join([":key%d" % i for i in range(size)])
+            return self.connection.execute(statement % {"keys": "(%s)" % placeholders}, parameters).fetchall()
+
+    ### Queries
+
+    def select_vms(self, columns=None, uuids=None, hypervisor=None, parked=False, order=None, limit=None, offset=0):
+        """
+        Read vms.
+        @type columns: string
+        @param columns: comma separated list of columns, or "*"
+        @type uuids: list
+        @param uuids: if set, only read these vms
+        @type hypervisor: string
+        @param hypervisor: if set, only read the vms of this hypervisor
+        @type parked: Boolean
+        @param parked: if True, only read the parked vms
+        @type order: string
+        @param order: if set, the column to sort the vms by. Ties are sorted by uuid
+        @type limit: int
+        @param limit: if set, the max number of vms to read
+        @type offset: int
+        @param offset: the number of vms to skip
+        @rtype: list
+        @return: list of dict, indexed by column
+        """
+        columns = self.check_columns(columns, ARCHIPEL_CENTRALDB_VMS_COLUMNS)
+        conditions = []
+        parameters = {}
+        if uuids is not None:
+            conditions.append("vms.uuid in %(keys)s")
+        if hypervisor:
+            conditions.append("vms.hypervisor=:hypervisor")
+            parameters["hypervisor"] = hypervisor
+        if parked:
+            conditions.append(ARCHIPEL_CENTRALDB_PARKED_CONDITION)
+        statement = "select %s from vms" % ", ".join(["vms.%s" % column for column in columns])
+        if conditions:
+            statement += " where %s" % " and ".join(conditions)
+        if order:
+            statement += " order by vms.%s, vms.uuid" % self.check_columns(order, ARCHIPEL_CENTRALDB_VMS_COLUMNS)[0]
+        if limit is not None or offset:
+            statement += " limit :limit offset :offset"
+            parameters["limit"] = -1 if limit is None else int(limit)
+            parameters["offset"] = int(offset or 0)
+        rows = self.select(statement, parameters, uuids)
+        return [dict(zip(columns, row)) for row in rows]
+
+    def select_hypervisors(self, columns=None, jids=None, status=None):
+        """
+        Read hypervisors.
+        @type columns: string
+        @param columns: comma separated list of columns, or "*"
+        @type jids: list
+        @param jids: if set, only read these hypervisors
+        @type status: string
+        @param status: if set, only read the hypervisors with this status
+        @rtype: list
+        @return: list of dict, indexed by column
+        """
+        columns = self.check_columns(columns, ARCHIPEL_CENTRALDB_HYPERVISORS_COLUMNS)
+        conditions = []
+        parameters = {}
+        if jids is not None:
+            conditions.append("jid in %(keys)s")
+        if status:
+            conditions.append("status=:status")
+            parameters["status"] = status
+        statement = "select %s from hypervisors" % ", ".join(columns)
+        if conditions:
+            statement += " where %s" % " and ".join(conditions)
+        rows = self.select(statement, parameters, jids)
+        return [dict(zip(columns, row)) for row in rows]
+
+    def select_vms_running_elsewhere(self, uuids, hypervisor):
+        """
+        Read the vms running on an online hypervisor other than the given one.
+        @type uuids: list
+        @param uuids: the uuids of the vms
+        @type hypervisor: string
+        @param hypervisor: the jid of the hypervisor to ignore
+        @rtype: list
+        @return: the uuids of the vms
+        """
+        rows = self.select("select vms.uuid from vms join hypervisors on hypervisors.jid=vms.hypervisor\
+                            where vms.uuid in %(keys)s and hypervisors.jid!=:hypervisor and hypervisors.status='Online'",
+                           {"hypervisor": hypervisor}, uuids)
+        return [row[0] for row in rows]
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+#
+# archipelHypervisorsLiveness.py
+#
+# Copyright (C) 2013 Nicolas Ochem <nicolas.ochem@free.fr>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains L{TNHypervisorsLiveness}, that tracks when hypervisors time out
+or come back online.
+
+The online hypervisors are kept in a heap ordered by deadline. A keepalive
+only updates the last_seen of the hypervisor: when its deadline expires,
+the entry is pushed again with the new deadline if the hypervisor has been
+seen meanwhile. A check only looks at the expired deadlines and at the
+unreachable hypervisors that have been seen since the previous check.
+"""
+
+import heapq
+
+
+class TNHypervisorsLiveness (object):
+    """
+    This class tracks the last_seen and the status of the hypervisors.
+    """
+
+    def __init__(self, timeout):
+        """
+        Initialize the tracker.
+        @type timeout: int
+        @param timeout: the number of seconds after which a silent hypervisor is unreachable
+        """
+        self.timeout    = timeout
+        self.last_seen  = {}
+        self.status     = {}
+        self.deadlines  = []
+        self.scheduled  = set()
+        self.recovered  = set()
+
+    def schedule(self, jid):
+        """
+        Push the deadline of an online hypervisor, if not already done.
+        @type jid: string
+        @param jid: the jid of the hypervisor
+        """
+        if not jid in self.scheduled:
+            heapq.heappush(self.deadlines, (self.last_seen.get(jid, 0) + self.timeout, jid))
+            self.scheduled.add(jid)
+
+    def load(self, rows):
+        """
+        Replace the tracked hypervisors.
+        @type rows: list
+        @param rows: list of (jid, last_seen, status)
+        """
+        self.last_seen  = {}
+        self.status     = {}
+        self.deadlines  = []
+        self.scheduled  = set()
+        self.recovered  = set()
+        for jid, last_seen, status in rows:
+            self.update(jid, last_seen, status)
+
+    def update(self, jid, last_seen=None, status=None):
+        """
+        Record a change written in the hypervisors table.
+        @type jid: string
+        @param jid: the jid of the hypervisor
+        @type last_seen: int
+        @param last_seen: if set, the new last_seen, as an epoch
+        @type status: string
+        @param status: if set, the new status
+        """
+        if last_seen is not None:
+            self.last_seen[jid] = int(last_seen)
+        if status is not None:
+            self.status[jid] = status
+        if self.status.get(jid) == "Online":
+            self.recovered.discard(jid)
+            self.schedule(jid)
+        elif self.status.get(jid) == "Unreachable" and last_seen is not None:
+            self.recovered.add(jid)
+
+    def remove(self, jid):
+        """
+        Stop tracking an hypervisor. Its heap entry is dropped when it expires.
+        @type jid: string
+        @param jid: the jid of the hypervisor
+        """
+        self.last_seen.pop(jid, None)
+        self.status.pop(jid, None)
+        self.recovered.discard(jid)
+
+    def check(self, now):
+        """
+        Find the hypervisors which changed of state, and record their new status.
+        @type now: int
+        @param now: the current time, as an epoch
+        @rtype: tuple
+        @return: the list of timed out jids, and the list of recovered jids
+        """
+        timed_out = []
+        while self.deadlines and self.deadlines[0][0] < now:
+            deadline, jid = heapq.heappop(self.deadlines)
+            self.scheduled.discard(jid)
+            if not self.status.get(jid) == "Online":
+                continue
+            if self.last_seen.get(jid, 0) + self.timeout >= now:
+                self.schedule(jid)
+            else:
+                self.status[jid] = "Unreachable"
+                timed_out.append(jid)
+
+        recovered = []
+        for jid in self.recovered:
+            if self.status.get(jid) == "Unreachable" and self.last_seen.get(jid, 0) + self.timeout >= now:
+                self.status[jid] = "Online"
+                self.schedule(jid)
+                recovered.append(jid)
+        self.recovered = set()
+
+        return (timed_out, recovered)
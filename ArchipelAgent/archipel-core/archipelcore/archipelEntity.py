@@ -106,6 +106,8 @@ class TNArchipelEntity (object):
         self.xmppstatus             = None
         self.xmppstatusshow         = None
         self.xmppclient             = None
+        self.xmpp_multiplexer       = None
+        self.xmpp_reactor           = None
         self.vCard                  = None
         self.password               = password
         self.jid                    = jid
@@ -323,7 +325,10 @@ class TNArchipelEntity (object):
         debug_mode = []
         if self.configuration.has_option("LOGGING", "xmpppy_debug") and self.configuration.getboolean("LOGGING", "xmpppy_debug"):
             debug_mode = ['always', 'nodebuilder']
-        self.xmppclient = xmpp.Client(self.jid.getDomain(), debug=debug_mode) #debug=['dispatcher', 'nodebuilder', 'protocol'])
+        if self.xmpp_multiplexer:
+            self.xmppclient = self.xmpp_multiplexer.create_client(self)
+        else:
+            self.xmppclient = xmpp.Client(self.jid.getDomain(), debug=debug_mode) #debug=['dispatcher', 'nodebuilder', 'protocol'])
         if self.xmppclient.connect() == "":
             if self.auto_reconnect:
                 self.loop_status = ARCHIPEL_XMPP_LOOP_RESTART
@@ -378,6 +383,9 @@ class TNArchipelEntity (object):
             self.isAuth = False
             self.loop_status = ARCHIPEL_XMPP_LOOP_OFF
             self.perform_hooks("HOOK_ARCHIPELENTITY_XMPP_DISCONNECTED")
+            # multiplexed entities have no loop that will close the connection
+            if self.xmpp_multiplexer:
+                self.xmppclient.disconnect()
         else:
             self.log.warning("Trying to disconnect, but not connected. Ignoring.")
 
@@ -391,14 +399,14 @@ class TNArchipelEntity (object):
 
     def recover_pubsubs(self, origin, user_info, arguments):
         """
-        Create or get the current hypervisor pubsub node.
+        Create or get the current hypervisor pubsub node. On reconnection,
+        the existing nodes are kept and their items are retrieved again.
         Arguments here are used to be HOOK compliant see @register_hook
         """
         TNTaggableEntity.recover_pubsubs(self, origin, user_info, arguments)
         # creating/getting the event pubsub node
         eventNodeName = "/archipel/" + self.jid.getStripped() + "/events"
-        self.pubSubNodeEvent = archipelcore.pubsub.TNPubSubNode(self.xmppclient, self.pubsubserver, eventNodeName)
-        if not self.pubSubNodeEvent.recover(wait=True):
+        if not self.recover_pubsub_node("pubSubNodeEvent", eventNodeName):
             self.pubSubNodeEvent.create(wait=True)
         self.pubSubNodeEvent.configure({
             archipelcore.pubsub.XMPP_PUBSUB_VAR_ACCESS_MODEL: archipelcore.pubsub.XMPP_PUBSUB_VAR_ACCESS_MODEL_OPEN,
@@ -410,8 +418,7 @@ class TNArchipelEntity (object):
         }, wait=True)
         # creating/getting the log pubsub node
         logNodeName = "/archipel/" + self.jid.getStripped() + "/logs"
-        self.pubSubNodeLog = archipelcore.pubsub.TNPubSubNode(self.xmppclient, self.pubsubserver, logNodeName)
-        if not self.pubSubNodeLog.recover(wait=True):
+        if not self.recover_pubsub_node("pubSubNodeLog", logNodeName):
             self.pubSubNodeLog.create(wait=True)
         self.pubSubNodeLog.configure({
                 archipelcore.pubsub.XMPP_PUBSUB_VAR_ACCESS_MODEL: archipelcore.pubsub.XMPP_PUBSUB_VAR_ACCESS_MODEL_OPEN,
@@ -426,8 +433,7 @@ class TNArchipelEntity (object):
         # Recovering eventual admin account pubsub node
         ## get the admins in pubsub
         adminNodeName = "/archipel/adminaccounts"
-        self.pubSubNodeAdmins = archipelcore.pubsub.TNPubSubNode(self.xmppclient, self.pubsubserver, adminNodeName)
-        if self.pubSubNodeAdmins.recover(wait=True):
+        if self.recover_pubsub_node("pubSubNodeAdmins", adminNodeName):
             admins = self.pubSubNodeAdmins.get_items()
             for admin in admins:
                 admin_node = admin.getTag("admin")
@@ -440,6 +446,25 @@ class TNArchipelEntity (object):
             self.log.warning("Unable to find pubsub node %s for getting additional admin accounts. Using only static ones" % adminNodeName)
         self.log.debug("Here is the final admin list: %s" % self.permission_center.admins())
 
+    def recover_pubsub_node(self, attribute, nodename):
+        """
+        Get a pubsub node of the entity. If the node has already been
+        recovered before a reconnection, it is kept and its items are
+        retrieved again on the new connection.
+        @type attribute: string
+        @param attribute: the name of the attribute holding the node
+        @type nodename: string
+        @param nodename: the name of the node
+        @rtype: Boolean
+        @return: True if the node exists on the server
+        """
+        node = getattr(self, attribute)
+        if node:
+            return node.reconnect(self.xmppclient)
+        node = archipelcore.pubsub.TNPubSubNode(self.xmppclient, self.pubsubserver, nodename)
+        setattr(self, attribute, node)
+        return node.recover(wait=True)
+
     def remove_pubsubs(self):
         """
         Delete own entity pubsubs.
@@ -951,6 +976,9 @@ class TNArchipelEntity (object):
         Do a in-band unregistration.
         """
         self.loop_status = ARCHIPEL_XMPP_LOOP_REMOVE_USER
+        # multiplexed entities have no loop that will process the unregistration
+        if self.xmpp_multiplexer:
+            self.process_inband_unregistration()
 
     def process_inband_unregistration(self):
         """
@@ -960,6 +988,13 @@ class TNArchipelEntity (object):
         self.is_unregistering = True
         self.remove_pubsubs()
         self.unregister_handlers()
+        if self.xmpp_multiplexer:
+            self.log.info("Multiplexed entity has no account. Removing roster, vCard and detaching.")
+            self.xmpp_multiplexer.delete_roster(self.jid.getStripped())
+            self.xmpp_multiplexer.delete_vcard(self.jid.getStripped())
+            self.xmppclient.disconnect()
+            self.loop_status = ARCHIPEL_XMPP_LOOP_OFF
+            return
         self.log.info("Trying to unregister.")
         iq = (xmpp.Iq(typ='set', to=self.jid.getDomain()))
         iq.setQueryNS("jabber:iq:register")
@@ -1237,7 +1272,15 @@ class TNArchipelEntity (object):
     def loop(self):
         """
         This is the main loop of the client.
+        If the entity uses a reactor, it is registered in it and the loop
+        returns immediately (except for the reactor owner, that runs it).
         """
+        if self.xmpp_reactor:
+            self.xmpp_reactor.register(self)
+            if self.xmpp_reactor.owner == self:
+                self.xmpp_reactor.run()
+            return
+
         while not self.loop_status == ARCHIPEL_XMPP_LOOP_OFF:
             try:
                 if self.loop_status == ARCHIPEL_XMPP_LOOP_REMOVE_USER:
@@ -20,6 +20,8 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import threading
+
 from sqlalchemy import Table, Column, Integer, String, ForeignKey, create_engine
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
@@ -27,6 +29,7 @@ from sqlalchemy.orm import sessionmaker, relationship, backref
 from sqlalchemy.orm.exc import NoResultFound
 
 Base = declarative_base()
+SharedBase = declarative_base()
 
 
 users_have_permissions = Table('users_have_permissions', Base.metadata,
@@ -78,6 +81,8 @@ class TNArchipelPermissionCenter:
         self.engine = None
         self.metadata = None
         self.session = None
+        self.index_lock = threading.RLock()
+        self.reset_index()
 
     def start(self, database_file=None, root_admins={}):
         """
@@ -93,6 +98,7 @@ class TNArchipelPermissionCenter:
         self.metadata = Base.metadata
         self.metadata.create_all(self.engine)
         self.session = sessionmaker(bind=self.engine)
+        self.reset_index()
 
     def create_session(self):
         """
@@ -130,6 +136,76 @@ class TNArchipelPermissionCenter:
         """
         return self.root_admins
 
+    ### Permission index
+
+    def reset_index(self):
+        """
+        Forget the in-memory permission index. It will be reloaded on next check.
+        """
+        with self.index_lock:
+            self.index_loaded = False
+            self.index_defaults = {}
+            self.index_users = {}
+
+    def load_index(self):
+        """
+        Load all permissions and users permissions in memory, in one session.
+        The index contains the default value of each permission and the set
+        of permission names of each user.
+        """
+        with self.index_lock:
+            if self.index_loaded:
+                return
+            session = self.create_session()
+            defaults = {}
+            users = {}
+            for perm in session.query(TNArchipelPermission).all():
+                defaults[perm.name] = perm.defaultValue
+            for user in session.query(TNArchipelUser).all():
+                users[user.name] = set([perm.name for perm in user.permissions])
+            session.close()
+            self.index_defaults = defaults
+            self.index_users = users
+            self.index_loaded = True
+
+    def update_index(self, user_name=None, permission_name=None, granted=None, default_value=None, deleted=False):
+        """
+        Update the index after a change in the database. Does nothing if
+        the index is not loaded yet.
+        @type user_name: string
+        @param user_name: the name of the changed user
+        @type permission_name: string
+        @param permission_name: the name of the changed permission
+        @type granted: Boolean
+        @param granted: if set, the permission has been granted (True) or revoked (False) to the user
+        @type default_value: Boolean
+        @param default_value: the default value of a created permission
+        @type deleted: Boolean
+        @param deleted: if True, the user or permission has been deleted
+        """
+        with self.index_lock:
+            if not self.index_loaded:
+                return
+            if user_name and not permission_name:
+                if deleted:
+                    self.index_users.pop(user_name, None)
+                else:
+                    self.index_users.setdefault(user_name, set())
+            elif permission_name and not user_name:
+                if deleted:
+                    self.index_defaults.pop(permission_name, None)
+                    for perms in self.index_users.values():
+                        perms.discard(permission_name)
+                else:
+                    self.index_defaults[permission_name] = default_value
+            elif user_name and permission_name:
+                perms = self.index_users.setdefault(user_name, set())
+                if granted:
+                    perms.add(permission_name)
+                else:
+                    perms.discard(permission_name)
+
+
     ### Permission management
 
     def create_permission(self, name, description="", default_permission=False, currentsession=None):
@@ -151,10 +227,35 @@ class TNArchipelPermissionCenter:
             session.add(p)
             session.commit()
             if not currentsession: session.close()
+            self.update_index(permission_name=name, default_value=int(default_permission))
             return True
         except IntegrityError:
             return False
 
+    def create_permissions(self, definitions, currentsession=None):
+        """
+        Create several permissions in one transaction. Existing ones are ignored.
+        @type definitions: list
+        @param definitions: list of tuples (name, description, default_permission)
+        @rtype: int
+        @return: the number of created permissions
+        """
+        if currentsession: session = currentsession
+        else: session = self.create_session()
+        existing = set([p.name for p in session.query(TNArchipelPermission).all()])
+        created = []
+        for name, description, default_permission in definitions:
+            if name in existing:
+                continue
+            existing.add(name)
+            session.add(TNArchipelPermission(name, description, default_permission))
+            created.append((name, default_permission))
+        session.commit()
+        if not currentsession: session.close()
+        for name, default_permission in created:
+            self.update_index(permission_name=name, default_value=int(default_permission))
+        return len(created)
+
     def get_permission(self, name, currentsession=None):
         """
         Get the permission by name.
@@ -187,6 +288,7 @@ class TNArchipelPermissionCenter:
             session.delete(p)
             session.commit()
             if not currentsession: session.close()
+            self.update_index(permission_name=name, deleted=True)
             return True
         except NoResultFound:
             return False
@@ -220,6 +322,7 @@ class TNArchipelPermissionCenter:
             session.add(u)
             session.commit()
             if not currentsession: session.close()
+            self.update_index(user_name=name)
             return u
         except IntegrityError:
             return None
@@ -256,6 +359,7 @@ class TNArchipelPermissionCenter:
             session.delete(u)
             session.commit()
             if not currentsession: session.close()
+            self.update_index(user_name=name, deleted=True)
             return True
         except NoResultFound:
             return False
@@ -280,6 +384,8 @@ class TNArchipelPermissionCenter:
             u.permissions.append(p)
             session.commit()
         if not currentsession: session.close()
+        if p:
+            self.update_index(user_name=user_name, permission_name=permission_name, granted=True)
         return True
 
     def revoke_permission_to_user(self, permission_name, user_name, currentsession=None):
@@ -303,6 +409,7 @@ class TNArchipelPermissionCenter:
         u.permissions.remove(p)
         session.commit()
         if not currentsession: session.close()
+        self.update_index(user_name=user_name, permission_name=permission_name, granted=False)
         return True
 
     def user_has_permission(self, user_name, permission_name, currentsession=None):
@@ -357,25 +464,12 @@ class TNArchipelPermissionCenter:
         @rtype: Boolean
         @return: True in case of success
         """
-        permObject = self.get_permission(permission_name)
-        if user_name in self.root_admins.values():
-            return True
-        if self.user_has_permission(user_name, "all"):
-            return True
-        if not self.get_user(user_name):
-            if permObject and permObject.defaultValue == 1:
-                return True
-            else:
-                return False
-        if not permObject:
-            return False
-        if self.user_has_permission(user_name, permission_name):
-            return True
-        return False
+        return self.check_permissions(user_name, (permission_name,))
 
     def check_permissions(self, user_name, permissions):
         """
         Check if all permissions on array are granted.
+        This only uses the in-memory index.
         @type user_name: string
         @param user_name: the name of the user
         @type permissions: array of string
@@ -383,10 +477,19 @@ class TNArchipelPermissionCenter:
         @rtype: Boolean
         @return: True in case of success
         """
-        for perm in permissions:
-            if not self.check_permission(user_name, perm):
-                return False
-        return True
+        if user_name in self.root_admins.values():
+            return True
+        if not self.index_loaded:
+            self.load_index()
+        user_permissions = self.index_users.get(user_name, None)
+        if user_permissions is None:
+            for perm in permissions:
+                if not self.index_defaults.get(perm, None) == 1:
+                    return False
+            return True
+        if "all" in user_permissions:
+            return True
+        return user_permissions.issuperset(permissions)
 
     def close_database(self):
         """
@@ -394,5 +497,466 @@ class TNArchipelPermissionCenter:
         """
         self.session.close_all()
         self.engine.dispose()
+        self.reset_index()
         del self.session
-        del self.engine
\ No newline at end of file
+        del self.engine
+
+
+### Shared permission store
+
+class TNArchipelSharedPermission (SharedBase):
+    __tablename__ = 'shared_permissions'
+
+    name = Column(String, primary_key=True)
+    description = Column(String)
+    defaultValue = Column(Integer)
+
+    def __init__(self, name, description, default_value):
+        self.name = name
+        self.description = description
+        self.defaultValue = default_value
+
+class TNArchipelSharedUser (SharedBase):
+    __tablename__ = 'shared_users'
+
+    entity = Column(String, primary_key=True)
+    name = Column(String, primary_key=True)
+
+    def __init__(self, entity, name):
+        self.entity = entity
+        self.name = name
+
+class TNArchipelSharedGrant (SharedBase):
+    __tablename__ = 'shared_grants'
+
+    entity = Column(String, primary_key=True, index=True)
+    user = Column(String, primary_key=True)
+    permission = Column(String, primary_key=True)
+
+    def __init__(self, entity, user, permission):
+        self.entity = entity
+        self.user = user
+        self.permission = permission
+
+
+class TNArchipelPermissionStore:
+    """
+    One database and one engine storing the permissions of a lot of entities
+    (for example all the virtual machines of a hypervisor), keyed by entity JID.
+    Permission definitions are shared by all entities. Everything is kept in memory,
+    so the database is only used for writes.
+    """
+
+    def __init__(self, database_file):
+        """
+        Initialize the store.
+        @type database_file: string
+        @param database_file: the path to the db file
+        """
+        self.database_file = database_file
+        self.engine = None
+        self.session = None
+        self.lock = threading.RLock()
+        self.definitions = {}
+        self.pending_definitions = []
+        self.entities = {}
+
+    def start(self):
+        """
+        Open the database and load it in memory.
+        """
+        self.engine = create_engine('sqlite:///%s' % self.database_file)
+        SharedBase.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)
+        session = self.session()
+        for perm in session.query(TNArchipelSharedPermission).all():
+            self.definitions[perm.name] = (perm.description, perm.defaultValue)
+        for user in session.query(TNArchipelSharedUser).all():
+            self.entities.setdefault(user.entity, {})[user.name] = set()
+        for grant in session.query(TNArchipelSharedGrant).all():
+            self.entities.setdefault(grant.entity, {}).setdefault(grant.user, set()).add(grant.permission)
+        session.close()
+
+    def close(self):
+        """
+        Close the database.
+        """
+        self.flush_definitions()
+        self.session.close_all()
+        self.engine.dispose()
+
+    ### Definitions
+
+    def define_permission(self, name, description, default_permission):
+        """
+        Add a permission definition. It will be written with the next
+        flush_definitions(), in one transaction with the other pending ones.
+        @type name: string
+        @param name: the name of the permission
+        @type description: string
+        @param description: the description of the permission
+        @type default_permission: Boolean
+        @param default_permission: the default value of permission if not set
+        @rtype: Boolean
+        @return: True if the permission was not defined yet
+        """
+        with self.lock:
+            if name in self.definitions:
+                return False
+            self.definitions[name] = (description, int(default_permission))
+            self.pending_definitions.append(name)
+            return True
+
+    def flush_definitions(self):
+        """
+        Write all pending permission definitions in one transaction.
+        """
+        with self.lock:
+            if not self.pending_definitions:
+                return
+            session = self.session()
+            for name in self.pending_definitions:
+                description, default_value = self.definitions[name]
+                session.merge(TNArchipelSharedPermission(name, description, default_value))
+            session.commit()
+            session.close()
+            self.pending_definitions = []
+
+    def delete_definition(self, name):
+        """
+        Delete a permission definition, and all grants of this permission.
+        @type name: string
+        @param name: the name of the permission
+        @rtype: Boolean
+        @return: True in case of success
+        """
+        with self.lock:
+            if not name in self.definitions:
+                return False
+            self.flush_definitions()
+            session = self.session()
+            session.query(TNArchipelSharedPermission).filter(TNArchipelSharedPermission.name == name).delete()
+            session.query(TNArchipelSharedGrant).filter(TNArchipelSharedGrant.permission == name).delete()
+            session.commit()
+            session.close()
+            del self.definitions[name]
+            for users in self.entities.values():
+                for perms in users.values():
+                    perms.discard(name)
+            return True
+
+    ### Entities
+
+    def has_entity(self, entity):
+        """
+        @type entity: string
+        @param entity: the bare JID of the entity
+        @rtype: Boolean
+        @return: True if the store contains users for the entity
+        """
+        return entity in self.entities
+
+    def users(self, entity):
+        """
+        @type entity: string
+        @param entity: the bare JID of the entity
+        @rtype: dict
+        @return: the users of the entity and their set of permissions
+        """
+        return self.entities.get(entity, {})
+
+    def create_user(self, entity, name):
+        """
+        Create a user for an entity.
+        @rtype: Boolean
+        @return: False if the user already exists
+        """
+        with self.lock:
+            users = self.entities.setdefault(entity, {})
+            if name in users:
+                return False
+            session = self.session()
+            session.add(TNArchipelSharedUser(entity, name))
+            session.commit()
+            session.close()
+            users[name] = set()
+            return True
+
+    def delete_user(self, entity, name):
+        """
+        Delete a user of an entity, and its grants.
+        @rtype: Boolean
+        @return: False if the user doesn't exist
+        """
+        with self.lock:
+            users = self.entities.get(entity, {})
+            if not name in users:
+                return False
+            session = self.session()
+            session.query(TNArchipelSharedUser).filter(TNArchipelSharedUser.entity == entity).filter(TNArchipelSharedUser.name == name).delete()
+            session.query(TNArchipelSharedGrant).filter(TNArchipelSharedGrant.entity == entity).filter(TNArchipelSharedGrant.user == name).delete()
+            session.commit()
+            session.close()
+            del users[name]
+            return True
+
+    def grant(self, entity, permission_name, user_name):
+        """
+        Grant a permission to a user of an entity. The user is created if needed.
+        @rtype: Boolean
+        @return: False if the permission doesn't exist
+        """
+        with self.lock:
+            if not permission_name in self.definitions:
+                return False
+            self.create_user(entity, user_name)
+            perms = self.entities[entity][user_name]
+            if permission_name in perms:
+                return True
+            self.flush_definitions()
+            session = self.session()
+            session.add(TNArchipelSharedGrant(entity, user_name, permission_name))
+            session.commit()
+            session.close()
+            perms.add(permission_name)
+            return True
+
+    def revoke(self, entity, permission_name, user_name):
+        """
+        Revoke a permission of a user of an entity.
+        @rtype: Boolean
+        @return: True
+        """
+        with self.lock:
+            perms = self.entities.get(entity, {}).get(user_name, None)
+            if perms is None or not permission_name in perms:
+                return True
+            session = self.session()
+            session.query(TNArchipelSharedGrant).filter(TNArchipelSharedGrant.entity == entity)\
+                                                .filter(TNArchipelSharedGrant.user == user_name)\
+                                                .filter(TNArchipelSharedGrant.permission == permission_name).delete()
+            session.commit()
+            session.close()
+            perms.discard(permission_name)
+            return True
+
+    def delete_entity(self, entity):
+        """
+        Remove all users and grants of an entity.
+        @type entity: string
+        @param entity: the bare JID of the entity
+        """
+        with self.lock:
+            session = self.session()
+            session.query(TNArchipelSharedUser).filter(TNArchipelSharedUser.entity == entity).delete()
+            session.query(TNArchipelSharedGrant).filter(TNArchipelSharedGrant.entity == entity).delete()
+            session.commit()
+            session.close()
+            self.entities.pop(entity, None)
+
+    ### Import / export of per-entity databases
+
+    def import_database(self, entity, database_file):
+        """
+        Import a per-entity permission database (as used by TNArchipelPermissionCenter)
+        in the store. Definitions and grants are merged with existing ones, and
+        written in one transaction.
+        @type entity: string
+        @param entity: the bare JID of the entity
+        @type database_file: string
+        @param database_file: the path of the per-entity database
+        @rtype: int
+        @return: the number of imported grants
+        """
+        legacy = TNArchipelPermissionCenter(database_file=database_file)
+        legacy.start()
+        session = legacy.create_session()
+        with self.lock:
+            for perm in session.query(TNArchipelPermission).all():
+                self.define_permission(perm.name, perm.description, perm.defaultValue)
+            self.flush_definitions()
+            users = self.entities.get(entity, {})
+            new_users = set()
+            new_grants = []
+            count = 0
+            for user in session.query(TNArchipelUser).all():
+                if not user.name in users:
+                    new_users.add(user.name)
+                for perm in user.permissions:
+                    count += 1
+                    if not perm.name in users.get(user.name, set()):
+                        new_grants.append((user.name, perm.name))
+            store_session = self.session()
+            for user_name in new_users:
+                store_session.add(TNArchipelSharedUser(entity, user_name))
+            for user_name, permission_name in new_grants:
+                store_session.add(TNArchipelSharedGrant(entity, user_name, permission_name))
+            store_session.commit()
+            store_session.close()
+            users = self.entities.setdefault(entity, {})
+            for user_name in new_users:
+                users[user_name] = set()
+            for user_name, permission_name in new_grants:
+                users[user_name].add(permission_name)
+        session.close()
+        legacy.close_database()
+        return count
+
+    def export_database(self, entity, database_file):
+        """
+        Write the permissions of an entity in a per-entity database, so it can
+        be used by a hypervisor without shared store (after a migration for example).
+        The users and the grants of the database which are not in the store
+        anymore are removed, so a revoked permission is not imported again.
+        @type entity: string
+        @param entity: the bare JID of the entity
+        @type database_file: string
+        @param database_file: the path of the per-entity database
+        """
+        legacy = TNArchipelPermissionCenter(database_file=database_file)
+        legacy.start()
+        session = legacy.create_session()
+        with self.lock:
+            legacy.create_permissions([(name, description, default_value) for name, (description, default_value) in self.definitions.items()], currentsession=session)
+            permissions = dict([(perm.name, perm) for perm in session.query(TNArchipelPermission).all()])
+            users = self.users(entity)
+            existing = {}
+            for user in session.query(TNArchipelUser).all():
+                if user.name in users:
+                    existing[user.name] = user
+                else:
+                    session.delete(user)
+            for user_name, perms in users.items():
+                user = existing.get(user_name)
+                if not user:
+                    user = TNArchipelUser(user_name)
+                    session.add(user)
+                user.permissions = [permissions[perm] for perm in perms if perm in permissions]
+            session.commit()
+        session.close()
+        legacy.close_database()
+
+
+class TNArchipelEntityPermissionCenter (TNArchipelPermissionCenter):
+    """
+    A TNArchipelPermissionCenter reading and writing permissions of one entity
+    in a shared L{TNArchipelPermissionStore}. It has the same API.
+    """
+
+    def __init__(self, store, entity, root_admins={}):
+        """
+        Initialize the permission center.
+        @type store: L{TNArchipelPermissionStore}
+        @param store: the shared store
+        @type entity: string
+        @param entity: the bare JID of the entity
+        @type root_admins: array
+        @param root_admins: the root users JID
+        """
+        TNArchipelPermissionCenter.__init__(self, database_file=store.database_file, root_admins=root_admins)
+        self.store = store
+        self.entity = entity
+
+    def start(self, database_file=None, root_admins={}):
+        """
+        The store is started by its owner. Only update the root admins.
+        """
+        if len(root_admins) > 0:
+            self.root_admins = root_admins
+
+    def close_database(self):
+        """
+        Write pending definitions. The store is closed by its owner.
+        """
+        self.store.flush_definitions()
+
+    def delete_entity(self):
+        """
+        Remove all the permissions of the entity from the store.
+        """
+        self.store.delete_entity(self.entity)
+
+    ### Index (the store is already in memory)
+
+    def load_index(self):
+        pass
+
+    def update_index(self, user_name=None, permission_name=None, granted=None, default_value=None, deleted=False):
+        pass
+
+    ### Permission management
+
+    def create_permission(self, name, description="", default_permission=False, currentsession=None):
+        return self.store.define_permission(name, description, default_permission)
+
+    def create_permissions(self, definitions, currentsession=None):
+        count = 0
+        for name, description, default_permission in definitions:
+            if self.store.define_permission(name, description, default_permission):
+                count += 1
+        self.store.flush_definitions()
+        return count
+
+    def get_permission(self, name, currentsession=None):
+        if not name in self.store.definitions:
+            return None
+        description, default_value = self.store.definitions[name]
+        return TNArchipelPermission(name, description, default_value)
+
+    def delete_permission(self, name, currentsession=None):
+        return self.store.delete_definition(name)
+
+    def get_permissions(self, currentsession=None):
+        return [self.get_permission(name) for name in self.store.definitions.keys()]
+
+    ### Users management
+
+    def create_user(self, name, currentsession=None):
+        if not self.store.create_user(self.entity, name):
+            return None
+        return TNArchipelUser(name)
+
+    def get_user(self, name, currentsession=None):
+        if not name in self.store.users(self.entity):
+            return None
+        return TNArchipelUser(name)
+
+    def delete_user(self, name, currentsession=None):
+        return self.store.delete_user(self.entity, name)
+
+    def grant_permission_to_user(self, permission_name, user_name, currentsession=None):
+        self.store.grant(self.entity, permission_name, user_name)
+        return True
+
+    def revoke_permission_to_user(self, permission_name, user_name, currentsession=None):
+        return self.store.revoke(self.entity, permission_name, user_name)
+
+    def user_has_permission(self, user_name, permission_name, currentsession=None):
+        return permission_name in self.store.users(self.entity).get(user_name, ())
+
+    def get_user_permissions(self, user_name, currentsession=None):
+        return [self.get_permission(name) for name in self.store.users(self.entity).get(user_name, ())]
+
+    ### User permissions verification
+
+    def check_permissions(self, user_name, permissions):
+        """
+        Check if all permissions on array are granted, using the store.
+        @type user_name: string
+        @param user_name: the name of the user
+        @type permissions: array of string
+        @param permissions: list permissions names
+        @rtype: Boolean
+        @return: True in case of success
+        """
+        if user_name in self.root_admins.values():
+            return True
+        user_permissions = self.store.users(self.entity).get(user_name, None)
+        if user_permissions is None:
+            for perm in permissions:
+                if not perm in self.store.definitions or not self.store.definitions[perm][1] == 1:
+                    return False
+            return True
+        if "all" in user_permissions:
+            return True
+        return user_permissions.issuperset(permissions)
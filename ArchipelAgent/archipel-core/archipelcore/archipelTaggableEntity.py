@@ -90,13 +90,18 @@ class TNTaggableEntity (object):
 
     def recover_pubsubs(self, origin, user_info, arguments):
         """
-        Get the global tag pubsub node.
+        Get the global tag pubsub node. On reconnection, the existing node
+        is kept and its items are retrieved again.
         Arguments here are used to be HOOK compliant see register_hook of L{TNHookableEntity}
         """
         # getting the tags pubsub node
         tagsNodeName = "/archipel/tags"
-        self.pubSubNodeTags = TNPubSubNode(self.xmppclient, self.pubsubserver, tagsNodeName)
-        if not self.pubSubNodeTags.recover(wait=True):
+        if self.pubSubNodeTags:
+            recovered = self.pubSubNodeTags.reconnect(self.xmppclient)
+        else:
+            self.pubSubNodeTags = TNPubSubNode(self.xmppclient, self.pubsubserver, tagsNodeName)
+            recovered = self.pubSubNodeTags.recover(wait=True)
+        if not recovered:
             Exception("The pubsub node /archipel/tags must have been created. You can use archipel-tagnode tool to create it.")
 
     def init_permissions(self):
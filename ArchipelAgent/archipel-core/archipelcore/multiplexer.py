@@ -0,0 +1,870 @@
+# -*- coding: utf-8 -*-
+#
+# multiplexer.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains TNXMPPMultiplexer, that allows a lot of entities to share a
+single XMPP connection.
+
+The multiplexer opens one XEP-0114 component connection for a given domain,
+and gives to each attached entity a TNMultiplexedClient. This object exposes
+the subset of the xmpp.Client API used by Archipel entities, so handlers
+registered by the entities and their plugins work unchanged. Incoming stanzas
+are routed to the right client according to the bare JID they are sent to.
+
+As the XMPP server doesn't store anything for component JIDs, the rosters and
+the vCards of the entities are stored by the multiplexer, and the vCard IQs
+are answered by the multiplexer itself.
+"""
+
+import sqlite3
+import threading
+import time
+import xmpp
+
+from archipelcore.utils import log
+
+
+# default timeout of SendAndWaitForResponse (same as xmpppy)
+ARCHIPEL_MULTIPLEXER_DEFAULT_TIMEOUT    = 25
+
+# number of seconds before retrying to connect the component
+ARCHIPEL_MULTIPLEXER_RECONNECT_DELAY    = 5
+
+# namespace of the vCards stored by the multiplexer
+ARCHIPEL_MULTIPLEXER_NS_VCARD           = "vcard-temp"
+
+
+class TNMultiplexedRoster (object):
+    """
+    A roster stored by the multiplexer. As the XMPP server doesn't handle
+    rosters of component JIDs, we need to keep track of the subscriptions
+    ourselves. It implements the subset of the xmpp.roster.Roster API used
+    by Archipel.
+    """
+
+    def __init__(self, client):
+        """
+        Initialize the roster.
+        @type client: L{TNMultiplexedClient}
+        @param client: the client owning this roster
+        """
+        self.client     = client
+        self.owner      = client.jid.getStripped()
+        self.items      = {}
+        for jid, subscription, name in client.multiplexer.load_roster(self.owner):
+            self.items[jid] = {"subscription": subscription, "name": name, "resources": {}}
+
+    def _item(self, jid):
+        """
+        Return the item for given jid, creating it if needed.
+        @type jid: string or xmpp.JID
+        @param jid: the JID
+        @rtype: dict
+        @return: the roster item
+        """
+        jid = xmpp.JID(jid).getStripped()
+        if not jid in self.items:
+            self.items[jid] = {"subscription": "none", "name": None, "resources": {}}
+        return self.items[jid]
+
+    def _save(self, jid):
+        """
+        Save the given item in the multiplexer database.
+        @type jid: string or xmpp.JID
+        @param jid: the JID
+        """
+        jid = xmpp.JID(jid).getStripped()
+        item = self.items.get(jid)
+        if item:
+            self.client.multiplexer.save_roster_item(self.owner, jid, item["subscription"], item["name"])
+        else:
+            self.client.multiplexer.delete_roster_item(self.owner, jid)
+
+    def _send_presence(self, jid, typ):
+        """
+        Send a presence with given type to given JID.
+        @type jid: string or xmpp.JID
+        @param jid: the JID
+        @type typ: string
+        @param typ: the type of presence
+        """
+        self.client.send(xmpp.Presence(to=xmpp.JID(jid).getStripped(), typ=typ))
+
+    def getItems(self):
+        """
+        @rtype: list
+        @return: the list of bare JIDs in the roster
+        """
+        return self.items.keys()
+
+    def getResources(self, jid):
+        """
+        @type jid: string
+        @param jid: the JID
+        @rtype: list
+        @return: the list of the available resources of the JID
+        """
+        jid = xmpp.JID(jid).getStripped()
+        if not jid in self.items:
+            return []
+        return self.items[jid]["resources"].keys()
+
+    def getSubscription(self, jid):
+        """
+        @type jid: string
+        @param jid: the JID
+        @rtype: string
+        @return: the subscription of the JID (none, to, from or both)
+        """
+        return self.items[xmpp.JID(jid).getStripped()]["subscription"]
+
+    def setItem(self, jid, name=None, groups=[]):
+        """
+        Add or update an item.
+        @type jid: string
+        @param jid: the JID
+        @type name: string
+        @param name: the name of the item
+        @type groups: list
+        @param groups: ignored, groups are not stored
+        """
+        self._item(jid)["name"] = name
+        self._save(jid)
+
+    def delItem(self, jid):
+        """
+        Remove an item and cancel the subscriptions.
+        @type jid: string
+        @param jid: the JID
+        """
+        jid = xmpp.JID(jid).getStripped()
+        if jid in self.items:
+            self._send_presence(jid, "unsubscribe")
+            self._send_presence(jid, "unsubscribed")
+            del self.items[jid]
+            self._save(jid)
+
+    def Authorize(self, jid):
+        """
+        Authorize given JID to see our presence.
+        @type jid: string
+        @param jid: the JID
+        """
+        item = self._item(jid)
+        self._send_presence(jid, "subscribed")
+        if item["subscription"] in ("none", "from"):
+            item["subscription"] = "from"
+        else:
+            item["subscription"] = "both"
+        self._save(jid)
+        self.client.send_current_presence(xmpp.JID(jid).getStripped())
+
+    def Unauthorize(self, jid):
+        """
+        Forbid given JID to see our presence.
+        @type jid: string
+        @param jid: the JID
+        """
+        item = self._item(jid)
+        self._send_presence(jid, "unsubscribed")
+        if item["subscription"] in ("to", "both"):
+            item["subscription"] = "to"
+        else:
+            item["subscription"] = "none"
+        self._save(jid)
+
+    def Subscribe(self, jid):
+        """
+        Ask given JID to see its presence.
+        @type jid: string
+        @param jid: the JID
+        """
+        self._item(jid)
+        self._send_presence(jid, "subscribe")
+        self._save(jid)
+
+    def Unsubscribe(self, jid):
+        """
+        Stop receiving the presence of given JID.
+        @type jid: string
+        @param jid: the JID
+        """
+        item = self._item(jid)
+        self._send_presence(jid, "unsubscribe")
+        if item["subscription"] in ("from", "both"):
+            item["subscription"] = "from"
+        else:
+            item["subscription"] = "none"
+        self._save(jid)
+
+    def subscribers(self):
+        """
+        @rtype: list
+        @return: the list of bare JIDs allowed to see our presence
+        """
+        return [jid for jid, item in self.items.iteritems() if item["subscription"] in ("from", "both")]
+
+    def process_presence(self, presence):
+        """
+        Update the roster according to an incoming presence. This doesn't
+        consume the stanza, entity handlers will receive it too.
+        @type presence: xmpp.Presence
+        @param presence: the received presence
+        """
+        jid = presence.getFrom()
+        barejid = jid.getStripped()
+        typ = presence.getType()
+        if typ == "probe":
+            if barejid in self.subscribers():
+                self.client.send_current_presence(jid)
+            return
+        if not barejid in self.items:
+            return
+        item = self.items[barejid]
+        if typ == "subscribed":
+            item["subscription"] = "both" if item["subscription"] in ("from", "both") else "to"
+            self._save(barejid)
+        elif typ == "unsubscribed":
+            item["subscription"] = "from" if item["subscription"] in ("from", "both") else "none"
+            item["resources"] = {}
+            self._save(barejid)
+        elif typ == "unavailable":
+            item["resources"].pop(jid.getResource(), None)
+        elif not typ:
+            item["resources"][jid.getResource()] = presence.getShow()
+
+
+class TNMultiplexedClient (object):
+    """
+    The connection given to an entity attached to a L{TNXMPPMultiplexer}.
+    It behaves like a xmpp.Client, but sends everything through the shared
+    component connection, with the entity's JID as sender.
+    """
+
+    def __init__(self, multiplexer, entity):
+        """
+        Initialize the client.
+        @type multiplexer: L{TNXMPPMultiplexer}
+        @param multiplexer: the multiplexer to use
+        @type entity: L{TNArchipelEntity}
+        @param entity: the entity owning this client
+        """
+        self.multiplexer            = multiplexer
+        self.entity                 = entity
+        self.jid                    = entity.jid
+        self.handlers               = []
+        self.disconnect_handlers    = []
+        self.connected              = False
+        self.current_presence       = None
+        self.roster                 = None
+
+    ### xmpp.Client API
+
+    def connect(self):
+        """
+        Attach the client to the multiplexer.
+        @rtype: string
+        @return: "component" in case of success, "" otherwise (as xmpp.Client)
+        """
+        if not self.multiplexer.wait_connected(ARCHIPEL_MULTIPLEXER_DEFAULT_TIMEOUT):
+            return ""
+        self.multiplexer.attach_client(self)
+        self.connected = True
+        return "component"
+
+    def auth(self, user, password, resource=""):
+        """
+        There is no authentication for component JIDs: the multiplexer
+        is authenticated once for all.
+        @rtype: string
+        @return: "component"
+        """
+        if not self.connected:
+            return None
+        self.roster = TNMultiplexedRoster(self)
+        return "component"
+
+    def isConnected(self):
+        """
+        @rtype: Boolean
+        @return: True if the client is attached and the component connected
+        """
+        return self.connected and self.multiplexer.isConnected()
+
+    def disconnect(self):
+        """
+        Detach the client from the multiplexer. The disconnect handlers
+        are not called, as this is a voluntary disconnection.
+        """
+        if not self.connected:
+            return
+        if self.multiplexer.isConnected():
+            self.send(xmpp.Presence(typ="unavailable"))
+        self.connected = False
+        self.multiplexer.detach_client(self)
+
+    def disconnected(self):
+        """
+        Called when the component connection is lost.
+        """
+        self.connected = False
+        for handler in self.disconnect_handlers:
+            handler()
+
+    def getRoster(self):
+        """
+        @rtype: L{TNMultiplexedRoster}
+        @return: the roster of the entity
+        """
+        return self.roster
+
+    def RegisterHandler(self, name, handler, typ="", ns="", xmlns=None, makefirst=0, system=0):
+        """
+        Register a stanza handler (same semantic as xmpp.Client).
+        """
+        item = {"name": name, "func": handler, "typ": typ, "ns": ns}
+        if makefirst:
+            self.handlers.insert(0, item)
+        else:
+            self.handlers.append(item)
+
+    def UnregisterHandler(self, name, handler, typ="", ns="", xmlns=None):
+        """
+        Unregister a stanza handler (same semantic as xmpp.Client).
+        """
+        for item in self.handlers:
+            if item["name"] == name and item["func"] == handler and item["typ"] == typ and item["ns"] == ns:
+                self.handlers.remove(item)
+                return
+
+    def RegisterDisconnectHandler(self, handler):
+        """
+        Register a method called when the connection is lost.
+        """
+        self.disconnect_handlers.append(handler)
+
+    def UnregisterDisconnectHandler(self, handler):
+        """
+        Unregister a method called when the connection is lost.
+        """
+        if handler in self.disconnect_handlers:
+            self.disconnect_handlers.remove(handler)
+
+    def send(self, stanza):
+        """
+        Send a stanza with the entity's JID as sender.
+        Presences without recipient are broadcasted to subscribers.
+        @type stanza: xmpp.Node
+        @param stanza: the stanza to send
+        """
+        self._stamp(stanza)
+        if self._own_vcard_iq(stanza):
+            self.process_vcard(stanza)
+            return stanza.getID()
+        if stanza.getName() == "presence" and not stanza.getTo() and not stanza.getType() in ("subscribe", "subscribed", "unsubscribe", "unsubscribed"):
+            if not stanza.getType():
+                self.current_presence = stanza
+            self._broadcast(stanza)
+            return stanza.getID()
+        return self.multiplexer.send(stanza)
+
+    def SendAndCallForResponse(self, stanza, func=None, args={}):
+        """
+        Send a stanza and call func with the response.
+        Presences doesn't have any response, so func is called with None
+        right after the broadcast (xmpp.Client would never call it).
+        """
+        self._stamp(stanza)
+        if stanza.getName() == "presence" and not stanza.getTo():
+            self.send(stanza)
+            if func:
+                func(self, None, **args)
+            return
+        if self._own_vcard_iq(stanza):
+            response = self.process_vcard(stanza)
+            if func:
+                func(self, response, **args)
+            return
+        return self.multiplexer.send_and_call(stanza, func, args)
+
+    def SendAndWaitForResponse(self, stanza, timeout=None):
+        """
+        Send a stanza and wait for the response.
+        @rtype: xmpp.Node
+        @return: the response or None in case of timeout
+        """
+        self._stamp(stanza)
+        if self._own_vcard_iq(stanza):
+            return self.process_vcard(stanza)
+        return self.multiplexer.send_and_wait(stanza, timeout)
+
+    def Process(self, timeout=0):
+        """
+        Stanzas are read by the multiplexer thread. We just wait here.
+        """
+        time.sleep(timeout)
+        return "0"
+
+    ### Multiplexing
+
+    def _stamp(self, stanza):
+        """
+        Set the sender of a stanza. As for a client, an IQ without recipient
+        is addressed to the entity's own bare JID.
+        @type stanza: xmpp.Node
+        @param stanza: the stanza to stamp
+        """
+        if not stanza.getFrom():
+            stanza.setFrom(self.jid)
+        if stanza.getName() == "iq" and not stanza.getTo():
+            stanza.setTo(self.jid.getStripped())
+        if not stanza.getID() and stanza.getName() == "iq":
+            stanza.setID(self.multiplexer.next_id())
+
+    def _own_vcard_iq(self, stanza):
+        """
+        @type stanza: xmpp.Node
+        @param stanza: the stanza to send
+        @rtype: Boolean
+        @return: True if the stanza is a vCard IQ sent by the entity to itself
+        """
+        if stanza.getName() != "iq" or not stanza.getType() in ("get", "set"):
+            return False
+        if stanza.getTo().getStripped().lower() != self.jid.getStripped().lower():
+            return False
+        return ARCHIPEL_MULTIPLEXER_NS_VCARD in stanza.getProperties()
+
+    def process_vcard(self, iq):
+        """
+        Answer a vCard IQ with the vCard stored by the multiplexer. Anybody
+        can get the vCard, only the entity itself can set it.
+        @type iq: xmpp.Iq
+        @param iq: the vCard IQ, sent to the entity
+        @rtype: xmpp.Iq
+        @return: the response
+        """
+        owner = self.jid.getStripped()
+        if iq.getType() == "set":
+            if iq.getFrom().getStripped().lower() != owner.lower():
+                return xmpp.Error(iq, xmpp.ERR_FORBIDDEN)
+            self.multiplexer.save_vcard(owner, str(iq.getTag("vCard")))
+            return iq.buildReply("result")
+        response = iq.buildReply("result")
+        data = self.multiplexer.load_vcard(owner)
+        if data:
+            response.addChild(node=xmpp.simplexml.NodeBuilder(data=data).getDom())
+        else:
+            response.addChild(name="vCard", namespace=ARCHIPEL_MULTIPLEXER_NS_VCARD)
+        return response
+
+    def _broadcast(self, presence):
+        """
+        Send a presence to all subscribers.
+        @type presence: xmpp.Presence
+        @param presence: the presence to broadcast
+        """
+        if not self.roster:
+            return
+        for jid in self.roster.subscribers():
+            pres = xmpp.Presence(node=presence)
+            pres.setTo(jid)
+            self.multiplexer.send(pres)
+
+    def send_current_presence(self, jid):
+        """
+        Send the current presence to given JID.
+        @type jid: string or xmpp.JID
+        @param jid: the recipient
+        """
+        if not self.current_presence:
+            return
+        pres = xmpp.Presence(node=self.current_presence)
+        pres.setTo(jid)
+        self.multiplexer.send(pres)
+
+    def dispatch(self, stanza):
+        """
+        Run the handlers matching the given stanza, as xmpp.Dispatcher does.
+        @type stanza: xmpp.Node
+        @param stanza: the received stanza
+        @rtype: Boolean
+        @return: True if a handler processed the stanza
+        """
+        name = stanza.getName()
+        typ = stanza.getType() or ""
+        props = stanza.getProperties()
+        if name == "presence" and self.roster:
+            self.roster.process_presence(stanza)
+        if name == "iq" and typ in ("get", "set") and ARCHIPEL_MULTIPLEXER_NS_VCARD in props:
+            self.multiplexer.send(self.process_vcard(stanza))
+            return True
+        for item in list(self.handlers):
+            if item["name"] != name:
+                continue
+            if item["typ"] and item["typ"] != typ:
+                continue
+            if item["ns"] and not item["ns"] in props:
+                continue
+            try:
+                item["func"](self, stanza)
+            except xmpp.protocol.NodeProcessed:
+                return True
+        return False
+
+
+class TNXMPPMultiplexer (threading.Thread):
+    """
+    This class owns a XMPP component connection and routes the stanzas
+    to the attached entities.
+    """
+
+    def __init__(self, domain, secret, server, port=5347, database_file=None, debug=False):
+        """
+        Initialize the multiplexer.
+        @type domain: string
+        @param domain: the component domain. Entities JIDs must be on this domain
+        @type secret: string
+        @param secret: the component secret
+        @type server: string
+        @param server: the address of the XMPP server
+        @type port: int
+        @param port: the port of component listener of the XMPP server
+        @type database_file: string
+        @param database_file: the sqlite3 file used to store rosters and vCards (None to keep them in memory)
+        @type debug: Boolean
+        @param debug: if True, xmpppy will be in debug mode
+        """
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.domain         = domain.lower()
+        self.secret         = secret
+        self.server         = server
+        self.port           = port
+        self.debug          = debug
+        self.connection     = None
+        self.clients        = {}
+        self.entities       = {}
+        self.running        = False
+        self.connected      = threading.Event()
+        self.lock           = threading.RLock()
+        self.id_counter     = 0
+        self.database       = sqlite3.connect(database_file or ":memory:", check_same_thread=False)
+        self.database.execute("create table if not exists rosters (owner text, jid text, subscription text, name text)")
+        self.database.execute("create table if not exists vcards (owner text unique on conflict replace, data text)")
+        self.database.commit()
+
+    ### Entities
+
+    def can_serve(self, jid):
+        """
+        @type jid: xmpp.JID
+        @param jid: the JID to check
+        @rtype: Boolean
+        @return: True if the JID is handled by this multiplexer
+        """
+        return jid.getDomain().lower() == self.domain
+
+    def create_client(self, entity):
+        """
+        Create a new client for given entity. The entity will be reconnected
+        by the multiplexer if the component connection is restarted.
+        @type entity: L{TNArchipelEntity}
+        @param entity: the entity
+        @rtype: L{TNMultiplexedClient}
+        @return: the client to use as xmppclient
+        """
+        self.entities[entity.jid.getStripped().lower()] = entity
+        return TNMultiplexedClient(self, entity)
+
+    def attach_client(self, client):
+        """
+        Start routing stanzas to given client.
+        @type client: L{TNMultiplexedClient}
+        @param client: the client
+        """
+        self.clients[client.jid.getStripped().lower()] = client
+        log.debug("MULTIPLEXER: entity %s attached" % client.jid)
+
+    def detach_client(self, client):
+        """
+        Stop routing stanzas to given client and forget its entity.
+        @type client: L{TNMultiplexedClient}
+        @param client: the client
+        """
+        barejid = client.jid.getStripped().lower()
+        if self.clients.get(barejid) == client:
+            del self.clients[barejid]
+        if barejid in self.entities and self.entities[barejid].xmppclient == client:
+            del self.entities[barejid]
+        log.debug("MULTIPLEXER: entity %s detached" % client.jid)
+
+    ### Rosters
+
+    def load_roster(self, owner):
+        """
+        @type owner: string
+        @param owner: the bare JID of the roster owner
+        @rtype: list
+        @return: list of (jid, subscription, name)
+        """
+        with self.lock:
+            return self.database.execute("select jid, subscription, name from rosters where owner=?", (owner,)).fetchall()
+
+    def save_roster_item(self, owner, jid, subscription, name):
+        """
+        Save a roster item.
+        """
+        with self.lock:
+            self.database.execute("delete from rosters where owner=? and jid=?", (owner, jid))
+            self.database.execute("insert into rosters values(?,?,?,?)", (owner, jid, subscription, name))
+            self.database.commit()
+
+    def delete_roster_item(self, owner, jid):
+        """
+        Delete a roster item.
+        """
+        with self.lock:
+            self.database.execute("delete from rosters where owner=? and jid=?", (owner, jid))
+            self.database.commit()
+
+    def delete_roster(self, owner):
+        """
+        Delete the whole roster of an entity.
+        @type owner: string
+        @param owner: the bare JID of the roster owner
+        """
+        with self.lock:
+            self.database.execute("delete from rosters where owner=?", (owner,))
+            self.database.commit()
+
+    ### vCards
+
+    def load_vcard(self, owner):
+        """
+        @type owner: string
+        @param owner: the bare JID of the vCard owner
+        @rtype: string
+        @return: the stored vCard, or None
+        """
+        with self.lock:
+            row = self.database.execute("select data from vcards where owner=?", (owner,)).fetchone()
+        return row and row[0] or None
+
+    def save_vcard(self, owner, data):
+        """
+        Save the vCard of an entity.
+        @type owner: string
+        @param owner: the bare JID of the vCard owner
+        @type data: string
+        @param data: the vCard node
+        """
+        with self.lock:
+            self.database.execute("insert into vcards values(?,?)", (owner, data))
+            self.database.commit()
+
+    def delete_vcard(self, owner):
+        """
+        Delete the vCard of an entity.
+        @type owner: string
+        @param owner: the bare JID of the vCard owner
+        """
+        with self.lock:
+            self.database.execute("delete from vcards where owner=?", (owner,))
+            self.database.commit()
+
+    ### Connection
+
+    def isConnected(self):
+        """
+        @rtype: Boolean
+        @return: True if the component is connected and authenticated
+        """
+        return self.connected.isSet()
+
+    def wait_connected(self, timeout):
+        """
+        Wait for the component to be connected.
+        @type timeout: int
+        @param timeout: max number of seconds to wait
+        @rtype: Boolean
+        @return: True if connected
+        """
+        self.connected.wait(timeout)
+        return self.connected.isSet()
+
+    def connect(self):
+        """
+        Connect and authenticate the component.
+        @rtype: Boolean
+        @return: True in case of success
+        """
+        debug_mode = []
+        if self.debug:
+            debug_mode = ['always', 'nodebuilder']
+        self.connection = xmpp.Component(self.domain, self.port, debug=debug_mode)
+        if self.connection.connect(server=(self.server, self.port)) == "":
+            log.warning("MULTIPLEXER: unable to connect to %s:%s" % (self.server, self.port))
+            return False
+        if not self.connection.auth(self.domain, self.secret):
+            log.error("MULTIPLEXER: unable to authenticate component %s. Check the secret" % self.domain)
+            return False
+        for name in ("iq", "message", "presence"):
+            self.connection.RegisterHandler(name, self.route)
+        self.connection.RegisterDisconnectHandler(self.on_disconnect)
+        self.connected.set()
+        log.info("MULTIPLEXER: component %s connected to %s:%s" % (self.domain, self.server, self.port))
+        return True
+
+    def on_disconnect(self):
+        """
+        Called when the component connection is lost.
+        """
+        if not self.isConnected():
+            return
+        log.warning("MULTIPLEXER: component %s has been disconnected" % self.domain)
+        self.connected.clear()
+        for client in self.clients.values():
+            client.disconnected()
+        self.clients = {}
+
+    def reconnect_entities(self):
+        """
+        Reconnect the entities that lost their connection.
+        """
+        for entity in self.entities.values():
+            if not entity.xmppclient or not entity.xmppclient.isConnected():
+                try:
+                    entity.connect()
+                except Exception as ex:
+                    log.error("MULTIPLEXER: unable to reconnect entity %s: %s" % (entity.jid, str(ex)))
+
+    def stop(self):
+        """
+        Stop the multiplexer loop.
+        """
+        self.running = False
+
+    def run(self):
+        """
+        The main loop: read stanzas from the component connection and route them.
+        """
+        self.running = True
+        while self.running:
+            try:
+                if not self.isConnected():
+                    if not self.connect():
+                        time.sleep(ARCHIPEL_MULTIPLEXER_RECONNECT_DELAY)
+                        continue
+                    self.reconnect_entities()
+                self.connection.Process(3)
+            except Exception as ex:
+                log.error("MULTIPLEXER: error in main loop: %s. Reconnecting in %s seconds" % (str(ex), ARCHIPEL_MULTIPLEXER_RECONNECT_DELAY))
+                self.on_disconnect()
+                time.sleep(ARCHIPEL_MULTIPLEXER_RECONNECT_DELAY)
+        if self.connection and self.connection.isConnected():
+            self.connection.disconnect()
+
+    ### Stanzas
+
+    def next_id(self):
+        """
+        @rtype: string
+        @return: a new unique stanza ID
+        """
+        with self.lock:
+            self.id_counter += 1
+            return "mux%d" % self.id_counter
+
+    def send(self, stanza):
+        """
+        Send a stanza through the component connection.
+        @type stanza: xmpp.Node
+        @param stanza: the stanza to send
+        """
+        with self.lock:
+            return self.connection.send(stanza)
+
+    def send_and_call(self, stanza, func, args={}):
+        """
+        Send a stanza and call func when the response is received.
+        @type stanza: xmpp.Node
+        @param stanza: the stanza to send
+        @type func: function
+        @param func: the callback
+        @type args: dict
+        @param args: extra arguments of the callback
+        """
+        client = self.clients.get(stanza.getFrom().getStripped().lower())
+        def on_response(conn, response, **kwargs):
+            func(client or conn, response, **kwargs)
+        with self.lock:
+            return self.connection.SendAndCallForResponse(stanza, on_response if func else None, args)
+
+    def send_and_wait(self, stanza, timeout=None):
+        """
+        Send a stanza and wait for the response. If called from the
+        multiplexer thread, the connection is processed inline, as
+        xmpp.Client does. Otherwise we wait for the multiplexer thread to
+        receive the response.
+        @type stanza: xmpp.Node
+        @param stanza: the stanza to send
+        @type timeout: int
+        @param timeout: max number of seconds to wait
+        @rtype: xmpp.Node
+        @return: the response, or None on timeout
+        """
+        if timeout is None:
+            timeout = ARCHIPEL_MULTIPLEXER_DEFAULT_TIMEOUT
+        if threading.currentThread() == self:
+            return self.connection.SendAndWaitForResponse(stanza, timeout)
+        response = {}
+        received = threading.Event()
+        def on_response(conn, resp):
+            response["stanza"] = resp
+            received.set()
+        self.send_and_call(stanza, on_response)
+        received.wait(timeout)
+        return response.get("stanza", None)
+
+    def route(self, conn, stanza):
+        """
+        Route an incoming stanza to the client of its recipient.
+        @type conn: xmpp.Dispatcher
+        @param conn: the component connection
+        @type stanza: xmpp.Node
+        @param stanza: the received stanza
+        """
+        to = stanza.getTo()
+        client = None
+        if to:
+            client = self.clients.get(to.getStripped().lower())
+        if not client:
+            if stanza.getName() == "iq" and stanza.getType() in ("get", "set"):
+                conn.send(xmpp.Error(stanza, xmpp.ERR_SERVICE_UNAVAILABLE))
+            raise xmpp.protocol.NodeProcessed
+        try:
+            processed = client.dispatch(stanza)
+        except Exception as ex:
+            log.error("MULTIPLEXER: error while dispatching stanza to %s: %s" % (to, str(ex)))
+            processed = False
+        if not processed and stanza.getName() == "iq" and stanza.getType() in ("get", "set"):
+            conn.send(xmpp.Error(stanza, xmpp.ERR_FEATURE_NOT_IMPLEMENTED))
+        raise xmpp.protocol.NodeProcessed
@@ -22,6 +22,8 @@
 import types
 import xmpp
 
+from collections import OrderedDict
+from threading import RLock
 from uuid import uuid1 as uuid
 
 XMPP_PUBSUB_VAR_TITLE                                       = "pubsub#title"
@@ -63,10 +65,13 @@ XMPP_PUBSUB_AFFILIATION_MEMBER                             = "member"
 XMPP_PUBSUB_AFFILIATION_NONE                               = "none"
 XMPP_PUBSUB_AFFILIATION_OUTCAST                            = "outcast"
 
+# default max number of items kept in the cache of a node. The oldest are dropped first
+ARCHIPEL_PUBSUB_MAX_CACHED_ITEMS                           = 10000
+
 
 class TNPubSubNode:
 
-    def __init__(self, xmppclient, pubsubserver, nodename):
+    def __init__(self, xmppclient, pubsubserver, nodename, max_items=ARCHIPEL_PUBSUB_MAX_CACHED_ITEMS):
         """
         Initialize the TNPubSubNode.
         @type xmppclient: xmpp.Dispatcher
@@ -75,12 +80,17 @@ class TNPubSubNode:
         @param xmppclient: the string containing the JID of the pubsub server
         @type nodename: string
         @param nodename: the name of the pubsub node
+        @type max_items: int
+        @param max_items: the max number of items kept in the cache
         """
         self.xmppclient     = xmppclient
         self.pubsubserver   = pubsubserver
         self.nodename       = nodename
+        self.max_items      = max_items
         self.recovered      = False
-        self.content        = None
+        self.stale          = False
+        self.content        = OrderedDict()
+        self.content_lock   = RLock()
         self.affiliations   = {}
         self.subscriptions  = []
 
@@ -96,11 +106,25 @@ class TNPubSubNode:
         @return: True in case of success
         """
         try:
-            self.retrieve_items(wait=wait)
             return self.retrieve_items(wait=wait)
         except Exception as ex:
             return False
 
+    def reconnect(self, xmppclient):
+        """
+        Use the new connection of the entity after a reconnection, and
+        retrieve the items at once, so the cache doesn't keep the items
+        from before the disconnection.
+        @type xmppclient: xmpp.Dispatcher
+        @param xmppclient: the new connection
+        @rtype: Boolean
+        @return: True in case of success
+        """
+        self.xmppclient = xmppclient
+        self.recovered = False
+        self.invalidate()
+        return self.recover(wait=True)
+
     def retrieve_items(self, callback=None, wait=False):
         """
         Retrieve or update the content of the node.
@@ -116,8 +140,9 @@ class TNPubSubNode:
         def _did_retrieve_items(conn, resp, callback=None):
             ret = False
             if resp.getType() == "result":
-                self.content = resp.getTag("pubsub").getTag("items").getTags("item")
+                self.set_cached_items(resp.getTag("pubsub").getTag("items").getTags("item"))
                 self.recovered = True
+                self.stale = False
                 ret = True
             if callback:
                 callback(resp)
@@ -229,6 +254,67 @@ class TNPubSubNode:
             return True
 
 
+    ### Item cache
+
+    def set_cached_items(self, items):
+        """
+        Replace the content of the cache.
+        @type items: list
+        @param items: the item nodes, the oldest first
+        """
+        with self.content_lock:
+            self.content = OrderedDict()
+            for item in items:
+                self.cache_item(item)
+
+    def cache_item(self, item):
+        """
+        Add or replace an item in the cache, and drop the oldest items
+        if there are more than max_items.
+        @type item: xmpp.Node
+        @param item: the item node
+        """
+        with self.content_lock:
+            item_id = item.getAttr("id").lower()
+            self.content.pop(item_id, None)
+            self.content[item_id] = item
+            while len(self.content) > self.max_items:
+                self.content.popitem(last=False)
+
+    def uncache_item(self, item_id):
+        """
+        Remove an item from the cache.
+        @type item_id: string
+        @param item_id: the id of the item
+        """
+        with self.content_lock:
+            self.content.pop(item_id.lower(), None)
+
+    def apply_event_items(self, items):
+        """
+        Apply the items and the retracts of an event to the cache.
+        @type items: xmpp.Node
+        @param items: the items node of the event
+        @rtype: Boolean
+        @return: False if the event doesn't carry the payloads, so the cache can't be updated
+        """
+        for child in items.getChildren():
+            if child.getName() == "item":
+                if not child.getChildren():
+                    return False
+                self.cache_item(child)
+            elif child.getName() == "retract":
+                self.uncache_item(child.getAttr("id"))
+        return True
+
+    def invalidate(self):
+        """
+        Mark the cache as stale, so it is retrieved again on reconnection
+        or on the next event.
+        """
+        self.stale = True
+
+
     ### Item management
 
     def get_items(self):
@@ -237,7 +323,8 @@ class TNPubSubNode:
         @rtype: list
         @return: list of pubsub's xmpp.Nonde
         """
-        return self.content
+        with self.content_lock:
+            return self.content.values()
 
     def get_item(self, item_id):
         """
@@ -245,10 +332,8 @@ class TNPubSubNode:
         @type item_id: string
         @param item_id: the pubsub node id
         """
-        for n in self.content:
-            if n.getAttr("id").lower() == item_id.lower():
-                return n
-        return None
+        with self.content_lock:
+            return self.content.get(item_id.lower())
 
     def add_item(self, itemcontentnode, callback=None, wait=False):
         """
@@ -271,7 +356,7 @@ class TNPubSubNode:
         def _did_publish_item(conn, resp, callback, item):
             ret = False
             if resp.getType() == "result" and resp.getTag("pubsub").getTag("publish").getTag("item").getAttr("id") == item.getAttr("id"):
-                self.content.append(item)
+                self.cache_item(item)
                 ret = True
             if callback:
                 return callback(resp)
@@ -300,10 +385,7 @@ class TNPubSubNode:
         retract = pubsub.addChild("retract", attrs={"node": self.nodename})
         item = retract.addChild("item", attrs={"id": item_id})
 
-        for item in self.content:
-            if item.getAttr("id") == item_id:
-                self.content.remove(item)
-                break
+        self.uncache_item(item_id)
 
         def _did_remove_item(conn, resp, callback, user_info):
             ret = False
@@ -371,6 +453,7 @@ class TNPubSubNode:
                 self.retrieve_subscriptions(wait=True)
             if not len(self.subscriptions) == 0:
                 self.xmppclient.RegisterHandler('message', self._on_pubsub_event, ns=xmpp.protocol.NS_PUBSUB+"#event", typ="headline")
+                self.xmppclient.RegisterDisconnectHandler(self.invalidate)
                 return;
 
         iq = xmpp.Iq(typ="set", to=self.pubsubserver)
@@ -381,6 +464,7 @@ class TNPubSubNode:
             ret = False
             if resp.getType() == "result":
                 self.xmppclient.RegisterHandler('message', self._on_pubsub_event, ns=xmpp.protocol.NS_PUBSUB+"#event", typ="headline")
+                self.xmppclient.RegisterDisconnectHandler(self.invalidate)
                 ret = True
             return ret
 
@@ -396,15 +480,37 @@ class TNPubSubNode:
 
     def _on_pubsub_event(self, conn, event):
         """
-        Trigger the callback for events.
-        """
+        Update the cache with the event, and trigger the callback. The
+        whole node is only retrieved when the cache can't be updated
+        from the event: it is stale since a disconnection, or the
+        event doesn't carry the payloads. The cache is cleared when
+        the node is purged or deleted. The callback is not triggered in
+        that case, as it only handles items events.
+        """
+        for name in ("purge", "delete"):
+            cleared = event.getTag("event").getTag(name)
+            if cleared and cleared.getAttr("node") == self.nodename:
+                self.set_cached_items([])
+                if name == "delete":
+                    self.recovered = False
+                return
+
+        items = event.getTag("event").getTag("items")
+        if not items or not items.getAttr("node") == self.nodename:
+            return
+
+        def notify():
+            if self.subscriber_callback and event.getTo().getStripped() == self.subscriber_jid.getStripped():
+                self.subscriber_callback(event)
+
         def on_retrieve(resp):
             if resp.getType() == "result":
-                node = event.getTag("event").getTag("items").getAttr("node")
-                if node == self.nodename and self.subscriber_callback and event.getTo().getStripped() == self.subscriber_jid.getStripped():
-                    self.subscriber_callback(event)
+                notify()
 
-        self.retrieve_items(callback=on_retrieve)
+        if self.stale or not self.recovered or not self.apply_event_items(items):
+            self.retrieve_items(callback=on_retrieve)
+        else:
+            notify()
 
     def unsubscribe(self, jid, subID, callback=None, wait=False):
         """
@@ -422,6 +528,7 @@ class TNPubSubNode:
 
         def _did_unsubscribe(conn, resp, callback):
             self.xmppclient.UnregisterHandler('message', self._on_pubsub_event, ns=xmpp.protocol.NS_PUBSUB+"#event", typ="headline")
+            self.xmppclient.UnregisterDisconnectHandler(self.invalidate)
 
         iq = xmpp.Iq(typ="set", to=self.pubsubserver)
         pubsub = iq.addChild("pubsub", namespace=xmpp.protocol.NS_PUBSUB)
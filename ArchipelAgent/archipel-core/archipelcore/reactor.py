@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+#
+# reactor.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Contains TNXMPPReactor, an event loop that processes the XMPP connections
+of a lot of entities from a single thread.
+
+Instead of running TNArchipelEntity.loop() in one thread per entity, each
+entity registers itself in the reactor, that polls all the sockets at once
+and only processes the connections having incoming data. on_xmpp_loop_tick
+is called by a timer, and the ARCHIPEL_XMPP_LOOP_RESTART state machine
+(reconnection after 1 second, back-off of 5 seconds after an error) is
+kept. Reconnections are performed in short-lived threads, so a slow
+XMPP handshake doesn't block the other entities.
+"""
+
+import heapq
+import os
+import select
+import sys
+import threading
+import time
+import traceback
+
+from archipelcore.archipelEntity import TNArchipelEntity, ARCHIPEL_XMPP_LOOP_OFF, ARCHIPEL_XMPP_LOOP_ON,\
+                                        ARCHIPEL_XMPP_LOOP_RESTART, ARCHIPEL_XMPP_LOOP_REMOVE_USER
+from archipelcore.utils import log
+
+
+# interval between two on_xmpp_loop_tick (same as the Process(3) of the threaded loop)
+ARCHIPEL_REACTOR_TICK_INTERVAL      = 3.0
+
+# max time to wait in poll, in order to notice loop_status changes made by other threads
+ARCHIPEL_REACTOR_MAX_WAIT           = 1.0
+
+# delay before reconnecting, and back-off after an error (same as TNArchipelEntity.loop)
+ARCHIPEL_REACTOR_RESTART_DELAY      = 1.0
+ARCHIPEL_REACTOR_ERROR_BACKOFF      = 5.0
+
+
+class TNXMPPReactor (object):
+    """
+    This class drives the XMPP connections of several L{TNArchipelEntity}
+    from one thread.
+    """
+
+    def __init__(self, owner):
+        """
+        Initialize the reactor.
+        @type owner: L{TNArchipelEntity}
+        @param owner: the entity running the reactor. The reactor stops when its loop is off
+        """
+        self.owner          = owner
+        self.entities       = []
+        self.restarting     = set()
+        self.backoffs       = {}
+        self.timers         = []
+        self.timer_counter  = 0
+        self.running        = False
+        self.lock           = threading.RLock()
+        self.wakeup_read, self.wakeup_write = os.pipe()
+
+    ### Timers
+
+    def wakeup(self):
+        """
+        Interrupt the current poll.
+        """
+        try:
+            os.write(self.wakeup_write, "x")
+        except OSError:
+            pass
+
+    def call_later(self, delay, method, interval=None):
+        """
+        Schedule a method.
+        @type delay: float
+        @param delay: number of seconds before calling the method
+        @type method: function
+        @param method: the method to call
+        @type interval: float
+        @param interval: if set, the method will be called again every interval seconds
+        """
+        with self.lock:
+            self.timer_counter += 1
+            heapq.heappush(self.timers, (time.time() + delay, self.timer_counter, method, interval))
+        self.wakeup()
+
+    def run_timers(self):
+        """
+        Run the due timers.
+        @rtype: float
+        @return: the number of seconds before the next timer
+        """
+        now = time.time()
+        due = []
+        with self.lock:
+            while self.timers and self.timers[0][0] <= now:
+                due.append(heapq.heappop(self.timers))
+        for deadline, counter, method, interval in due:
+            try:
+                keep = method()
+            except Exception as ex:
+                keep = True
+                log.error("REACTOR: error in timer %s: %s" % (str(method), str(ex)))
+            if interval and not keep is False:
+                self.call_later(interval, method, interval)
+        with self.lock:
+            if not self.timers:
+                return ARCHIPEL_REACTOR_MAX_WAIT
+            return max(0, min(self.timers[0][0] - time.time(), ARCHIPEL_REACTOR_MAX_WAIT))
+
+    ### Entities
+
+    def register(self, entity):
+        """
+        Start processing the connection of given entity.
+        @type entity: L{TNArchipelEntity}
+        @param entity: the entity
+        """
+        with self.lock:
+            if entity in self.entities:
+                return
+            self.entities.append(entity)
+        if getattr(entity.on_xmpp_loop_tick, "im_func", None) is not TNArchipelEntity.on_xmpp_loop_tick.im_func:
+            self.call_later(0, lambda: self.tick(entity), ARCHIPEL_REACTOR_TICK_INTERVAL)
+        log.debug("REACTOR: entity %s registered" % entity.jid)
+
+    def unregister(self, entity):
+        """
+        Stop processing the connection of given entity.
+        @type entity: L{TNArchipelEntity}
+        @param entity: the entity
+        """
+        with self.lock:
+            if entity in self.entities:
+                self.entities.remove(entity)
+        log.debug("REACTOR: entity %s unregistered" % entity.jid)
+
+    def tick(self, entity):
+        """
+        Call on_xmpp_loop_tick of given entity if it is online.
+        @type entity: L{TNArchipelEntity}
+        @param entity: the entity
+        @rtype: Boolean
+        @return: False if the entity is not registered anymore
+        """
+        if not entity in self.entities:
+            return False
+        if entity.loop_status == ARCHIPEL_XMPP_LOOP_ON and not entity in self.restarting\
+            and entity.xmppclient and entity.xmppclient.isConnected():
+            entity.on_xmpp_loop_tick()
+        return True
+
+    def check_entities(self):
+        """
+        Apply the loop_status of each entity, as TNArchipelEntity.loop does.
+        """
+        for entity in list(self.entities):
+            if entity in self.restarting:
+                continue
+            if entity.loop_status == ARCHIPEL_XMPP_LOOP_REMOVE_USER:
+                self.unregister(entity)
+                try:
+                    entity.process_inband_unregistration()
+                except Exception as ex:
+                    self.handle_exception(entity, ex)
+            elif entity.loop_status == ARCHIPEL_XMPP_LOOP_OFF:
+                self.unregister(entity)
+                if entity.xmppclient and entity.xmppclient.isConnected():
+                    entity.xmppclient.disconnect()
+            elif entity.loop_status == ARCHIPEL_XMPP_LOOP_RESTART:
+                self.restarting.add(entity)
+                if entity.xmppclient and entity.xmppclient.isConnected():
+                    entity.xmppclient.disconnect()
+                delay = ARCHIPEL_REACTOR_RESTART_DELAY + self.backoffs.pop(entity, 0)
+                self.call_later(delay, lambda entity=entity: self.start_reconnection(entity))
+
+    def start_reconnection(self, entity):
+        """
+        Reconnect the entity in a new thread.
+        @type entity: L{TNArchipelEntity}
+        @param entity: the entity
+        """
+        thread = threading.Thread(target=self.reconnect, args=(entity,))
+        thread.setDaemon(True)
+        thread.start()
+
+    def reconnect(self, entity):
+        """
+        Reconnect the given entity. Called in a dedicated thread.
+        @type entity: L{TNArchipelEntity}
+        @param entity: the entity
+        """
+        try:
+            entity.connect()
+        except Exception as ex:
+            self.handle_exception(entity, ex)
+        finally:
+            self.restarting.discard(entity)
+            self.wakeup()
+
+    def handle_exception(self, entity, ex):
+        """
+        Manage an exception raised while processing an entity, as
+        TNArchipelEntity.loop does.
+        @type entity: L{TNArchipelEntity}
+        @param entity: the entity
+        @type ex: Exception
+        @param ex: the exception
+        """
+        if str(ex).upper().find('USER REMOVED') > -1:
+            entity.log.info("LOOP EXCEPTION: Account has been removed from server.")
+            entity.loop_status = ARCHIPEL_XMPP_LOOP_OFF
+        else:
+            if str(ex).upper().find('SYSTEM-SHUTDOWN') > -1:
+                entity.log.warning("LOOP EXCEPTION: The XMPP server has been shut down. Waiting 5 second for reconnection")
+            else:
+                entity.log.error("LOOP EXCEPTION : Disconnected from server. Trying to reconnect in 5 seconds.")
+                t, v, tr = sys.exc_info()
+                entity.log.error("TRACEBACK: %s" % "\n".join(traceback.format_exception(t, v, tr)))
+            entity.loop_status = ARCHIPEL_XMPP_LOOP_RESTART
+            self.backoffs[entity] = ARCHIPEL_REACTOR_ERROR_BACKOFF
+
+    ### Loop
+
+    def get_socket(self, entity):
+        """
+        @type entity: L{TNArchipelEntity}
+        @param entity: the entity
+        @rtype: int
+        @return: the file descriptor of the entity connection, or None if not ready
+        """
+        if entity in self.restarting or not entity.loop_status == ARCHIPEL_XMPP_LOOP_ON:
+            return None
+        if not entity.xmppclient or not entity.xmppclient.isConnected():
+            return None
+        try:
+            return entity.xmppclient.Connection._sock.fileno()
+        except Exception:
+            return None
+
+    def has_buffered_data(self, entity):
+        """
+        With TLS, data can be already decrypted by the SSL object but not
+        processed yet. poll() would not notice it, so the pending() of the
+        SSL object is checked. Without TLS, or if the SSL object has no
+        pending(), only poll() is used.
+        @type entity: L{TNArchipelEntity}
+        @param entity: the entity
+        @rtype: Boolean
+        @return: True if some data is waiting in the TLS layer
+        """
+        connection = getattr(entity.xmppclient, "Connection", None)
+        if not connection:
+            return False
+        for ssl_object in (getattr(connection, "_sslObj", None), getattr(connection, "_sock", None)):
+            pending = getattr(ssl_object, "pending", None)
+            if callable(pending):
+                return pending() > 0
+        return False
+
+    def process(self, entity):
+        """
+        Process the incoming data of an entity.
+        @type entity: L{TNArchipelEntity}
+        @param entity: the entity
+        """
+        try:
+            entity.xmppclient.Process(0)
+        except Exception as ex:
+            self.handle_exception(entity, ex)
+
+    def run(self):
+        """
+        The main loop. Returns when the owner's loop is off.
+        """
+        self.running = True
+        while not self.owner.loop_status == ARCHIPEL_XMPP_LOOP_OFF:
+            self.check_entities()
+            timeout = self.run_timers()
+
+            sockets = {}
+            ready = []
+            poller = select.poll()
+            poller.register(self.wakeup_read, select.POLLIN)
+            for entity in list(self.entities):
+                fd = self.get_socket(entity)
+                if fd is None:
+                    continue
+                sockets[fd] = entity
+                poller.register(fd, select.POLLIN | select.POLLPRI | select.POLLERR | select.POLLHUP)
+                if self.has_buffered_data(entity):
+                    ready.append(entity)
+            if ready:
+                timeout = 0
+
+            try:
+                events = poller.poll(timeout * 1000)
+            except select.error:
+                continue
+
+            for fd, event in events:
+                if fd == self.wakeup_read:
+                    os.read(self.wakeup_read, 4096)
+                elif fd in sockets and not sockets[fd] in ready:
+                    ready.append(sockets[fd])
+            for entity in ready:
+                self.process(entity)
+
+        self.running = False
+        self.unregister(self.owner)
+        if self.owner.xmppclient and self.owner.xmppclient.isConnected():
+            self.owner.xmppclient.disconnect()
@@ -29,11 +29,12 @@ import ConfigParser
 import socket
 import struct
 import fcntl
-import inspect
 import glob
 import logging
 import logging.handlers
 import os
+import Queue
+import threading
 import xmpp
 import sys
 import traceback
@@ -48,12 +49,24 @@ ARCHIPEL_LOG_INFO                               = 1
 ARCHIPEL_LOG_WARNING                            = 2
 ARCHIPEL_LOG_ERROR                              = 3
 
+ARCHIPEL_LOG_PYTHON_LEVELS                      = { ARCHIPEL_LOG_DEBUG:    logging.DEBUG,
+                                                    ARCHIPEL_LOG_INFO:     logging.INFO,
+                                                    ARCHIPEL_LOG_WARNING:  logging.WARNING,
+                                                    ARCHIPEL_LOG_ERROR:    logging.ERROR}
+
+# default max number of records waiting in the TNArchipelQueueHandler
+ARCHIPEL_LOG_QUEUE_SIZE                         = 10000
+
 
 log = logging.getLogger('archipel')
 
 class TNArchipelLogger:
     """
     archipel logger implt
+    The level is checked before doing anything. The name of the calling method
+    is read from the current frame (not from inspect.stack() that reads source files)
+    and the final message is only built by the handler. Messages can use deferred
+    arguments: log.debug("value is %s", value).
     """
 
     def __init__(self, entity, pubsubnode=None, xmppconn=None):
@@ -61,36 +74,101 @@ class TNArchipelLogger:
         self.entity     = entity
         self.pubSubNode = pubsubnode
 
-    def __log(self, level, msg):
-        log = logging.getLogger('archipel')
-        msg = "\033[33m%s.%s (%s)\033[0m::%s" % (self.entity.__class__.__name__, inspect.stack()[2][3],  self.entity.jid, msg)
+    def __log(self, level, msg, args):
         if level < ARCHIPEL_LOG_LEVEL:
             return
-        elif level == ARCHIPEL_LOG_DEBUG:
-            log.debug(msg)
-        elif level == ARCHIPEL_LOG_INFO:
-            log.info(msg)
-        elif level == ARCHIPEL_LOG_WARNING:
-            log.warning(msg)
-        elif level == ARCHIPEL_LOG_ERROR:
-             log.error(msg)
+        python_level = ARCHIPEL_LOG_PYTHON_LEVELS[level]
+        if not log.isEnabledFor(python_level):
+            return
+        if args:
+            msg = msg % args
+        caller = sys._getframe(2).f_code.co_name
+        log.log(python_level, "\033[33m%s.%s (%s)\033[0m::%s", self.entity.__class__.__name__, caller, self.entity.jid, msg)
 
         # if self.xmppclient and self.pubSubNode:
         #     log = xmpp.Node(tag="log", attrs={"date": datetime.datetime.now(), "level": str(level)})
         #     log.setData(msg)
         #     self.pubSubNode.add_item(log)
 
-    def debug(self, msg):
-        self.__log(ARCHIPEL_LOG_DEBUG, msg)
+    def debug(self, msg, *args):
+        self.__log(ARCHIPEL_LOG_DEBUG, msg, args)
+
+    def info(self, msg, *args):
+        self.__log(ARCHIPEL_LOG_INFO, msg, args)
+
+    def warning(self, msg, *args):
+        self.__log(ARCHIPEL_LOG_WARNING, msg, args)
+
+    def error(self, msg, *args):
+        self.__log(ARCHIPEL_LOG_ERROR, msg, args)
+
+
+class TNArchipelQueueHandler (logging.Handler):
+    """
+    Non blocking log handler. Records are put in a queue and written
+    by the given handler in a dedicated thread, so the disk I/O never
+    happens in the XMPP threads. If the queue is full, records are dropped.
+    """
+
+    def __init__(self, handler, max_size=ARCHIPEL_LOG_QUEUE_SIZE):
+        """
+        Initialize the handler.
+        @type handler: logging.Handler
+        @param handler: the handler that will really write the records
+        @type max_size: int
+        @param max_size: the max number of records waiting to be written
+        """
+        logging.Handler.__init__(self)
+        self.handler    = handler
+        self.queue      = Queue.Queue(max_size)
+        self.dropped    = 0
+        self.thread     = threading.Thread(target=self.process_queue)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def emit(self, record):
+        """
+        Put the record in the queue. The message is built now,
+        as the arguments may change before it's written.
+        @type record: logging.LogRecord
+        @param record: the record
+        """
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
 
-    def info(self, msg):
-        self.__log(ARCHIPEL_LOG_INFO, msg)
+    def process_queue(self):
+        """
+        Write the queued records. Runs in its own thread.
+        """
+        while True:
+            record = self.queue.get()
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                self.handler.handle(logging.makeLogRecord({"name": record.name, "levelno": logging.WARNING, "levelname": "WARNING",
+                                                           "msg": "logging queue was full: %d records have been dropped" % dropped}))
+            self.handler.handle(record)
 
-    def warning(self, msg):
-        self.__log(ARCHIPEL_LOG_WARNING, msg)
+    def setFormatter(self, fmt):
+        """
+        Set the formatter of the real handler.
+        """
+        self.handler.setFormatter(fmt)
 
-    def error(self, msg):
-        self.__log(ARCHIPEL_LOG_ERROR, msg)
+    def close(self):
+        """
+        Close the real handler.
+        """
+        self.handler.close()
+        logging.Handler.close(self)
 
 
 class ColorFormatter (logging.Formatter):
@@ -159,12 +237,17 @@ def init_log(conf):
     handler         = logging.handlers.RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count)
     log_format      = ColorFormatter(conf.get("LOGGING", "logging_formatter", raw=True), conf.get("LOGGING", "logging_date_format", raw=True))
     handler.setFormatter(log_format)
+    if conf.has_option("LOGGING", "logging_use_queue") and conf.getboolean("LOGGING", "logging_use_queue"):
+        queue_size = ARCHIPEL_LOG_QUEUE_SIZE
+        if conf.has_option("LOGGING", "logging_queue_size"):
+            queue_size = conf.getint("LOGGING", "logging_queue_size")
+        handler = TNArchipelQueueHandler(handler, queue_size)
     logger.addHandler(handler)
     logger.setLevel(level)
 
 def build_error_iq(originclass, ex, iq, code=-1, ns=ARCHIPEL_NS_GENERIC_ERROR):
     #traceback.print_exc(file=sys.stdout, limit=20)
-    caller = inspect.stack()[1][3]
+    caller = sys._getframe(1).f_code.co_name
     log.error("%s.%s: exception raised is: '%s' triggered by stanza :\n%s" % (originclass, caller, ex, str(iq)))
     t, v, tr = sys.exc_info()
     log.debug("\n".join(traceback.format_exception(t,v,tr)))
@@ -184,7 +267,7 @@ def build_error_iq(originclass, ex, iq, code=-1, ns=ARCHIPEL_NS_GENERIC_ERROR):
     return reply
 
 def build_error_message(originclass, ex, msg):
-    caller = inspect.stack()[3][3]
+    caller = sys._getframe(3).f_code.co_name
     log.error("%s: exception raised is: '%s' triggered by message:\n %s" % (caller, str(ex), str(msg)))
     return str(ex)
 
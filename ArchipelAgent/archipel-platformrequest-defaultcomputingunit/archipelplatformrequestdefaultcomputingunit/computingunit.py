@@ -32,7 +32,8 @@ class TNDefaultComputingUnit (TNBasicPlatformScoreComputing):
         Initialize the TNBasicPlatformScoreComputing.
         """
         TNBasicPlatformScoreComputing.__init__(self)
-        self.required_stats = [ { "major":"memory", "minor":"free" } ]
+        self.required_stats = [ { "major":"memory", "minor":"free" }, { "major":"load", "minor":"one" } ]
+        self.placement_weights = { "memory": 1.0, "vms": 1.0, "vcpus": 0.5, "load": 0.5 }
 
 
     ## Plugin implementation
@@ -52,36 +53,3 @@ class TNDefaultComputingUnit (TNBasicPlatformScoreComputing):
                     "identifier"                : plugin_identifier,
                     "configuration-section"     : plugin_configuration_section,
                     "configuration-tokens"      : plugin_configuration_tokens }
-
-
-    ### Score computing
-
-    def score(self, database, limit=10):
-        """
-        Perform the score. The highest is the score, the highest chance
-        you got to perform the action. If you want to decline
-        the performing of the action, return 0.0 or None. the max score
-        you can return is 1.0 (so basically see it as a percentage).
-        @type limit: integer
-        @param limit: the number of potential hypervisors to suggest
-        @rtype: list
-        @return: scores of the top hypervisors
-        """
-        # stat1 is the free ram available, we divide it by 256GB of ram to get a first score, the highest ram the better;
-        # 1/(1+num_vm) gives us another score based on the number of vms running, the less the better;
-        # but we have to perform an union to take into account the case of hypervisors with no vms
-        # we multiply these 2 scores to get the final score.
-        hyp_list = []
-        rows = database.execute("select hypervisors.jid, 1.0/(1+count(vms.uuid))*(hypervisors.stat1/256000000.0) as score_vms\
-                from hypervisors join vms on hypervisors.jid=vms.hypervisor\
-                where hypervisors.status='Online'\
-                union\
-                select hypervisors.jid, (hypervisors.stat1/256000000.0) as score_vms\
-                from hypervisors left outer join vms on hypervisors.jid=vms.hypervisor\
-                where hypervisors.status='Online'\
-                and vms.uuid is null \
-                order by score_vms asc \
-                limit %s;" % limit)
-        for row in rows:
-            hyp_list.append({"jid":row[0], "score":row[1]})
-        return hyp_list
@@ -0,0 +1,112 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# benchLogger.py
+#
+# Copyright (C) 2010 Antoine Mercadal <antoine.mercadal@inframonde.eu>
+# This file is part of ArchipelProject
+# http://archipelproject.org
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Micro benchmark of TNArchipelLogger.
+
+It compares the per-call cost of the previous implementation (based on
+inspect.stack()) with the current one, with the message filtered by the
+level and with the message written to a file.
+Run it on a machine where archipel-core is installed:
+    python benchLogger.py [-n ITERATIONS]
+"""
+
+import argparse
+import inspect
+import logging
+import os
+import tempfile
+import timeit
+
+from archipelcore.utils import log, TNArchipelLogger, TNArchipelQueueHandler
+
+
+class FakeEntity:
+    """
+    Minimal entity used as logger owner.
+    """
+    def __init__(self):
+        self.jid = "bench@archipel.test/bench"
+
+
+class TNLegacyArchipelLogger:
+    """
+    The previous implementation of TNArchipelLogger.
+    """
+    def __init__(self, entity):
+        self.entity = entity
+
+    def __log(self, level, msg):
+        msg = "\033[33m%s.%s (%s)\033[0m::%s" % (self.entity.__class__.__name__, inspect.stack()[2][3],  self.entity.jid, msg)
+        if level == logging.DEBUG:
+            log.debug(msg)
+        else:
+            log.info(msg)
+
+    def debug(self, msg):
+        self.__log(logging.DEBUG, msg)
+
+    def info(self, msg):
+        self.__log(logging.INFO, msg)
+
+
+def bench(name, method, iterations):
+    """
+    Run the method and print the cost of one call.
+    """
+    total = timeit.timeit(method, number=iterations)
+    print "%-45s %10.2f us/call" % (name, total * 1000000.0 / iterations)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--iterations", dest="iterations", type=int, default=2000, help="number of calls per test")
+    options = parser.parse_args()
+
+    entity = FakeEntity()
+    legacy = TNLegacyArchipelLogger(entity)
+    current = TNArchipelLogger(entity)
+    value = {"some": "payload", "to": "format"}
+
+    log_file = tempfile.mktemp()
+    file_handler = logging.FileHandler(log_file)
+    log.addHandler(file_handler)
+
+    print "filtered (level is INFO, calling debug):"
+    log.setLevel(logging.INFO)
+    bench("  before: inspect.stack()", lambda: legacy.debug("value is %s" % str(value)), options.iterations)
+    bench("  after: pre-formatted message", lambda: current.debug("value is %s" % str(value)), options.iterations)
+    bench("  after: deferred arguments", lambda: current.debug("value is %s", value), options.iterations)
+
+    print "written to file (level is DEBUG):"
+    log.setLevel(logging.DEBUG)
+    bench("  before: inspect.stack()", lambda: legacy.debug("value is %s" % str(value)), options.iterations)
+    bench("  after: deferred arguments", lambda: current.debug("value is %s", value), options.iterations)
+
+    log.removeHandler(file_handler)
+    queue_handler = TNArchipelQueueHandler(file_handler)
+    log.addHandler(queue_handler)
+    bench("  after: deferred arguments, queue handler", lambda: current.debug("value is %s", value), options.iterations)
+
+    log.removeHandler(queue_handler)
+    file_handler.close()
+    os.unlink(log_file)